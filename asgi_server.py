@@ -0,0 +1,327 @@
+"""ASGI variant of the hospital server, run with uvicorn.
+
+Serves the same routes as server.py with the same answers, but a request
+is a coroutine rather than a thread. Database calls are handed to a
+bounded pool of DB_THREADS worker threads, so a request that is only
+waiting costs a coroutine and a socket. That covers /changes?wait=
+subscriptions and /snapshot downloads by slow clients. Waiting /changes
+requests share a single poll of the change log.
+
+Needs starlette and uvicorn (see requirements.txt).
+
+Usage: python asgi_server.py <hospital_name> <port> <db_name> [hospital_id]
+       [--master <federation_url>] [--backup-dir <dir>] [--archive-days <days>] [--shards <n>]
+"""
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from database import ARCHIVE_DATES, ID_COLUMNS, VIEW_FILTERS
+from server import CHANGES_MAX_WAIT, CHANGES_POLL, SNAPSHOT_CHUNK, parse_arguments, valid_ids, write_answer
+import anyio
+import asyncio
+import contextlib
+import os
+import server
+import sys
+import tempfile
+import uvicorn
+import zlib
+
+# Worker threads for database calls, however many requests are open
+DB_THREADS = 32
+
+def read_feed(since, tables, limit):
+    """(seq, entries) of the change feed and the latest log position"""
+    seq, entries = server.db.change_feed(since, tables, limit)
+    return seq, entries, server.db.last_change()
+
+class ChangeNotifier:
+    """Wakes waiting /changes requests when the change log moves.
+
+    While anyone is waiting, one task looks at the log every CHANGES_POLL
+    seconds (right away after a write through this server), instead of
+    every waiting request polling it. Woken requests asking for the same
+    feed share one read of it per log position.
+    """
+    def __init__(self):
+        self.seq = 0
+        self.changed = asyncio.Event()
+        self.poked = asyncio.Event()
+        self.waiting = 0
+        self.poller = None
+        self.feeds = {}
+
+    def poke(self):
+        """Look at the change log now, e.g. after a write"""
+        self.poked.set()
+
+    async def poll(self):
+        while self.waiting:
+            seq = await run_in_threadpool(server.db.last_change)
+            if seq != self.seq:
+                self.seq = seq
+                self.feeds = {}
+                changed, self.changed = self.changed, asyncio.Event()
+                changed.set()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.poked.wait(), CHANGES_POLL)
+            self.poked.clear()
+        self.poller = None
+
+    async def wait(self, seen, timeout):
+        """Wait until the log position differs from seen (a value of seq),
+        at most timeout seconds"""
+        if self.seq != seen:
+            return
+        self.waiting += 1
+        if self.poller is None:
+            self.poller = asyncio.create_task(self.poll())
+        try:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.changed.wait(), timeout)
+        finally:
+            self.waiting -= 1
+
+    async def feed(self, since, tables, limit):
+        """read_feed() for a request woken by wait()"""
+        key = (since, tuple(tables or ()), limit)
+        if key not in self.feeds:
+            self.feeds[key] = asyncio.ensure_future(run_in_threadpool(read_feed, since, tables, limit))
+        # A request that goes away doesn't cancel the read for the others
+        return await asyncio.shield(self.feeds[key])
+
+notifier = ChangeNotifier()
+
+class Activity:
+    """Does for every request what server.ship_writes does for the Flask
+    app, and wakes the change notifier after writes"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        if server.maintenance:
+            server.maintenance.touch()
+        await self.app(scope, receive, send)
+        if scope['method'] in ('POST', 'PUT', 'DELETE'):
+            if server.shipper:
+                server.shipper.notify()
+            notifier.poke()
+
+def arg(request, name, default=None, type=None):
+    """Query parameter like Flask's request.args.get: default if it is
+    missing or can't be converted with type"""
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    if type is None:
+        return value
+    try:
+        return type(value)
+    except ValueError:
+        return default
+
+async def json_body(request):
+    """The request's JSON body, or None if there isn't one"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+def is_json(request):
+    """Whether the body is declared as JSON, as Flask's request.json
+    requires (it answers 415 otherwise)"""
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    return mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+def error(message, status_code):
+    return JSONResponse({'status': 'error', 'message': message}, status_code)
+
+async def health(request):
+    db = server.db
+    return JSONResponse({'status': 'ok', 'hospital': db.hospital_name, 'hospital_id': db.hospital_id})
+
+async def search_sketch(request):
+    """See server.search_sketch"""
+    sketch = server.sketch
+    await run_in_threadpool(sketch.refresh)
+    if arg(request, 'seq', type=int) == sketch.seq:
+        return JSONResponse({'hospital': server.db.hospital_name, 'seq': sketch.seq, 'unchanged': True})
+    return JSONResponse({'hospital': server.db.hospital_name, **sketch.to_dict()})
+
+async def changes(request):
+    """See server.changes; a waiting request holds no thread"""
+    db = server.db
+    tables = request.query_params.getlist('table') or None
+    since, limit = arg(request, 'since', 0, int), arg(request, 'limit', type=int)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(arg(request, 'wait', 0, float), CHANGES_MAX_WAIT)
+    seen = notifier.seq
+    seq, entries, latest = await run_in_threadpool(read_feed, since, tables, limit)
+    while not entries and loop.time() < deadline:
+        await notifier.wait(seen, deadline - loop.time())
+        seen = notifier.seq
+        seq, entries, latest = await notifier.feed(since, tables, limit)
+    return JSONResponse({'hospital': db.hospital_name, 'seq': seq, 'latest': latest, 'changes': entries})
+
+def read_compressed(f, compressor):
+    """Compressed next SNAPSHOT_CHUNK of f (possibly empty), or None at
+    the end of the file"""
+    chunk = f.read(SNAPSHOT_CHUNK)
+    return compressor.compress(chunk) if chunk else None
+
+async def snapshot(request):
+    """See server.snapshot; reading and compressing happen on worker
+    threads, and a slow client only holds its coroutine"""
+    db = server.db
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        seq = await run_in_threadpool(db.snapshot, path)
+    except:
+        os.remove(path)
+        raise
+
+    async def stream():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    data = await run_in_threadpool(read_compressed, f, compressor)
+                    if data is None:
+                        break
+                    if data:
+                        yield data
+            yield compressor.flush()
+        finally:
+            os.remove(path)
+
+    return StreamingResponse(stream(), media_type='application/gzip',
+                             headers={'X-Snapshot-Seq': str(seq), 'X-Hospital-Id': str(db.hospital_id)})
+
+async def stats(request):
+    return JSONResponse(await run_in_threadpool(server.db.stats, arg(request, 'since') or None,
+                                                arg(request, 'top', 10, int)))
+
+async def doctor_availability(request):
+    db = server.db
+    doctor_id = request.path_params['doctor_id']
+    date, time_text = arg(request, 'date'), arg(request, 'time')
+    try:
+        conflicts = await run_in_threadpool(db.conflicts, doctor_id, date or '', time_text)
+    except ValueError:
+        return error('date (YYYY-MM-DD) and time (HH:MM) are required', 400)
+    return JSONResponse({'hospital': db.hospital_name, 'doctor_id': doctor_id, 'date': date, 'time': time_text,
+                         'available': not conflicts, 'conflicts': conflicts})
+
+async def availability(request):
+    db = server.db
+    try:
+        slots = await run_in_threadpool(db.free_slots, arg(request, 'specialization'), arg(request, 'count', 5, int),
+                                        arg(request, 'after') or None, arg(request, 'doctor_id', type=int))
+    except ValueError:
+        return error('after must be YYYY-MM-DD HH:MM', 400)
+    return JSONResponse({'hospital': db.hospital_name, 'slots': slots})
+
+async def maintenance_status(request):
+    if request.method == 'POST':
+        reports = [await run_in_threadpool(server.maintenance.enable_vacuum)] if arg(request, 'enable_vacuum') else []
+        return JSONResponse(reports + await run_in_threadpool(server.maintenance.run_due, True))
+    return JSONResponse(server.maintenance.summary())
+
+def table_endpoint(table):
+    """GET (search, or with ?archive=1 for archived tables), POST and bulk
+    DELETE of a table, like server.patients() and the others"""
+    async def endpoint(request):
+        db = server.db
+        if request.method == 'GET':
+            if table in ARCHIVE_DATES:
+                rows = await run_in_threadpool(db.get_all, table, bool(arg(request, 'archive')))
+            else:
+                rows = await run_in_threadpool(db.search, table, arg(request, 'search', ''))
+            return JSONResponse(rows)
+        if request.method == 'POST':
+            if not is_json(request):
+                return error('Expected a JSON body', 415)
+            data = await json_body(request)
+            if not isinstance(data, dict) or not data:
+                return error('Expected the new row as a JSON object', 400)
+            return JSONResponse(write_answer(table, await run_in_threadpool(db.insert, table, data)))
+        data = await json_body(request)
+        ids = data.get('ids') if isinstance(data, dict) else None
+        if not valid_ids(ids):
+            return error('Expected a list of IDs in ids', 400)
+        return JSONResponse({'status': 'success',
+                             **await run_in_threadpool(db.delete_many, table, ID_COLUMNS[table], ids)})
+    return endpoint
+
+def row_endpoint(table):
+    """PUT and DELETE of one row, like server.write_row()"""
+    async def endpoint(request):
+        db = server.db
+        row_id = request.path_params['row_id']
+        if request.method == 'PUT':
+            if not is_json(request):
+                return error('Expected a JSON body', 415)
+            data = await json_body(request)
+            if not isinstance(data, dict) or not data:
+                return error('No columns to update', 400)
+            result = await run_in_threadpool(db.update, table, ID_COLUMNS[table], row_id, data)
+        else:
+            result = await run_in_threadpool(db.delete, table, ID_COLUMNS[table], row_id)
+        return JSONResponse(write_answer(table, result))
+    return endpoint
+
+async def patient_timeline(request):
+    patient_id = request.path_params['patient_id']
+    timeline = await run_in_threadpool(server.db.timeline, patient_id, bool(arg(request, 'archive')))
+    if timeline is None:
+        return error(f'Unknown patient {patient_id}', 404)
+    return JSONResponse(timeline)
+
+async def list_view(request):
+    db = server.db
+    table = request.path_params['table']
+    if table not in VIEW_FILTERS:
+        return error(f'Unknown view {table}', 404)
+    filters = {column: request.query_params[column] for column in VIEW_FILTERS[table]
+               if column in request.query_params}
+    limit, offset = arg(request, 'limit', type=int), arg(request, 'offset', 0, int)
+    page = await run_in_threadpool(db.list_view, table, arg(request, 'search', ''), filters, arg(request, 'since'),
+                                   arg(request, 'until'), limit, offset, bool(arg(request, 'archive')))
+    return JSONResponse({'hospital': db.hospital_name, 'limit': limit, 'offset': offset, **page})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DB_THREADS
+    yield
+
+routes = [
+    Route('/health', health, methods=['GET']),
+    Route('/sketch', search_sketch, methods=['GET']),
+    Route('/changes', changes, methods=['GET']),
+    Route('/snapshot', snapshot, methods=['GET']),
+    Route('/stats', stats, methods=['GET']),
+    Route('/doctors/{doctor_id:int}/availability', doctor_availability, methods=['GET']),
+    Route('/availability', availability, methods=['GET']),
+    Route('/maintenance', maintenance_status, methods=['GET', 'POST']),
+    Route('/patients/{patient_id:int}/timeline', patient_timeline, methods=['GET']),
+    Route('/views/{table}', list_view, methods=['GET']),
+]
+for table in ID_COLUMNS:
+    routes.append(Route(f'/{table}', table_endpoint(table), methods=['GET', 'POST', 'DELETE']))
+    routes.append(Route(f'/{table}/{{row_id:int}}', row_endpoint(table), methods=['PUT', 'DELETE']))
+
+app = Activity(Starlette(routes=routes, lifespan=lifespan))
+
+def start_server(hospital_name, port, db_name, hospital_id=None, master_url=None, backup_dir=None,
+                 archive_days=None, shards=None):
+    server.setup(hospital_name, db_name, hospital_id, master_url, backup_dir, archive_days, shards)
+    # Waiting /changes requests would otherwise hold up a shutdown for up
+    # to CHANGES_MAX_WAIT
+    uvicorn.run(app, host='0.0.0.0', port=port, timeout_graceful_shutdown=5)
+
+if __name__ == '__main__':
+    start_server(*parse_arguments(sys.argv[1:], 'asgi_server.py'))
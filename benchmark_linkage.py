@@ -0,0 +1,132 @@
+"""Benchmark cross-hospital patient linkage on synthetic data.
+
+Generates patients spread over three hospitals, with a share of people
+registered at several of them under slightly different details (typos,
+missing phone, age off by one), then times a full linkage run and an
+incremental run and reports precision/recall against the known truth.
+
+Usage: python benchmark_linkage.py [patients] [duplicate_rate]
+"""
+from collections import Counter
+from database import HospitalDatabase
+from linkage import PatientLinker
+import os
+import random
+import sys
+import tempfile
+import time
+
+FIRST_NAMES = ['ali', 'sara', 'reza', 'maryam', 'hossein', 'zahra', 'mohammad', 'fatemeh', 'amir',
+               'narges', 'mehdi', 'leila', 'hamid', 'neda', 'jafar', 'parisa', 'omid', 'shirin',
+               'saeed', 'mina', 'kaveh', 'azadeh', 'babak', 'elham', 'farhad', 'golnar', 'javad',
+               'katayoun', 'majid', 'nasrin', 'peyman', 'roya', 'siavash', 'taraneh', 'vahid', 'yasaman']
+SYLLABLES = ['ka', 'ri', 'mo', 'za', 'de', 'ha', 'ni', 'ba', 'sa', 'lo', 'far', 'jan', 'tah', 'mir',
+             'rez', 'gol', 'dar', 'kia', 'pour', 'zad', 'vand', 'loo', 'nejad', 'abadi']
+HOSPITALS = ['Central Hospital', 'City Hospital', 'General Hospital']
+
+class ListSource:
+    def __init__(self, hospital_id, hospital, rows):
+        self.hospital_id = hospital_id
+        self.hospital = hospital
+        self.rows = rows
+
+    def snapshot(self):
+        return 0, self.rows
+
+def typo(text, rng):
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return text[:i] + text[i + 1:]
+    if kind == 1:
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    return text[:i] + rng.choice('aeiou') + text[i + 1:]
+
+def generate(count, duplicate_rate, seed=7):
+    """Patient rows per hospital plus the true person behind each row"""
+    rng = random.Random(seed)
+    rows = {hospital: [] for hospital in HOSPITALS}
+    truth = {}
+    person = 0
+    while sum(len(r) for r in rows.values()) < count:
+        person += 1
+        name = f"{rng.choice(FIRST_NAMES)} {''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))}"
+        phone = f"+98-9{rng.randint(10, 99)}-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}"
+        age = rng.randint(1, 90)
+        gender = rng.choice(['Male', 'Female'])
+        copies = rng.sample(HOSPITALS, rng.randint(2, 3)) if rng.random() < duplicate_rate else [rng.choice(HOSPITALS)]
+        for copy, hospital in enumerate(copies):
+            row = {'patient_id': len(rows[hospital]) + 1, 'name': name.title(), 'age': age, 'gender': gender,
+                   'phone': phone, 'address': '', 'created_at': '2025-06-01 10:00:00'}
+            if copy:
+                change = rng.random()
+                if change < 0.3:
+                    row['name'] = typo(name, rng).title()
+                elif change < 0.5:
+                    row['phone'] = ''
+                elif change < 0.6:
+                    row['age'] = age + rng.choice([-1, 1])
+            rows[hospital].append(row)
+            truth[(hospital, row['patient_id'])] = person
+    return rows, truth
+
+def pair_count(counter):
+    return sum(n * (n - 1) // 2 for n in counter.values())
+
+def evaluate(db, truth):
+    predicted = {(row['hospital'], row['patient_id']): row['global_id']
+                 for row in db.execute_query('SELECT hospital, patient_id, global_id FROM master_patient_index')}
+    predicted_pairs = pair_count(Counter(predicted.values()))
+    true_pairs = pair_count(Counter(truth.values()))
+    correct_pairs = pair_count(Counter((predicted[key], person) for key, person in truth.items()))
+    precision = correct_pairs / predicted_pairs if predicted_pairs else 1.0
+    recall = correct_pairs / true_pairs if true_pairs else 1.0
+    return precision, recall
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    duplicate_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    incremental = min(1000, count // 10)
+
+    started = time.perf_counter()
+    rows, truth = generate(count + incremental, duplicate_rate)
+    print(f"Generated {sum(len(r) for r in rows.values())} patients in {time.perf_counter() - started:.1f}s")
+
+    # Hold the last rows of each hospital back to link incrementally afterwards
+    per_hospital = incremental // len(HOSPITALS)
+    initial = {hospital: hospital_rows[:len(hospital_rows) - per_hospital] for hospital, hospital_rows in rows.items()}
+    held_back = {hospital: hospital_rows[len(hospital_rows) - per_hospital:] for hospital, hospital_rows in rows.items()}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = HospitalDatabase(os.path.join(tmp, 'linkage.db'), 'Central Hospital')
+        linker = PatientLinker(db)
+
+        started = time.perf_counter()
+        linker.rebuild([ListSource(HOSPITALS.index(hospital) + 1, hospital, hospital_rows)
+                        for hospital, hospital_rows in initial.items()])
+        elapsed = time.perf_counter() - started
+        linked = sum(len(r) for r in initial.values())
+        naive = linked * (linked - 1) // 2
+        print(f"Full linkage: {linked} patients in {elapsed:.1f}s "
+              f"({linked / elapsed:,.0f}/s), {linker.pairs_compared:,} pairs compared "
+              f"vs {naive:,} for all pairs")
+        initial_truth = {key: person for key, person in truth.items() if key[1] <= len(initial[key[0]])}
+        precision, recall = evaluate(db, initial_truth)
+        print(f"  precision {precision:.3f}, recall {recall:.3f}")
+
+        linker.pairs_compared = 0
+        started = time.perf_counter()
+        for hospital, hospital_rows in held_back.items():
+            linker.apply(HOSPITALS.index(hospital) + 1, hospital,
+                         [{'row_id': row['patient_id'], 'row': row} for row in hospital_rows], 0)
+        elapsed = time.perf_counter() - started
+        added = max(1, sum(len(r) for r in held_back.values()))
+        print(f"Incremental: {added} patients in {elapsed:.2f}s ({elapsed / added * 1000:.2f} ms each), "
+              f"{linker.pairs_compared:,} candidates scored")
+        precision, recall = evaluate(db, truth)
+        print(f"  precision {precision:.3f}, recall {recall:.3f}")
+
+if __name__ == '__main__':
+    main()
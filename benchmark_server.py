@@ -0,0 +1,144 @@
+"""Benchmark the Flask server (server.py) against the ASGI server
+(asgi_server.py) with many idle connections.
+
+Each server is started on a copy of city_hospital.db. The benchmark then:
+- runs patient searches from CONCURRENCY clients for a few seconds;
+- opens <subscriptions> /changes?wait= long polls that stay idle;
+- runs the searches again while they wait, noting the server's threads
+  and memory where /proc is available;
+- makes one write and times how long it takes every subscriber to get it.
+
+Usage: python benchmark_server.py [subscriptions] [seconds]
+"""
+from client import HospitalClient
+from server import CHANGES_MAX_WAIT
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SERVERS = [('Flask', 'server.py', 5801), ('ASGI', 'asgi_server.py', 5802)]
+CONCURRENCY = 20
+# Connections opened at a time while setting up the subscriptions
+CONNECT_BATCH = 50
+SEARCH_PATH = '/patients?search=a'
+
+async def send(port, method, path, body=None):
+    """Open a connection and send one request; returns the reader and
+    writer for the answer"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode() if body is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'
+                 f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n'.encode() + data)
+    await writer.drain()
+    return reader, writer
+
+async def answer(reader, writer):
+    """Status and JSON body of the answer to a request sent with send()"""
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), json.loads(body) if body else None
+
+async def request(port, method, path, body=None):
+    return await answer(*await send(port, method, path, body))
+
+async def load(port, seconds):
+    """Latencies in seconds of the searches CONCURRENCY clients make in
+    the given time"""
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            status, _ = await request(port, 'GET', SEARCH_PATH)
+            if status != 200:
+                raise RuntimeError(f'search answered {status}')
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    return latencies
+
+def process_stats(pid):
+    """Threads and resident memory (MB) of a process, or None without /proc"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+    except OSError:
+        return None
+    return int(fields['Threads']), int(fields['VmRSS'].split()[0]) / 1024
+
+def describe_load(latencies, elapsed, stats):
+    latencies = sorted(latencies)
+    text = (f"{len(latencies)} searches in {elapsed:.1f}s ({len(latencies) / elapsed:,.0f}/s), "
+            f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+    if stats:
+        text += f"; server has {stats[0]} threads, {stats[1]:.0f} MB"
+    return text
+
+async def measure(port, pid, subscriptions, seconds):
+    started = time.perf_counter()
+    latencies = await load(port, seconds)
+    print(f"  idle: {describe_load(latencies, time.perf_counter() - started, process_stats(pid))}")
+
+    _, feed = await request(port, 'GET', '/changes?since=0&limit=1')
+    path = f"/changes?since={feed['latest']}&wait={CHANGES_MAX_WAIT}"
+    started = time.perf_counter()
+    waiting = []
+    for start in range(0, subscriptions, CONNECT_BATCH):
+        batch = range(start, min(start + CONNECT_BATCH, subscriptions))
+        waiting.extend(await asyncio.gather(*(send(port, 'GET', path) for _ in batch)))
+    # Give the server a moment to pick every subscription up
+    await asyncio.sleep(1)
+    stats = process_stats(pid)
+    print(f"  {subscriptions} subscriptions opened in {time.perf_counter() - started:.1f}s"
+          + (f"; server has {stats[0]} threads, {stats[1]:.0f} MB" if stats else ''))
+
+    started = time.perf_counter()
+    latencies = await load(port, seconds)
+    print(f"  with subscriptions: {describe_load(latencies, time.perf_counter() - started, process_stats(pid))}")
+
+    started = time.perf_counter()
+    await request(port, 'POST', '/doctors', {'name': 'Benchmark Doctor', 'specialization': 'Benchmarking'})
+    answers = await asyncio.gather(*(answer(*connection) for connection in waiting), return_exceptions=True)
+    received = sum(1 for result in answers if not isinstance(result, Exception) and result[1]['changes'])
+    print(f"  one write reached {received}/{subscriptions} subscribers in {time.perf_counter() - started:.2f}s")
+
+def run(name, script, port, db_name, subscriptions, seconds):
+    process = subprocess.Popen([sys.executable, script, 'Benchmark Hospital', str(port), db_name],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        client = HospitalClient(f'http://127.0.0.1:{port}')
+        for _ in range(100):
+            if client.check_health():
+                break
+            time.sleep(0.2)
+        else:
+            raise RuntimeError(f'{script} did not start')
+        print(f"{name} ({script})")
+        asyncio.run(measure(port, process.pid, subscriptions, seconds))
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def main():
+    subscriptions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, script, port in SERVERS:
+            db_name = os.path.join(tmp, f'{name.lower()}.db')
+            shutil.copy(os.path.join(here, 'city_hospital.db'), db_name)
+            run(name, script, port, db_name, subscriptions, seconds)
+
+if __name__ == '__main__':
+    main()
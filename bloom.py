@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import math
+import threading
+from database import ID_COLUMNS
+
+def trigrams(text):
+    """Lower-cased 3-character substrings of text"""
+    text = str(text).lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    Answers "definitely not present" or "maybe present"; serialises to a
+    small dict so hospitals can publish it over HTTP.
+    """
+    def __init__(self, capacity=1000, error_rate=0.01, size=None, hashes=None):
+        if size is None:
+            size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if hashes is None:
+            hashes = max(1, round(size / capacity * math.log(2)))
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+    def to_dict(self):
+        return {'size': self.size, 'hashes': self.hashes,
+                'bits': base64.b64encode(self.bits).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        bloom = cls(size=data['size'], hashes=data['hashes'])
+        bloom.bits = bytearray(base64.b64decode(data['bits']))
+        return bloom
+
+def might_match(bloom, search_term):
+    """False only if no row summarised by bloom can match search_term.
+
+    Searches are substring (LIKE) matches, so a row can only match if it
+    contains every trigram of the term. Terms shorter than three characters
+    or containing LIKE wildcards can't be ruled out.
+    """
+    if len(search_term) < 3 or '%' in search_term or '_' in search_term:
+        return True
+    return all(gram in bloom for gram in trigrams(search_term))
+
+class SearchSketch:
+    """Per-table Bloom filters over the trigrams of every searchable value
+    in a hospital database, kept current from its change log.
+
+    Inserts and updates are folded in incrementally; deleted and overwritten
+    values only cause false positives, so the filters are rebuilt once
+    REBUILD_AFTER of those have accumulated.
+    """
+    TABLES = ('patients', 'doctors')
+    ERROR_RATE = 0.01
+    REBUILD_AFTER = 1000
+
+    def __init__(self, db):
+        self.db = db
+        # Reentrant: refresh() rebuilds while holding it
+        self.lock = threading.RLock()
+        self.build()
+
+    def row_trigrams(self, row):
+        grams = set()
+        for column, value in row.items():
+            # Global IDs are computed, not searchable columns
+            if value is not None and not column.endswith('gid'):
+                grams |= trigrams(value)
+        return grams
+
+    def build(self):
+        with self.lock:
+            self.seq = self.db.last_change()
+            self.grams = {}
+            for table in self.TABLES:
+                grams = set()
+                for row in self.db.get_all(table):
+                    grams |= self.row_trigrams(row)
+                self.grams[table] = grams
+            self.capacity = {}
+            self.filters = {table: self.make_filter(table) for table in self.TABLES}
+            self.stale = 0
+
+    def make_filter(self, table):
+        # Room to grow before the incremental path has to resize
+        self.capacity[table] = max(1024, len(self.grams[table]) * 2)
+        bloom = BloomFilter(capacity=self.capacity[table], error_rate=self.ERROR_RATE)
+        for gram in self.grams[table]:
+            bloom.add(gram)
+        return bloom
+
+    def refresh(self):
+        """Fold in writes logged since the last refresh"""
+        # Held throughout so concurrent refreshes can't read the same seq
+        # and fold the same changes in twice
+        with self.lock:
+            changes = self.db.changes_since(self.seq, self.TABLES)
+            if not changes:
+                return
+            if self.stale + len(changes) >= self.REBUILD_AFTER:
+                self.build()
+                return
+            for change in changes:
+                table = change['table_name']
+                self.seq = max(self.seq, change['seq'])
+                if change['op'] != 'insert':
+                    self.stale += 1
+                if change['op'] == 'delete':
+                    continue
+                row = self.db.get(table, ID_COLUMNS[table], change['row_id'])
+                if not row:
+                    continue
+                new_grams = self.row_trigrams(row) - self.grams[table]
+                self.grams[table] |= new_grams
+                if len(self.grams[table]) > self.capacity[table]:
+                    self.filters[table] = self.make_filter(table)
+                else:
+                    for gram in new_grams:
+                        self.filters[table].add(gram)
+
+    def to_dict(self):
+        with self.lock:
+            return {'seq': self.seq,
+                    'tables': {table: bloom.to_dict() for table, bloom in self.filters.items()}}
@@ -1,5 +1,6 @@
 import requests
 import json
+import zlib
 
 class HospitalClient:
     def __init__(self, base_url):
@@ -12,6 +13,76 @@ class HospitalClient:
         except:
             return None
     
+    def get_sketch(self, seq=None):
+        """Search sketch of the hospital; {'unchanged': True} if it is still at seq"""
+        try:
+            response = requests.get(f'{self.base_url}/sketch', 
+                                  params={'seq': seq} if seq is not None else {}, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def get_changes(self, since=0, tables=None, limit=None):
+        """Rows changed on the hospital after since (see HospitalDatabase.change_feed)"""
+        params = {'since': since}
+        if tables:
+            params['table'] = list(tables)
+        if limit is not None:
+            params['limit'] = limit
+        try:
+            response = requests.get(f'{self.base_url}/changes', params=params, timeout=30)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def download_snapshot(self, path):
+        """Save a consistent copy of the hospital database to path and return
+        the change sequence it corresponds to, or None on failure; pass that
+        to get_changes() to continue from the copy"""
+        try:
+            with requests.get(f'{self.base_url}/snapshot', stream=True, timeout=30) as response:
+                if response.status_code != 200:
+                    return None
+                decompressor = zlib.decompressobj(31)
+                with open(path, 'wb') as f:
+                    for chunk in response.iter_content(64 * 1024):
+                        f.write(decompressor.decompress(chunk))
+                    f.write(decompressor.flush())
+                return int(response.headers['X-Snapshot-Seq'])
+        except:
+            return None
+    
+    def get_stats(self, since=None, top=10):
+        """Dashboard summary of the hospital (see HospitalDatabase.stats)"""
+        params = {'top': top}
+        if since:
+            params['since'] = since
+        try:
+            response = requests.get(f'{self.base_url}/stats', params=params, timeout=10)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def check_availability(self, doctor_id, date, time_text):
+        """Whether a doctor is free, with the conflicting appointments"""
+        try:
+            response = requests.get(f'{self.base_url}/doctors/{doctor_id}/availability',
+                                  params={'date': date, 'time': time_text}, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def get_free_slots(self, specialization, count=5, after=None):
+        """Next free slots of the doctors of a specialization"""
+        params = {'specialization': specialization, 'count': count}
+        if after:
+            params['after'] = after
+        try:
+            response = requests.get(f'{self.base_url}/availability', params=params, timeout=5)
+            return response.json()['slots'] if response.status_code == 200 else None
+        except:
+            return None
+    
     def get_patients(self, search_term=''):
         try:
             response = requests.get(f'{self.base_url}/patients', 
@@ -44,9 +115,35 @@ class HospitalClient:
         except:
             return None
     
-    def get_appointments(self):
+    def get_timeline(self, patient_id, include_archive=False):
+        """A patient's appointments and records (see HospitalDatabase.timeline)"""
+        try:
+            response = requests.get(f'{self.base_url}/patients/{patient_id}/timeline', 
+                                  params={'archive': 1} if include_archive else {}, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def get_view(self, table, search_term='', filters=None, since=None, until=None, limit=None, offset=0,
+                 include_archive=False):
+        """A page of appointments or medical records with patient and
+        doctor names ({'rows', 'total', ...}, see HospitalDatabase.list_view)"""
+        params = dict(filters or {}, search=search_term, offset=offset)
+        for name, value in (('since', since), ('until', until), ('limit', limit)):
+            if value is not None:
+                params[name] = value
+        if include_archive:
+            params['archive'] = 1
+        try:
+            response = requests.get(f'{self.base_url}/views/{table}', params=params, timeout=10)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def get_appointments(self, include_archive=False):
         try:
-            response = requests.get(f'{self.base_url}/appointments', timeout=5)
+            response = requests.get(f'{self.base_url}/appointments', 
+                                  params={'archive': 1} if include_archive else {}, timeout=5)
             return response.json() if response.status_code == 200 else []
         except:
             return []
@@ -59,9 +156,10 @@ class HospitalClient:
         except:
             return None
     
-    def get_medical_records(self):
+    def get_medical_records(self, include_archive=False):
         try:
-            response = requests.get(f'{self.base_url}/medical_records', timeout=5)
+            response = requests.get(f'{self.base_url}/medical_records', 
+                                  params={'archive': 1} if include_archive else {}, timeout=5)
             return response.json() if response.status_code == 200 else []
         except:
             return []
@@ -74,6 +172,36 @@ class HospitalClient:
         except:
             return None
     
+    def update_patient(self, patient_id, data):
+        """Change some columns of a patient. Like add_*() and delete_*(),
+        answers with the row as stored ('row') and the rows affected ('count')."""
+        try:
+            response = requests.put(f'{self.base_url}/patients/{patient_id}', json=data, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def update_doctor(self, doctor_id, data):
+        try:
+            response = requests.put(f'{self.base_url}/doctors/{doctor_id}', json=data, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def update_appointment(self, appointment_id, data):
+        try:
+            response = requests.put(f'{self.base_url}/appointments/{appointment_id}', json=data, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def update_medical_record(self, record_id, data):
+        try:
+            response = requests.put(f'{self.base_url}/medical_records/{record_id}', json=data, timeout=5)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
     def delete_patient(self, patient_id):
         try:
             response = requests.delete(f'{self.base_url}/patients/{patient_id}', timeout=5)
@@ -101,3 +229,113 @@ class HospitalClient:
             return response.json() if response.status_code == 200 else None
         except:
             return None
+    
+    def delete_many(self, table, ids):
+        """Delete the rows of a table with the given IDs in one go; answers
+        with the deleted 'rows', their 'count' and the appointments and
+        medical records deleted with them ('cascaded')"""
+        try:
+            response = requests.delete(f'{self.base_url}/{table}', json={'ids': list(ids)}, timeout=30)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+
+class FederationClient:
+    """Thin client for a headless federation service (federation.py).
+
+    Offers the same hospitals()/add_hospital()/hospital_status()/query()/
+    stats()/free_slots()/timeline() calls as an in-process FederationService, so the master GUI can use
+    either one.
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+    
+    def hospitals(self):
+        try:
+            response = requests.get(f'{self.base_url}/federated/hospitals', timeout=5)
+            return response.json() if response.status_code == 200 else []
+        except:
+            return []
+    
+    def hospital_status(self):
+        try:
+            response = requests.get(f'{self.base_url}/federated/hospitals', 
+                                  params={'check': 1}, timeout=10)
+            return response.json() if response.status_code == 200 else []
+        except:
+            return []
+    
+    def add_hospital(self, url):
+        try:
+            response = requests.post(f'{self.base_url}/federated/hospitals', 
+                                   json={'url': url}, timeout=10)
+            return response.json()['hospital'] if response.status_code == 200 else None
+        except:
+            return None
+    
+    def replication_position(self, hospital_id):
+        """Last change sequence the master applied for a hospital"""
+        try:
+            response = requests.get(f'{self.base_url}/replication/{hospital_id}', timeout=5)
+            return response.json()['seq'] if response.status_code == 200 else None
+        except:
+            return None
+    
+    def push_changes(self, hospital_id, batch):
+        """Ship a batch of changes; returns the master's position afterwards"""
+        try:
+            response = requests.post(f'{self.base_url}/replication/{hospital_id}', 
+                                   json=batch, timeout=30)
+            return response.json()['seq'] if response.status_code in (200, 409) else None
+        except:
+            return None
+    
+    def stats(self, since=None, top=10):
+        """Dashboard summary merged across all hospitals"""
+        params = {'top': top}
+        if since:
+            params['since'] = since
+        try:
+            response = requests.get(f'{self.base_url}/federated/stats', params=params, timeout=15)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def free_slots(self, specialization, count=5, after=None):
+        """Next free slots for a specialization across all hospitals"""
+        params = {'specialization': specialization, 'count': count}
+        if after:
+            params['after'] = after
+        try:
+            response = requests.get(f'{self.base_url}/federated/availability', params=params, timeout=15)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def timeline(self, patient_gid, include_archive=False):
+        """A patient's timeline across all hospitals, by global ID"""
+        try:
+            response = requests.get(f'{self.base_url}/federated/patients/{patient_gid}/timeline',
+                                  params={'archive': 1} if include_archive else {}, timeout=15)
+            return response.json() if response.status_code == 200 else None
+        except:
+            return None
+    
+    def query(self, table, search_term='', url=None, refresh=False):
+        """Remote hospitals' rows as (hospital_name, rows) pairs"""
+        params = {'search': search_term, 'remote_only': 1}
+        if url:
+            params['hospital'] = url
+        if refresh:
+            params['refresh'] = 1
+        try:
+            response = requests.get(f'{self.base_url}/federated/{table}', 
+                                  params=params, timeout=15)
+            rows = response.json() if response.status_code == 200 else []
+        except:
+            rows = []
+        
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row.pop('hospital'), []).append(row)
+        return list(grouped.items())
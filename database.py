@@ -1,16 +1,180 @@
 import sqlite3
 import json
-from datetime import datetime
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+# Primary key column of each table
+ID_COLUMNS = {
+    'patients': 'patient_id',
+    'doctors': 'doctor_id',
+    'appointments': 'appointment_id',
+    'medical_records': 'record_id',
+}
+
+# Columns referring to rows of other tables, which get a global ID too
+GID_REFERENCES = {
+    'appointments': ('patient_id', 'doctor_id'),
+    'medical_records': ('patient_id', 'doctor_id'),
+}
+
+# Rows deleted together with each table's rows: (table, column referring
+# to it), so deleting a patient or doctor leaves no orphans behind
+DEPENDENTS = {
+    'patients': (('appointments', 'patient_id'), ('medical_records', 'patient_id')),
+    'doctors': (('appointments', 'doctor_id'), ('medical_records', 'doctor_id')),
+}
+
+# Tables whose old rows can be moved to the archive database, with the
+# date column that decides a row's age
+ARCHIVE_DATES = {
+    'appointments': 'appointment_date',
+    'medical_records': 'record_date',
+}
+
+# Columns of the rows listed in a patient's timeline, besides the doctor's
+TIMELINE_COLUMNS = {
+    'appointments': ('appointment_id', 'appointment_date', 'appointment_time', 'status'),
+    'medical_records': ('record_id', 'record_date', 'diagnosis', 'prescription', 'notes'),
+}
+
+# Tables with joined list views (see list_view), and the columns these can
+# be filtered on
+VIEW_FILTERS = {
+    'appointments': ('appointment_id', 'patient_id', 'doctor_id', 'status'),
+    'medical_records': ('record_id', 'patient_id', 'doctor_id', 'diagnosis'),
+}
+
+# Summary tables kept current by triggers, per source table: (summary table,
+# key columns, key expressions over the row, condition for the row to count)
+STATS_TABLES = {
+    'appointments': [
+        ('stats_appointments', ('day', 'status'),
+         ("COALESCE({row}.appointment_date, '')", "COALESCE({row}.status, '')"), '1'),
+        ('stats_doctor_patients', ('doctor_id', 'patient_id'), ('{row}.doctor_id', '{row}.patient_id'),
+         '{row}.doctor_id IS NOT NULL AND {row}.patient_id IS NOT NULL'),
+    ],
+    'medical_records': [
+        ('stats_doctor_patients', ('doctor_id', 'patient_id'), ('{row}.doctor_id', '{row}.patient_id'),
+         '{row}.doctor_id IS NOT NULL AND {row}.patient_id IS NOT NULL'),
+        ('stats_diagnoses', ('diagnosis',), ('LOWER(TRIM({row}.diagnosis))',),
+         "TRIM(COALESCE({row}.diagnosis, '')) != ''"),
+    ],
+}
+
+# Global row IDs are 64-bit integers: the hospital's cluster-wide ID in the
+# high bits and the local row ID in the low LOCAL_ID_BITS
+HOSPITAL_ID_BITS = 20
+LOCAL_ID_BITS = 40
+
+def make_gid(hospital_id, local_id):
+    return (hospital_id << LOCAL_ID_BITS) | int(local_id)
+
+def split_gid(gid):
+    """(hospital_id, local_id) of a global row ID"""
+    return gid >> LOCAL_ID_BITS, gid & ((1 << LOCAL_ID_BITS) - 1)
+
+def returned_rows(cursor):
+    """All rows of a statement with a RETURNING clause, as dicts. They must
+    be read before the statement's savepoint or transaction ends."""
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def delete_rows(conn, table, id_column, ids):
+    """Delete the rows of table whose id_column is in ids, and the rows of
+    DEPENDENTS referring to them, in conn's current transaction. Returns the
+    deleted rows and the number of referring rows deleted per table."""
+    # The IDs are passed as one JSON array, so any number of them fits in
+    # a single statement
+    rows = returned_rows(conn.execute(f'DELETE FROM {table} WHERE {id_column} IN (SELECT value FROM json_each(?)) '
+                                      f'RETURNING *', (json.dumps(list(ids)),)))
+    return rows, delete_dependents(conn, table, [row[ID_COLUMNS[table]] for row in rows])
+
+def delete_dependents(conn, table, ids):
+    """Delete the rows of DEPENDENTS referring to the rows of table with
+    the given IDs, archived ones included if conn has the archive attached
+    (see HospitalDatabase.attach_archive_for_writes); returns the number
+    deleted per table"""
+    ids = json.dumps(list(ids))
+    archived = conn.execute("SELECT 1 FROM pragma_database_list WHERE name = 'archive'").fetchone() is not None
+    counts = {}
+    for dependent, column in DEPENDENTS.get(table, ()):
+        # The archive goes first, so a row found in both tiers is logged by
+        # the hot tier's triggers
+        tiers = [f'archive.{dependent}'] if archived and dependent in ARCHIVE_DATES else []
+        counts[dependent] = sum(conn.execute(f'DELETE FROM {tier} WHERE {column} IN (SELECT value FROM json_each(?))',
+                                             (ids,)).rowcount
+                                for tier in tiers + [f'main.{dependent}'])
+    return counts
+
+def stats_removal(table):
+    """Statements of table's statistics triggers taking the OLD row out of
+    its summaries"""
+    statements = []
+    for summary, keys, expressions, condition in STATS_TABLES[table]:
+        old = [expression.format(row='OLD') for expression in expressions]
+        match = ' AND '.join(f'{key} = {expression}' for key, expression in zip(keys, old))
+        statements.append(f'''
+            UPDATE {summary} SET count = count - 1 WHERE {match} AND {condition.format(row='OLD')};
+            DELETE FROM {summary} WHERE {match} AND count <= 0;''')
+    return statements
+
+def minutes(time_text):
+    """Minutes after midnight of an 'HH:MM' time, or None"""
+    try:
+        hours, mins = str(time_text).split(':')[:2]
+        return int(hours) * 60 + int(mins)
+    except ValueError:
+        return None
 
 class HospitalDatabase:
-    def __init__(self, db_name, hospital_name):
+    # Pages copied per step of an online backup
+    BACKUP_PAGES = 256
+    # Free pages released per incremental vacuum call
+    VACUUM_PAGES = 1000
+    # Writes are committed in groups by one writer thread. A group holds the
+    # writes that queued up while the previous one was committing, plus any
+    # arriving within GROUP_COMMIT_WINDOW seconds (the extra latency allowed
+    # per write), at most GROUP_COMMIT_MAX of them
+    GROUP_COMMIT_WINDOW = 0
+    GROUP_COMMIT_MAX = 256
+    # Appointment slots start every SLOT_MINUTES between OPENING_TIME and
+    # CLOSING_TIME, and an appointment keeps its doctor busy for SLOT_MINUTES
+    SLOT_MINUTES = 60
+    OPENING_TIME = '08:00'
+    CLOSING_TIME = '18:00'
+    # How far ahead free_slots looks
+    AVAILABILITY_DAYS = 60
+    # Rows checked per read when looking for orphaned appointments and
+    # medical records; the orphans among them are purged in one write
+    ORPHAN_SCAN = 5000
+    
+    def __init__(self, db_name, hospital_name, archive_name=None):
         self.db_name = db_name
         self.hospital_name = hospital_name
+        # Cold tier for old appointments and medical records (see archive)
+        self.archive_name = archive_name or os.path.splitext(db_name)[0] + '_archive.db'
+        self.writes = queue.Queue()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        # Idle connections for read()
+        self.readers = queue.LifoQueue()
         self.init_database()
+        self.register_hospital_id()
     
     def init_database(self):
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
+        # Let maintenance hand free pages back in small steps; this only
+        # takes effect for a new database (see enable_incremental_vacuum)
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Write-ahead log, so long reads (snapshots, replication) don't hold
+        # up writers
+        cursor.execute('PRAGMA journal_mode=WAL')
         
         # Patient table
         cursor.execute('''
@@ -51,6 +215,12 @@ class HospitalDatabase:
                 FOREIGN KEY (doctor_id) REFERENCES doctors(doctor_id)
             )
         ''')
+        # Per-doctor day index for availability checks; it holds every
+        # column they read, so they never touch the table itself
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS appointments_doctor_day
+            ON appointments (doctor_id, appointment_date, appointment_time, status)
+        ''')
         
         # Medical records table
         cursor.execute('''
@@ -67,12 +237,187 @@ class HospitalDatabase:
                 FOREIGN KEY (doctor_id) REFERENCES doctors(doctor_id)
             )
         ''')
+        # A patient's appointments and records, for timelines and cascading
+        # deletes; a doctor's appointments use appointments_doctor_day
+        for table in TIMELINE_COLUMNS:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_patient ON {table} (patient_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS medical_records_doctor ON medical_records (doctor_id)')
+        
+        # Per-database settings, such as the hospital's cluster-wide ID
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hospital_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        
+        # Change log filled by triggers, so writes from any process (GUI or
+        # server) can be picked up incrementally by consumers such as the
+        # search sketches
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for table, id_column in ID_COLUMNS.items():
+            for op, row in (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')):
+                # Rows moved to another file (the archive, shards) aren't
+                # deleted as far as consumers are concerned; whoever moves
+                # them sets the flag for the length of its transaction
+                condition = ''
+                if op == 'delete':
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {table}_log_delete')
+                    condition = "WHEN NOT EXISTS (SELECT 1 FROM hospital_meta WHERE key = 'moving_rows')"
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_log_{op} AFTER {op.upper()} ON {table} {condition}
+                    BEGIN
+                        INSERT INTO change_log (table_name, row_id, op)
+                        VALUES ('{table}', {row}.{id_column}, '{op}');
+                    END
+                ''')
+            # Moves to the archive are logged as such, so consumers know the
+            # row still exists (see change_feed)
+            if table in ARCHIVE_DATES:
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_log_archive AFTER DELETE ON {table}
+                    WHEN EXISTS (SELECT 1 FROM hospital_meta WHERE key = 'moving_rows' AND value = 'archive')
+                    BEGIN
+                        INSERT INTO change_log (table_name, row_id, op)
+                        VALUES ('{table}', OLD.{id_column}, 'archive');
+                    END
+                ''')
+        # Statistics: appointments per day and status, appointments and
+        # records per doctor and patient, records per diagnosis. They count
+        # archived rows too, so rows moved away are not subtracted.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_appointments (
+                day TEXT, status TEXT, count INTEGER NOT NULL,
+                PRIMARY KEY (day, status)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_doctor_patients (
+                doctor_id INTEGER, patient_id INTEGER, count INTEGER NOT NULL,
+                PRIMARY KEY (doctor_id, patient_id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_diagnoses (
+                diagnosis TEXT PRIMARY KEY, count INTEGER NOT NULL
+            )
+        ''')
+        for table, summaries in STATS_TABLES.items():
+            add, remove = [], stats_removal(table)
+            for summary, keys, expressions, condition in summaries:
+                new = [expression.format(row='NEW') for expression in expressions]
+                add.append(f'''
+                    INSERT INTO {summary} ({", ".join(keys)}, count)
+                    SELECT {", ".join(new)}, 1 WHERE {condition.format(row='NEW')}
+                    ON CONFLICT ({", ".join(keys)}) DO UPDATE SET count = count + 1;''')
+            # Rows moved to the archive or into the shards stay counted; a
+            # row moving to another shard is counted by that shard instead
+            cursor.execute(f'DROP TRIGGER IF EXISTS {table}_stats_delete')
+            for op, body, condition in (
+                    ('insert', add, ''),
+                    ('update', remove + add, ''),
+                    ('delete', remove, "WHEN NOT EXISTS (SELECT 1 FROM hospital_meta "
+                                       "WHERE key = 'moving_rows' AND value != 'shard')")):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_stats_{op} AFTER {op.upper()} ON {table} {condition}
+                    BEGIN {"".join(body)}
+                    END
+                ''')
+        stats_built = cursor.execute("SELECT 1 FROM hospital_meta WHERE key = 'stats_built'").fetchone()
+        
+        # Rows written before the change log existed are logged once as
+        # inserts, so a consumer reading the log from the start sees them all
+        if cursor.execute('SELECT 1 FROM change_log LIMIT 1').fetchone() is None:
+            for table, id_column in ID_COLUMNS.items():
+                cursor.execute(f'''
+                    INSERT INTO change_log (table_name, row_id, op)
+                    SELECT '{table}', {id_column}, 'insert' FROM {table} ORDER BY {id_column}
+                ''')
         
         conn.commit()
         conn.close()
+        # Statistics start from the rows already there
+        if not stats_built:
+            self.rebuild_stats()
+    
+    def register_hospital_id(self, hospital_id=None):
+        """Set and persist this hospital's cluster-wide ID: hospital_id if
+        given, otherwise the stored one, or a new random one"""
+        if hospital_id is None:
+            rows = self.execute_query("SELECT value FROM hospital_meta WHERE key = 'hospital_id'")
+            hospital_id = int(rows[0]['value']) if rows else random.randrange(1, 1 << HOSPITAL_ID_BITS)
+        if not 0 < hospital_id < 1 << HOSPITAL_ID_BITS:
+            raise ValueError(f"Hospital ID must be between 1 and {(1 << HOSPITAL_ID_BITS) - 1}")
+        self.execute_query("INSERT OR REPLACE INTO hospital_meta (key, value) VALUES ('hospital_id', ?)",
+                           (str(hospital_id),))
+        self.hospital_id = hospital_id
+        return hospital_id
+    
+    def select_columns(self, table, alias=''):
+        """Columns to select from table (known as alias in the query): all
+        of them plus the global IDs of the row (gid) and of the rows it
+        refers to (patient_gid, doctor_gid)"""
+        prefix = f'{alias}.' if alias else ''
+        if table not in ID_COLUMNS:
+            return f'{prefix}*'
+        high = self.hospital_id << LOCAL_ID_BITS
+        columns = [f'{prefix}*', f'{high} | {prefix}{ID_COLUMNS[table]} AS gid']
+        columns.extend(f'{high} | {prefix}{column} AS {column[:-3]}_gid'
+                       for column in GID_REFERENCES.get(table, ()))
+        return ', '.join(columns)
+    
+    def attach_archive(self, conn):
+        """Attach the archive database to conn as 'archive', creating its
+        tables if needed, and add temporary views <table>_all spanning both
+        tiers. A row found in both (an interrupted archive run) counts once."""
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_name,))
+        for table in ARCHIVE_DATES:
+            schema = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                                  (table,)).fetchone()[0]
+            conn.execute(schema.replace(f'CREATE TABLE {table}', f'CREATE TABLE IF NOT EXISTS archive.{table}', 1))
+            conn.execute(f'CREATE INDEX IF NOT EXISTS archive.{table}_patient ON {table} (patient_id)')
+            id_column = ID_COLUMNS[table]
+            conn.execute(f'''
+                CREATE TEMP VIEW IF NOT EXISTS {table}_all AS
+                SELECT * FROM main.{table}
+                UNION ALL
+                SELECT * FROM archive.{table} WHERE {id_column} NOT IN (SELECT {id_column} FROM main.{table})
+            ''')
+    
+    def attach_archive_for_writes(self, conn):
+        """Attach the archive to the writer's connection conn (see
+        attach_archive), with temporary triggers that log deletes from its
+        tables and take the rows out of the statistics, as the hot tier's
+        triggers do. Rows still in the hot tier (an interrupted archive run)
+        are left to the hot tier's triggers."""
+        self.attach_archive(conn)
+        for table in ARCHIVE_DATES:
+            id_column = ID_COLUMNS[table]
+            conn.execute(f'''
+                CREATE TEMP TRIGGER IF NOT EXISTS archive_{table}_delete AFTER DELETE ON archive.{table}
+                WHEN NOT EXISTS (SELECT 1 FROM main.{table} WHERE {id_column} = OLD.{id_column})
+                BEGIN
+                    INSERT INTO change_log (table_name, row_id, op)
+                    VALUES ('{table}', OLD.{id_column}, 'delete');{"".join(stats_removal(table))}
+                END
+            ''')
+    
+    def tier(self, table, include_archive=False):
+        """Table or view to read: the hot tier only, unless include_archive"""
+        return f'{table}_all' if include_archive and table in ARCHIVE_DATES else table
     
-    def execute_query(self, query, params=()):
+    def execute_query(self, query, params=(), include_archive=False):
         conn = sqlite3.connect(self.db_name)
+        if include_archive:
+            self.attach_archive(conn)
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         cursor.execute(query, params)
@@ -81,29 +426,141 @@ class HospitalDatabase:
         conn.close()
         return [dict(row) for row in result]
     
-    def insert(self, table, data):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+    def read(self, query, params=()):
+        """Like execute_query, on a pooled connection: for small, frequent
+        reads that would otherwise spend most of their time opening the
+        database"""
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.db_name, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in conn.execute(query, params)]
+        finally:
+            self.readers.put(conn)
+    
+    def submit(self, write):
+        """Queue write(conn) for the writer thread. Returns a Future for its
+        result, set once the group it was committed with is on disk, or for
+        its exception (a failing write doesn't affect the rest of the group)."""
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True,
+                                               name=f'writer-{os.path.basename(self.db_name)}')
+                self.writer.start()
+        future = Future()
+        self.writes.put((write, future))
+        return future
+    
+    def write_loop(self):
+        conn = sqlite3.connect(self.db_name, timeout=30, isolation_level=None)
+        archive_attached = False
+        while True:
+            group = [self.writes.get()]
+            deadline = time.monotonic() + self.GROUP_COMMIT_WINDOW
+            while len(group) < self.GROUP_COMMIT_MAX:
+                remaining = deadline - time.monotonic()
+                try:
+                    group.append(self.writes.get(timeout=remaining) if remaining > 0 else self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                # Once there is an archive, deletes reach into it (see
+                # delete_dependents)
+                if not archive_attached and os.path.exists(self.archive_name):
+                    self.attach_archive_for_writes(conn)
+                    archive_attached = True
+                self.commit_group(conn, group)
+            except Exception as e:
+                # The connection itself is broken (its ROLLBACK failed):
+                # give up on the group and carry on with a new one
+                for write, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+                conn.close()
+                conn = sqlite3.connect(self.db_name, timeout=30, isolation_level=None)
+                archive_attached = False
+    
+    def commit_group(self, conn, group):
+        """Run a group of writes in one transaction, each in its own
+        savepoint. If anything but a write fails (BEGIN, a savepoint
+        statement, COMMIT), the whole group is rolled back and every write
+        in it fails with that error."""
+        group = [(write, future) for write, future in group if future.set_running_or_notify_cancel()]
+        done = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for write, future in group:
+                conn.execute('SAVEPOINT write')
+                try:
+                    result = write(conn)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    future.set_exception(e)
+                    continue
+                conn.execute('RELEASE write')
+                done.append((future, result))
+            conn.execute('COMMIT')
+        except Exception as e:
+            for write, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            return
+        for future, result in done:
+            future.set_result(result)
+    
+    def write_result(self, table, rows):
+        """Result of a write of single rows: {'row': the row as stored (or
+        as it was before a delete), with the global IDs select_columns adds,
+        or None if no row was affected; 'count': the rows affected}"""
+        if not rows:
+            return {'row': None, 'count': 0}
+        return {'row': self.with_gids(table, rows[0]), 'count': len(rows)}
+    
+    def with_gids(self, table, row):
+        """Copy of a row of table with the global IDs select_columns adds"""
+        row = dict(row)
+        if table in ID_COLUMNS:
+            row['gid'] = make_gid(self.hospital_id, row[ID_COLUMNS[table]])
+            for column in GID_REFERENCES.get(table, ()):
+                row[f'{column[:-3]}_gid'] = (make_gid(self.hospital_id, row[column])
+                                             if isinstance(row[column], int) else None)
+        return row
+    
+    def insert_async(self, table, data):
+        """Queue an insert; the Future's result is a write_result with the
+        new row, defaults and ID included"""
         columns = ', '.join(data.keys())
         placeholders = ', '.join(['?' for _ in data])
-        query = f'INSERT INTO {table} ({columns}) VALUES ({placeholders})'
-        cursor.execute(query, list(data.values()))
-        conn.commit()
-        last_id = cursor.lastrowid
-        conn.close()
-        return last_id
+        query = f'INSERT INTO {table} ({columns}) VALUES ({placeholders}) RETURNING *'
+        values = list(data.values())
+        return self.submit(lambda conn: self.write_result(table, returned_rows(conn.execute(query, values))))
+    
+    def insert(self, table, data):
+        return self.insert_async(table, data).result()
     
-    def search(self, table, search_term=''):
-        """Search across all fields in the table"""
+    def search(self, table, search_term='', limit=None, columns=None, include_archive=False):
+        """Search across all fields in the table (or only the given columns),
+        returning at most limit rows when a limit is set. Archived rows are
+        only included with include_archive."""
+        limit_clause = ' LIMIT ?' if limit else ''
+        limit_params = (limit,) if limit else ()
+        source = self.tier(table, include_archive)
         if not search_term:
-            return self.execute_query(f'SELECT * FROM {table}')
+            return self.execute_query(f'SELECT {self.select_columns(table)} FROM {source}{limit_clause}',
+                                      limit_params, include_archive)
         
         # Get column names for the table
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute(f'PRAGMA table_info({table})')
-        columns = [col[1] for col in cursor.fetchall()]
-        conn.close()
+        if columns is None:
+            conn = sqlite3.connect(self.db_name)
+            cursor = conn.cursor()
+            cursor.execute(f'PRAGMA table_info({table})')
+            columns = [col[1] for col in cursor.fetchall()]
+            conn.close()
         
         # Build WHERE clause to search all columns
         where_clauses = []
@@ -112,24 +569,497 @@ class HospitalDatabase:
             where_clauses.append(f'{column} LIKE ?')
             params.append(f'%{search_term}%')
         
-        query = f'SELECT * FROM {table} WHERE {" OR ".join(where_clauses)}'
+        query = (f'SELECT {self.select_columns(table)} FROM {source} '
+                 f'WHERE {" OR ".join(where_clauses)}{limit_clause}')
+        return self.execute_query(query, tuple(params) + limit_params, include_archive)
+    
+    def get_all(self, table, include_archive=False):
+        return self.execute_query(f'SELECT {self.select_columns(table)} FROM {self.tier(table, include_archive)}',
+                                  include_archive=include_archive)
+    
+    def get(self, table, id_column, id_value, include_archive=False):
+        """Fetch a single row by its ID, or None"""
+        rows = self.execute_query(f'SELECT {self.select_columns(table)} FROM {self.tier(table, include_archive)} '
+                                  f'WHERE {id_column} = ?', (id_value,), include_archive)
+        return rows[0] if rows else None
+    
+    def count(self, table, include_archive=False):
+        return self.execute_query(f'SELECT COUNT(*) AS count FROM {self.tier(table, include_archive)}',
+                                  include_archive=include_archive)[0]['count']
+    
+    def rebuild_stats(self):
+        """Recount the statistics tables from every row, archived ones included"""
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            if os.path.exists(self.archive_name):
+                self.attach_archive(conn)
+            source = {table: self.tier(table, os.path.exists(self.archive_name)) for table in STATS_TABLES}
+            conn.execute('BEGIN IMMEDIATE')
+            for summary in ('stats_appointments', 'stats_doctor_patients', 'stats_diagnoses'):
+                conn.execute(f'DELETE FROM {summary}')
+            conn.execute(f'''
+                INSERT INTO stats_appointments (day, status, count)
+                SELECT COALESCE(appointment_date, ''), COALESCE(status, ''), COUNT(*)
+                FROM {source['appointments']} GROUP BY 1, 2
+            ''')
+            conn.execute(f'''
+                INSERT INTO stats_doctor_patients (doctor_id, patient_id, count)
+                SELECT doctor_id, patient_id, COUNT(*) FROM (
+                    SELECT doctor_id, patient_id FROM {source['appointments']}
+                    UNION ALL
+                    SELECT doctor_id, patient_id FROM {source['medical_records']}
+                ) WHERE doctor_id IS NOT NULL AND patient_id IS NOT NULL GROUP BY 1, 2
+            ''')
+            conn.execute(f'''
+                INSERT INTO stats_diagnoses (diagnosis, count)
+                SELECT LOWER(TRIM(diagnosis)), COUNT(*) FROM {source['medical_records']}
+                WHERE TRIM(COALESCE(diagnosis, '')) != '' GROUP BY 1
+            ''')
+            conn.execute("INSERT OR REPLACE INTO hospital_meta (key, value) VALUES ('stats_built', '1')")
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def stats_rows(self, since=None):
+        """Raw statistics: appointments per day and status (from since on,
+        'YYYY-MM-DD'), appointments per status, patients per doctor ID and
+        records per diagnosis"""
+        return {
+            'by_day': self.execute_query('SELECT day, status, count FROM stats_appointments WHERE day >= ?',
+                                         (since or '',)),
+            'by_status': self.execute_query('SELECT status, SUM(count) AS count FROM stats_appointments '
+                                            'GROUP BY status'),
+            'doctor_patients': self.execute_query('SELECT doctor_id, COUNT(*) AS patients '
+                                                  'FROM stats_doctor_patients GROUP BY doctor_id'),
+            'diagnoses': self.execute_query('SELECT diagnosis, count FROM stats_diagnoses'),
+        }
+    
+    def stats(self, since=None, top=10):
+        """Dashboard summary read from the statistics tables, without
+        touching the rows themselves"""
+        rows = self.stats_rows(since)
+        doctors = {doctor['doctor_id']: doctor for doctor in self.get_all('doctors')}
+        per_doctor = []
+        for row in rows['doctor_patients']:
+            doctor = doctors.get(row['doctor_id'], {})
+            per_doctor.append({'doctor_id': row['doctor_id'],
+                               'doctor_gid': make_gid(self.hospital_id, row['doctor_id']),
+                               'name': doctor.get('name', 'Unknown'),
+                               'specialization': doctor.get('specialization', ''),
+                               'patients': row['patients']})
+        per_doctor.sort(key=lambda row: -row['patients'])
+        diagnoses = sorted(rows['diagnoses'], key=lambda row: -row['count'])
+        return {
+            'hospital': self.hospital_name,
+            'appointments_by_status': {row['status']: row['count'] for row in rows['by_status']},
+            'appointments_by_day': sorted(rows['by_day'], key=lambda row: (row['day'], row['status'])),
+            'patients_per_doctor': per_doctor,
+            'top_diagnoses': diagnoses[:top],
+        }
+    
+    def list_view(self, table, search_term='', filters=None, since=None, until=None, limit=None, offset=0,
+                  include_archive=False):
+        """A page of appointments or medical records in ID order, each with
+        the patient's name and the doctor's name and specialization, plus
+        the number of matching rows in all ({'rows', 'total'}). filters maps
+        VIEW_FILTERS columns to values, since and until (inclusive) bound the
+        row's date, and search_term is matched like search() against the
+        row and the names."""
+        conditions, params = [], []
+        for column, value in (filters or {}).items():
+            if column not in VIEW_FILTERS[table]:
+                raise ValueError(f'Cannot filter {table} by {column}')
+            conditions.append(f'e.{column} = ?')
+            params.append(value)
+        for bound, operator in ((since, '>='), (until, '<=')):
+            if bound:
+                conditions.append(f'e.{ARCHIVE_DATES[table]} {operator} ?')
+                params.append(bound)
+        if search_term:
+            term = f'%{search_term}%'
+            matches = [f'e.{row["name"]} LIKE ?' for row in self.read(f'PRAGMA table_info({table})')]
+            matches.append('p.name LIKE ?')
+            params.extend([term] * len(matches))
+            # Doctors are matched up front, as sharded rows live in another
+            # database than the doctors
+            doctor_ids = [row['doctor_id'] for row in self.read(
+                'SELECT doctor_id FROM doctors WHERE name LIKE ? OR specialization LIKE ?', (term, term))]
+            if doctor_ids:
+                matches.append(f'e.doctor_id IN ({", ".join("?" for _ in doctor_ids)})')
+                params.extend(doctor_ids)
+            conditions.append(f'({" OR ".join(matches)})')
+        return self.view_rows(table, ' AND '.join(conditions) or '1', params, limit, offset, include_archive)
+    
+    def view_rows(self, table, where, params, limit=None, offset=0, include_archive=False):
+        """Rows for list_view matching where, a condition over the rows (e)
+        and their patients (p), and their number"""
+        source = f'{self.tier(table, include_archive)} e LEFT JOIN patients p ON p.patient_id = e.patient_id'
+        query = (f'SELECT {self.select_columns(table, "e")}, p.name AS patient_name, '
+                 f'd.name AS doctor_name, d.specialization AS doctor_specialization '
+                 f'FROM {source} LEFT JOIN doctors d ON d.doctor_id = e.doctor_id '
+                 f'WHERE {where} ORDER BY e.{ID_COLUMNS[table]} LIMIT ? OFFSET ?')
+        if include_archive:
+            run = lambda query, params: self.execute_query(query, params, True)
+        else:
+            run = self.read
+        rows = run(query, (*params, -1 if limit is None else limit, offset))
+        total = run(f'SELECT COUNT(*) AS count FROM {source} WHERE {where}', params)[0]['count']
+        return {'rows': rows, 'total': total}
+    
+    def timeline(self, patient_id, include_archive=False):
+        """A patient with their appointments and medical records, oldest
+        first, each with the doctor's name and specialization; None if there
+        is no such patient. The rows come from one query, joining the
+        patient_id indexes to the doctors."""
+        patients = self.read(f'SELECT {self.select_columns("patients")} FROM patients WHERE patient_id = ?',
+                             (patient_id,))
+        if not patients:
+            return None
+        columns = [column for table_columns in TIMELINE_COLUMNS.values() for column in table_columns]
+        high = self.hospital_id << LOCAL_ID_BITS
+        query = ' UNION ALL '.join(f'''
+            SELECT '{table}' AS kind, {", ".join(f"e.{column}" if column in table_columns else f"NULL AS {column}"
+                                                for column in columns)},
+                   e.{ARCHIVE_DATES[table]} AS day, e.doctor_id, {high} | e.doctor_id AS doctor_gid,
+                   d.name AS doctor_name, d.specialization AS doctor_specialization
+            FROM {self.tier(table, include_archive)} e LEFT JOIN doctors d ON d.doctor_id = e.doctor_id
+            WHERE e.patient_id = ?
+        ''' for table, table_columns in TIMELINE_COLUMNS.items()) + ' ORDER BY day, appointment_time'
+        params = (patient_id,) * len(TIMELINE_COLUMNS)
+        rows = self.execute_query(query, params, True) if include_archive else self.read(query, params)
+        result = {'hospital': self.hospital_name, 'patient': patients[0]}
+        for table, table_columns in TIMELINE_COLUMNS.items():
+            result[table] = [{**{column: row[column] for column in table_columns},
+                              **{column: row[column] for column in
+                                 ('doctor_id', 'doctor_gid', 'doctor_name', 'doctor_specialization')}}
+                             for row in rows if row['kind'] == table]
+        return result
+    
+    def bookings(self, doctor_ids, first_day, last_day):
+        """Appointments (other than cancelled ones) of some doctors between
+        two dates, 'YYYY-MM-DD', read from the doctor/day index only"""
+        if not doctor_ids:
+            return []
+        return self.read(
+            f'SELECT appointment_id, doctor_id, appointment_date, appointment_time, status FROM appointments '
+            f'WHERE doctor_id IN ({", ".join("?" for _ in doctor_ids)}) AND appointment_date BETWEEN ? AND ? '
+            f"AND status IS NOT 'Cancelled'", (*doctor_ids, first_day, last_day))
+    
+    def conflicts(self, doctor_id, date, time_text, exclude_id=None):
+        """The doctor's appointments less than SLOT_MINUTES away from date
+        ('YYYY-MM-DD') and time ('HH:MM'), the day before or after included
+        near midnight, except appointment exclude_id (when moving it).
+        Raises ValueError for a bad date or time."""
+        start = minutes(time_text)
+        if start is None:
+            raise ValueError(f"Time must be HH:MM, not {time_text!r}")
+        day = datetime.strptime(date, '%Y-%m-%d').date()
+        first_day = day - timedelta(days=1) if start < self.SLOT_MINUTES else day
+        last_day = day + timedelta(days=1) if start > 24 * 60 - self.SLOT_MINUTES else day
+        conflicts = []
+        for row in self.bookings([int(doctor_id)], str(first_day), str(last_day)):
+            taken = minutes(row['appointment_time'])
+            if row['appointment_id'] == exclude_id or taken is None:
+                continue
+            try:
+                taken += (datetime.strptime(row['appointment_date'], '%Y-%m-%d').date() - day).days * 24 * 60
+            except ValueError:
+                continue
+            if abs(taken - start) < self.SLOT_MINUTES:
+                conflicts.append(row)
+        return conflicts
+    
+    def is_available(self, doctor_id, date, time_text):
+        return not self.conflicts(doctor_id, date, time_text)
+    
+    def free_slots(self, specialization=None, count=5, after=None, doctor_id=None):
+        """The earliest count free slots, from after ('YYYY-MM-DD HH:MM',
+        default now) up to AVAILABILITY_DAYS ahead, of the doctors of a
+        specialization (any case) or of one doctor. Bookings are read a day
+        at a time, so the usual answer costs one index scan per doctor."""
+        if doctor_id is not None:
+            doctors = self.read('SELECT * FROM doctors WHERE doctor_id = ?', (doctor_id,))
+        else:
+            doctors = self.read('SELECT * FROM doctors WHERE specialization = ? COLLATE NOCASE '
+                                'ORDER BY doctor_id', (specialization,))
+        start = datetime.strptime(after, '%Y-%m-%d %H:%M') if after else datetime.now()
+        earliest = start.hour * 60 + start.minute
+        day_slots = range(minutes(self.OPENING_TIME), minutes(self.CLOSING_TIME) - self.SLOT_MINUTES + 1,
+                          self.SLOT_MINUTES)
+        day, last_day = start.date(), start.date() + timedelta(days=self.AVAILABILITY_DAYS - 1)
+        slots = []
+        while doctors and day <= last_day and len(slots) < count:
+            booked = {}
+            for row in self.bookings([doctor['doctor_id'] for doctor in doctors], str(day), str(day)):
+                booked.setdefault(row['doctor_id'], []).append(minutes(row['appointment_time']))
+            for slot in day_slots:
+                if day == start.date() and slot < earliest:
+                    continue
+                for doctor in doctors:
+                    if all(taken is None or abs(slot - taken) >= self.SLOT_MINUTES
+                           for taken in booked.get(doctor['doctor_id'], ())):
+                        slots.append({'doctor_id': doctor['doctor_id'],
+                                      'doctor_gid': make_gid(self.hospital_id, doctor['doctor_id']),
+                                      'name': doctor['name'], 'specialization': doctor['specialization'],
+                                      'date': str(day), 'time': f'{slot // 60:02d}:{slot % 60:02d}'})
+            day += timedelta(days=1)
+        return slots[:count]
+    
+    def archive(self, cutoff):
+        """Move appointments and medical records dated before cutoff
+        ('YYYY-MM-DD') from this database to the archive database. Returns
+        the rows moved per table and the seconds taken."""
+        started = time.perf_counter()
+        report = {'task': 'archive', 'cutoff': cutoff}
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            self.attach_archive(conn)
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("INSERT OR REPLACE INTO hospital_meta (key, value) VALUES ('moving_rows', 'archive')")
+            for table, date_column in ARCHIVE_DATES.items():
+                conn.execute(f'INSERT OR REPLACE INTO archive.{table} '
+                             f'SELECT * FROM main.{table} WHERE {date_column} < ?', (cutoff,))
+                report[table] = conn.execute(f'DELETE FROM main.{table} WHERE {date_column} < ?',
+                                             (cutoff,)).rowcount
+            conn.execute("DELETE FROM hospital_meta WHERE key = 'moving_rows'")
+            conn.commit()
+        finally:
+            conn.close()
+        report['rows'] = sum(report[table] for table in ARCHIVE_DATES)
+        report['seconds'] = time.perf_counter() - started
+        return report
+    
+    def last_change(self):
+        """Sequence number of the latest logged write (0 if none)"""
+        return self.execute_query('SELECT COALESCE(MAX(seq), 0) AS seq FROM change_log')[0]['seq']
+    
+    def changes_since(self, seq, tables=None, limit=None):
+        """Logged writes after seq, oldest first, optionally for some tables
+        only and at most limit of them"""
+        query = 'SELECT seq, table_name, row_id, op FROM change_log WHERE seq > ?'
+        params = [seq]
+        if tables:
+            query += f' AND table_name IN ({", ".join("?" for _ in tables)})'
+            params.extend(tables)
+        query += ' ORDER BY seq'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
         return self.execute_query(query, tuple(params))
     
-    def get_all(self, table):
-        return self.execute_query(f'SELECT * FROM {table}')
+    def rows_by_id(self, table, ids, include_archive=False):
+        """Current rows of table with the given IDs (missing ones are
+        skipped), also looking in the archive with include_archive"""
+        rows = []
+        source = self.tier(table, include_archive)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows.extend(self.execute_query(f'SELECT {self.select_columns(table)} FROM {source} '
+                                           f'WHERE {ID_COLUMNS[table]} IN ({", ".join("?" for _ in chunk)})',
+                                           tuple(chunk), include_archive))
+        return rows
+    
+    def change_feed(self, since, tables=None, limit=None):
+        """Rows changed after since, one entry per row with its current
+        state (row is None once deleted). Rows moved to the archive (op
+        'archive', or an earlier op for a row archived since) come with
+        their archived state, as they still exist. Returns (seq, entries)
+        where seq is the position to resume from."""
+        changes = self.changes_since(since, tables, limit)
+        if not changes:
+            return since, []
+        latest = {}
+        for change in changes:
+            latest[(change['table_name'], change['row_id'])] = change
+        
+        rows = {}
+        for table in {table for table, _ in latest}:
+            for row in self.rows_by_id(table, [row_id for t, row_id in latest if t == table]):
+                rows[(table, row[ID_COLUMNS[table]])] = row
+            if table in ARCHIVE_DATES:
+                moved = [row_id for t, row_id in latest if t == table and (t, row_id) not in rows
+                         and latest[(t, row_id)]['op'] != 'delete']
+                for row in self.rows_by_id(table, moved, True):
+                    rows[(table, row[ID_COLUMNS[table]])] = row
+        
+        entries = [{'table': table, 'row_id': row_id, 'op': change['op'],
+                    'row': rows.get((table, row_id))}
+                   for (table, row_id), change in latest.items()]
+        return changes[-1]['seq'], entries
+    
+    def backup(self, target):
+        """Hot backup of the database to the file target with SQLite's online
+        backup API.
+        
+        The copy is taken BACKUP_PAGES at a time inside one read
+        transaction, so it is consistent without locking out writers.
+        Returns the change sequence the copy corresponds to, the pages
+        copied, the number of steps and the seconds taken."""
+        started = time.perf_counter()
+        report = {'task': 'backup', 'pages': 0, 'steps': 0}
+        
+        def progress(status, remaining, total):
+            report['pages'] = total - remaining
+            report['steps'] += 1
+        
+        source = sqlite3.connect(self.db_name)
+        dest = sqlite3.connect(target)
+        try:
+            source.execute('BEGIN')
+            report['seq'] = source.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+            source.backup(dest, pages=self.BACKUP_PAGES, progress=progress)
+            source.rollback()
+            # A single self-contained file
+            dest.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dest.close()
+            source.close()
+        report['seconds'] = time.perf_counter() - started
+        return report
+    
+    def snapshot(self, target):
+        """Consistent copy of the database in target (see backup); returns
+        the change sequence it corresponds to"""
+        return self.backup(target)['seq']
+    
+    def maintenance_query(self, task, *statements):
+        """Run maintenance statements on their own connection; returns the
+        last one's rows and a report of the seconds taken"""
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            for statement in statements:
+                rows = conn.execute(statement).fetchall()
+        finally:
+            conn.close()
+        return rows, {'task': task, 'seconds': time.perf_counter() - started}
+    
+    def checkpoint(self, mode='PASSIVE'):
+        """Copy committed WAL frames into the database file. PASSIVE never
+        waits for readers or writers; TRUNCATE also empties the WAL file."""
+        rows, report = self.maintenance_query('checkpoint', f'PRAGMA wal_checkpoint({mode})')
+        busy, wal_pages, checkpointed = rows[0]
+        report.update(pages=max(checkpointed, 0), wal_pages=max(wal_pages, 0), busy=bool(busy))
+        return report
+    
+    def optimize(self):
+        """Refresh query planner statistics where SQLite thinks they are stale"""
+        rows, report = self.maintenance_query('optimize', 'PRAGMA optimize')
+        report['pages'] = 0
+        return report
+    
+    def free_pages(self):
+        return self.execute_query('PRAGMA freelist_count')[0]['freelist_count']
+    
+    def incremental_vacuum(self, pages=None):
+        """Release up to pages (VACUUM_PAGES) free pages back to the file
+        system; does nothing unless incremental auto-vacuum is enabled"""
+        before = self.free_pages()
+        started = time.perf_counter()
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            # executescript steps the pragma to completion, execute() would
+            # stop after the first page
+            conn.executescript(f'PRAGMA incremental_vacuum({int(pages or self.VACUUM_PAGES)})')
+        finally:
+            conn.close()
+        return {'task': 'incremental_vacuum', 'pages': before - self.free_pages(),
+                'seconds': time.perf_counter() - started}
+    
+    def incremental_vacuum_enabled(self):
+        return self.execute_query('PRAGMA auto_vacuum')[0]['auto_vacuum'] == 2
+    
+    def enable_incremental_vacuum(self):
+        """Switch an existing database to incremental auto-vacuum. This
+        rewrites the whole file with VACUUM, so it belongs in a quiet period."""
+        rows, report = self.maintenance_query('enable_incremental_vacuum',
+                                              'PRAGMA auto_vacuum=INCREMENTAL', 'VACUUM', 'PRAGMA page_count')
+        report['pages'] = rows[0][0]
+        return report
+    
+    def delete_async(self, table, id_column, id_value):
+        """Queue a delete; the Future's result is a write_result with the
+        deleted row, plus 'cascaded': the appointments and medical records
+        deleted with a patient or doctor, per table"""
+        def delete(conn):
+            rows, cascaded = delete_rows(conn, table, id_column, [id_value])
+            return {**self.write_result(table, rows), 'cascaded': cascaded}
+        return self.submit(delete)
     
     def delete(self, table, id_column, id_value):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute(f'DELETE FROM {table} WHERE {id_column} = ?', (id_value,))
-        conn.commit()
-        conn.close()
+        return self.delete_async(table, id_column, id_value).result()
     
-    def update(self, table, id_column, id_value, data):
-        """Update a record in the table"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+    def delete_many_async(self, table, id_column, ids):
+        """Queue a delete of every row whose id_column is in ids, with the
+        rows referring to them, as one transaction. The Future's result has
+        the deleted 'rows', their 'count' and 'cascaded' as for delete."""
+        def delete(conn):
+            rows, cascaded = delete_rows(conn, table, id_column, ids)
+            return {'rows': [self.with_gids(table, row) for row in rows], 'count': len(rows),
+                    'cascaded': cascaded}
+        return self.submit(delete)
+    
+    def delete_many(self, table, id_column, ids):
+        return self.delete_many_async(table, id_column, ids).result()
+    
+    def existing_ids(self, table, ids):
+        """The IDs among ids that table has a row for"""
+        id_column = ID_COLUMNS[table]
+        return {row[id_column] for row in self.read(
+            f'SELECT {id_column} FROM {table} WHERE {id_column} IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(ids)),))}
+    
+    def purge_orphans(self):
+        """Delete appointments and medical records whose patient or doctor
+        no longer exists, left behind by deletes from before they cascaded.
+        Returns the rows purged per table and the seconds taken."""
+        return self.purge_orphans_in(self)
+    
+    def purge_orphans_in(self, source):
+        """purge_orphans for the rows stored in source (this database or a
+        shard of it), checking their references against this database.
         
+        The rows are scanned ORPHAN_SCAN at a time by ID on pooled read
+        connections, and each batch's orphans are deleted in one short write,
+        so writers are never held up for long. A row is only deleted if its
+        references are still the ones found missing. Archived rows are
+        checked too, before the hot tier (see delete_dependents)."""
+        started = time.perf_counter()
+        referenced = {id_column: table for table, id_column in ID_COLUMNS.items()}
+        report = {'task': 'purge_orphans'}
+        archived = os.path.exists(source.archive_name)
+        for table, columns in GID_REFERENCES.items():
+            id_column = ID_COLUMNS[table]
+            report[table] = 0
+            for tier in ([f'archive.{table}'] if archived and table in ARCHIVE_DATES else []) + [f'main.{table}']:
+                after = 0
+                while True:
+                    query = (f'SELECT {id_column}, {", ".join(columns)} FROM {tier} '
+                             f'WHERE {id_column} > ? ORDER BY {id_column} LIMIT ?')
+                    # Pooled connections don't have the archive attached
+                    rows = (source.execute_query(query, (after, self.ORPHAN_SCAN), True)
+                            if tier.startswith('archive.') else source.read(query, (after, self.ORPHAN_SCAN)))
+                    if not rows:
+                        break
+                    after = rows[-1][id_column]
+                    existing = {column: self.existing_ids(referenced[column],
+                                                          {row[column] for row in rows if row[column] is not None})
+                                for column in columns}
+                    orphans = [[row[id_column]] + [row[column] for column in columns] for row in rows
+                               if any(row[column] is not None and row[column] not in existing[column]
+                                      for column in columns)]
+                    if orphans:
+                        delete = (f'DELETE FROM {tier} WHERE {id_column} = ? AND '
+                                  f'{" AND ".join(f"{column} IS ?" for column in columns)}')
+                        report[table] += source.submit(
+                            lambda conn: conn.executemany(delete, orphans).rowcount).result()
+        report['rows'] = sum(report[table] for table in GID_REFERENCES)
+        report['seconds'] = time.perf_counter() - started
+        return report
+    
+    def update_async(self, table, id_column, id_value, data):
+        """Queue an update of a record in the table; the Future's result is
+        a write_result with the updated row"""
         # Build SET clause
         set_clauses = []
         values = []
@@ -140,7 +1070,9 @@ class HospitalDatabase:
         # Add id_value at the end for WHERE clause
         values.append(id_value)
         
-        query = f'UPDATE {table} SET {", ".join(set_clauses)} WHERE {id_column} = ?'
-        cursor.execute(query, values)
-        conn.commit()
-        conn.close()
+        query = f'UPDATE {table} SET {", ".join(set_clauses)} WHERE {id_column} = ? RETURNING *'
+        return self.submit(lambda conn: self.write_result(table, returned_rows(conn.execute(query, values))))
+    
+    def update(self, table, id_column, id_value, data):
+        """Update a record in the table"""
+        return self.update_async(table, id_column, id_value, data).result()
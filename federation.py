@@ -0,0 +1,552 @@
+from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from client import HospitalClient
+from sharding import open_database
+from database import TIMELINE_COLUMNS, VIEW_FILTERS, split_gid
+from bloom import BloomFilter, might_match
+from linkage import PatientLinker, LocalSource, RemoteSource
+from replication import ReplicaDatabase
+import threading
+import time
+import os
+import sys
+import tempfile
+
+# How each table is fetched from a remote hospital
+REMOTE_FETCHERS = {
+    'patients': lambda client, search_term: client.get_patients(search_term),
+    'doctors': lambda client, search_term: client.get_doctors(search_term),
+    'appointments': lambda client, search_term: (client.get_view('appointments', search_term) or {}).get('rows', []),
+    'medical_records': lambda client, search_term: (client.get_view('medical_records', search_term)
+                                                    or {}).get('rows', []),
+}
+
+def merge_stats(summaries, top=10):
+    """Add up per-hospital dashboard summaries (HospitalDatabase.stats)"""
+    by_status, by_day, diagnoses, by_hospital, per_doctor = {}, {}, {}, {}, []
+    for summary in summaries:
+        by_hospital[summary['hospital']] = summary['appointments_by_status']
+        for status, count in summary['appointments_by_status'].items():
+            by_status[status] = by_status.get(status, 0) + count
+        for row in summary['appointments_by_day']:
+            key = (row['day'], row['status'])
+            by_day[key] = by_day.get(key, 0) + row['count']
+        per_doctor.extend({**row, 'hospital': summary['hospital']} for row in summary['patients_per_doctor'])
+        for row in summary['top_diagnoses']:
+            diagnoses[row['diagnosis']] = diagnoses.get(row['diagnosis'], 0) + row['count']
+    return {
+        'appointments_by_status': by_status,
+        'appointments_by_hospital': by_hospital,
+        'appointments_by_day': [{'day': day, 'status': status, 'count': count}
+                                for (day, status), count in sorted(by_day.items(), key=lambda item: str(item[0]))],
+        'patients_per_doctor': sorted(per_doctor, key=lambda row: -row['patients']),
+        'top_diagnoses': [{'diagnosis': diagnosis, 'count': count}
+                          for diagnosis, count in sorted(diagnoses.items(), key=lambda item: -item[1])[:top]],
+    }
+
+class HospitalRegistry:
+    """Remote hospitals known to the master, persisted in its own database
+    so connections survive a restart"""
+
+    def __init__(self, db):
+        self.db = db
+        self.db.execute_query('''
+            CREATE TABLE IF NOT EXISTS remote_hospitals (
+                url TEXT PRIMARY KEY,
+                hospital TEXT,
+                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        columns = [column['name'] for column in self.db.execute_query('PRAGMA table_info(remote_hospitals)')]
+        if 'hospital_id' not in columns:
+            self.db.execute_query('ALTER TABLE remote_hospitals ADD COLUMN hospital_id INTEGER')
+
+    def all(self):
+        return self.db.execute_query('SELECT url, hospital, hospital_id FROM remote_hospitals '
+                                     'ORDER BY added_at, url')
+
+    def save(self, url, hospital, hospital_id=None):
+        self.db.execute_query('INSERT OR REPLACE INTO remote_hospitals (url, hospital, hospital_id) '
+                              'VALUES (?, ?, ?)', (url, hospital, hospital_id))
+
+    def remove(self, url):
+        self.db.execute_query('DELETE FROM remote_hospitals WHERE url = ?', (url,))
+
+class HospitalHealth:
+    """Rolling health statistics for one remote hospital"""
+    SAMPLES = 100
+    # Consecutive failed checks before a hospital is skipped during fan-out
+    FAILURE_THRESHOLD = 2
+
+    def __init__(self):
+        self.latencies = deque(maxlen=self.SAMPLES)
+        self.checks = 0
+        self.successes = 0
+        self.consecutive_failures = 0
+        self.last_seen = None
+
+    def record(self, ok, latency_ms):
+        self.checks += 1
+        if ok:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.last_seen = time.time()
+            self.latencies.append(latency_ms)
+        else:
+            self.consecutive_failures += 1
+
+    @property
+    def healthy(self):
+        return self.consecutive_failures < self.FAILURE_THRESHOLD
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 1)
+
+    def summary(self):
+        return {
+            'online': self.checks > 0 and self.consecutive_failures == 0,
+            'healthy': self.healthy,
+            'latency_p50_ms': self.percentile(50),
+            'latency_p95_ms': self.percentile(95),
+            'latency_p99_ms': self.percentile(99),
+            'uptime': round(self.successes / self.checks, 4) if self.checks else None,
+            'last_seen': self.last_seen,
+            'checks': self.checks,
+        }
+
+class FederationService:
+    """Cross-hospital aggregation for the master hospital.
+
+    Holds the registry of remote hospitals, fans queries out to them in
+    parallel, caches the answers for a few seconds and merges them with the
+    master's own database. Used in-process by the master GUI, or served over
+    HTTP by this module so several terminals and scripts can share it.
+
+    The registry is persisted in the master's database, and a background
+    monitor health-checks every hospital each HEALTH_INTERVAL seconds;
+    hospitals failing consecutive checks are skipped during fan-out.
+    The monitor also pulls each hospital's search sketch (Bloom filters
+    over its searchable values), and searches are only sent to hospitals
+    whose sketch might match. Hospitals without a sketch are always asked.
+
+    Hospitals that replicate into the master (server.py --master) are read
+    from the local replica instead, which keeps answering while they are
+    down.
+    """
+    CACHE_TTL = 5
+    HEALTH_INTERVAL = 10
+
+    def __init__(self, local_db, max_workers=16, monitor=True, replica_db=None):
+        self.local_db = local_db
+        self.registry = HospitalRegistry(local_db)
+        self.replica = ReplicaDatabase(replica_db or os.path.splitext(local_db.db_name)[0] + '_replica.db')
+        self.clients = {}
+        self.hospital_names = {}
+        self.hospital_ids = {}
+        self.health = {}
+        self.sketches = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='federation')
+        self.stopped = threading.Event()
+
+        for entry in self.registry.all():
+            self.register(entry['url'], entry['hospital'], entry['hospital_id'])
+        if monitor:
+            threading.Thread(target=self.monitor, name='federation-health', daemon=True).start()
+
+    def register(self, url, hospital, hospital_id=None):
+        with self.lock:
+            self.clients[url] = HospitalClient(url)
+            self.hospital_names[url] = hospital
+            if hospital_id is not None:
+                self.hospital_ids[url] = hospital_id
+            self.health.setdefault(url, HospitalHealth())
+
+    def id_conflict(self, url, hospital_id):
+        """Whether hospital_id is already used by this or another registered hospital"""
+        return hospital_id == self.local_db.hospital_id or any(
+            other_id == hospital_id for other, other_id in self.hospital_ids.items() if other != url)
+
+    def add_hospital(self, url):
+        """Register a remote hospital; returns its name, or None if it is
+        unreachable or its hospital ID is already taken"""
+        client = HospitalClient(url)
+        started = time.perf_counter()
+        health = client.check_health()
+        if not health:
+            return None
+        if self.id_conflict(url, health.get('hospital_id')):
+            print(f"Warning: {url} uses hospital ID {health.get('hospital_id')}, which is already taken")
+            return None
+        self.register(url, health['hospital'], health.get('hospital_id'))
+        self.health[url].record(True, (time.perf_counter() - started) * 1000)
+        self.registry.save(url, health['hospital'], health.get('hospital_id'))
+        self.refresh_sketch(url, client)
+        return health['hospital']
+
+    def remove_hospital(self, url):
+        with self.lock:
+            self.clients.pop(url, None)
+            self.hospital_names.pop(url, None)
+            self.hospital_ids.pop(url, None)
+            self.health.pop(url, None)
+            self.sketches.pop(url, None)
+            self.cache = {key: value for key, value in self.cache.items() if key[2] != url}
+        self.registry.remove(url)
+
+    def check_all(self):
+        """Health-check every registered hospital in parallel and record
+        latency and availability"""
+        with self.lock:
+            targets = list(self.clients.items())
+
+        def check(target):
+            url, client = target
+            started = time.perf_counter()
+            health = client.check_health()
+            latency_ms = (time.perf_counter() - started) * 1000
+            stats = self.health.get(url)
+            if stats:
+                stats.record(bool(health), latency_ms)
+            if health:
+                self.hospital_names[url] = health['hospital']
+                self.hospital_ids[url] = health.get('hospital_id')
+                self.refresh_sketch(url, client)
+
+        list(self.pool.map(check, targets))
+
+    def refresh_sketch(self, url, client):
+        current = self.sketches.get(url)
+        sketch = client.get_sketch(current[0] if current else None)
+        if not sketch or sketch.get('unchanged'):
+            return
+        self.sketches[url] = (sketch['seq'], {table: BloomFilter.from_dict(data)
+                                              for table, data in sketch['tables'].items()})
+
+    def might_have(self, url, table, search_term):
+        """False if the hospital's sketch rules out any row matching search_term"""
+        sketch = self.sketches.get(url)
+        if not search_term or not sketch or table not in sketch[1]:
+            return True
+        return might_match(sketch[1][table], search_term)
+
+    def monitor(self):
+        while not self.stopped.is_set():
+            self.check_all()
+            self.stopped.wait(self.HEALTH_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_healthy(self, url):
+        stats = self.health.get(url)
+        return stats is None or stats.healthy
+
+    def hospitals(self):
+        with self.lock:
+            return [{'url': url, 'hospital': self.hospital_names[url], 'hospital_id': self.hospital_ids.get(url)}
+                    for url in self.clients]
+
+    def hospital_status(self):
+        """Registered hospitals with the monitor's cached health statistics
+        and, for replicated ones, the replica's position and last apply time"""
+        sources = {source['hospital_id']: source for source in self.replica.sources()}
+        statuses = []
+        for hospital in self.hospitals():
+            if hospital['url'] not in self.health:
+                continue
+            source = sources.get(hospital['hospital_id'])
+            statuses.append({**hospital, **self.health[hospital['url']].summary(),
+                             'replica_seq': source['seq'] if source else None,
+                             'replica_applied_at': source['applied_at'] if source else None})
+        return statuses
+
+    def replicated_id(self, url):
+        """Hospital ID of url if the master holds a replica of it, else None"""
+        hospital_id = self.hospital_ids.get(url)
+        return hospital_id if hospital_id is not None and self.replica.has_source(hospital_id) else None
+
+    def seed_replica(self, url):
+        """Bootstrap the replica of url from a snapshot of its database
+        instead of replaying its whole change log; its shipper then resumes
+        from the snapshot's sequence. Returns the replica position, or None
+        if the hospital couldn't be reached."""
+        hospital_id = self.hospital_ids.get(url)
+        if hospital_id is None:
+            return None
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            seq = self.clients[url].download_snapshot(path)
+            if seq is None:
+                return None
+            return self.replica.load_snapshot(hospital_id, self.hospital_names[url], path, seq)
+        finally:
+            os.remove(path)
+
+    def query(self, table, search_term='', url=None, refresh=False):
+        """Fetch table from every remote hospital (or just url) in parallel.
+
+        Returns (hospital_name, rows) pairs in registration order. Answers
+        are cached per (table, search term, hospital) for CACHE_TTL seconds
+        unless refresh is set. Hospitals the monitor marks unhealthy are
+        skipped rather than waited on, and hospitals whose search sketch
+        rules the term out answer with no rows without a request (unless
+        refresh is set, as sketches lag writes by up to HEALTH_INTERVAL).
+        Replicated hospitals are answered from the replica, healthy or not.
+        """
+        fetch = REMOTE_FETCHERS[table]
+        with self.lock:
+            urls = [url] if url else list(self.clients)
+            targets = [(u, self.clients[u]) for u in urls
+                       if u in self.clients and (self.is_healthy(u) or self.replicated_id(u) is not None)]
+
+        def fetch_one(target):
+            url, client = target
+            key = (table, search_term, url)
+            now = time.monotonic()
+            cached = self.cache.get(key)
+            replicated = self.replicated_id(url)
+            if replicated is not None:
+                rows = self.replica.search(table, replicated, search_term)
+            elif not refresh and not self.might_have(url, table, search_term):
+                rows = []
+            elif cached and not refresh and cached[0] > now:
+                rows = cached[1]
+            else:
+                rows = fetch(client, search_term)
+                self.cache[key] = (now + self.CACHE_TTL, rows)
+            return self.hospital_names.get(url, 'Unknown'), rows
+
+        return list(self.pool.map(fetch_one, targets))
+
+    def link_patients(self):
+        """Update the master patient index from the change feeds of the
+        local database and every healthy hospital; returns the linker"""
+        linker = PatientLinker(self.local_db)
+        sources = [LocalSource(self.local_db)]
+        with self.lock:
+            sources.extend(RemoteSource(client, self.hospital_ids[url], self.hospital_names[url])
+                           for url, client in self.clients.items()
+                           if self.is_healthy(url) and self.hospital_ids.get(url) is not None)
+        linker.sync(sources)
+        return linker
+
+    def stats(self, since=None, top=10):
+        """Dashboard summary of the master and every healthy hospital,
+        merged from their /stats summaries. Each hospital is asked for more
+        than top diagnoses, so the merged top list is rarely cut short by a
+        diagnosis that is common overall but not near the top anywhere."""
+        with self.lock:
+            targets = [(url, client) for url, client in self.clients.items() if self.is_healthy(url)]
+            missing = [self.hospital_names[url] for url in self.clients if not self.is_healthy(url)]
+        summaries = [self.local_db.stats(since, top * 5)]
+        for (url, client), summary in zip(targets, self.pool.map(
+                lambda target: target[1].get_stats(since, top * 5), targets)):
+            if summary:
+                summaries.append(summary)
+            else:
+                missing.append(self.hospital_names.get(url, url))
+        return {**merge_stats(summaries, top), 'hospitals': [summary['hospital'] for summary in summaries],
+                'missing': missing}
+
+    def free_slots(self, specialization, count=5, after=None):
+        """The earliest count free slots for a specialization at the master
+        and every healthy hospital, each tagged with its hospital"""
+        with self.lock:
+            targets = [(url, client) for url, client in self.clients.items() if self.is_healthy(url)]
+            missing = [self.hospital_names[url] for url in self.clients if not self.is_healthy(url)]
+        slots = [{**slot, 'hospital': self.local_db.hospital_name}
+                 for slot in self.local_db.free_slots(specialization, count, after)]
+        for (url, client), answer in zip(targets, self.pool.map(
+                lambda target: target[1].get_free_slots(specialization, count, after), targets)):
+            if answer is None:
+                missing.append(self.hospital_names.get(url, url))
+            else:
+                slots.extend({**slot, 'hospital': self.hospital_names.get(url, url)} for slot in answer)
+        slots.sort(key=lambda slot: (slot['date'], slot['time'], slot['hospital']))
+        return {'slots': slots[:count], 'missing': missing}
+
+    def timeline(self, patient_gid, include_archive=False):
+        """A patient's timeline from their hospital and from every hospital
+        where the master patient index links them to another registration
+        (see link_patients), merged oldest first with each row tagged with
+        its hospital. Hospitals are found by the hospital ID of the global
+        ID in the registry. None if the patient's hospital doesn't know
+        them."""
+        hospital_id, patient_id = split_gid(patient_gid)
+        with self.lock:
+            urls = {other_id: url for url, other_id in self.hospital_ids.items() if other_id is not None}
+            names = {other_id: self.hospital_names[url] for other_id, url in urls.items()}
+        names[self.local_db.hospital_id] = self.local_db.hospital_name
+        if hospital_id not in names:
+            return None
+
+        def fetch(registration):
+            other_id, local_id = registration
+            if other_id == self.local_db.hospital_id:
+                return self.local_db.timeline(local_id, include_archive)
+            url = urls.get(other_id)
+            if url is None or not self.is_healthy(url):
+                return None
+            return self.clients[url].get_timeline(local_id, include_archive)
+
+        registrations = PatientLinker(self.local_db).linked(hospital_id, patient_id)
+        results = list(self.pool.map(fetch, registrations))
+        if results[0] is None:
+            return None
+        merged = {'patient': results[0]['patient'], 'registrations': [], 'missing': []}
+        for table in TIMELINE_COLUMNS:
+            merged[table] = []
+        for (other_id, local_id), result in zip(registrations, results):
+            hospital = names.get(other_id, 'Unknown')
+            if result is None:
+                merged['missing'].append(hospital)
+                continue
+            merged['registrations'].append({'hospital': hospital, 'hospital_id': other_id, 'patient_id': local_id,
+                                            'gid': result['patient']['gid']})
+            for table in TIMELINE_COLUMNS:
+                merged[table].extend({**row, 'hospital': hospital} for row in result[table])
+        merged['appointments'].sort(key=lambda row: (row['appointment_date'] or '', row['appointment_time'] or ''))
+        merged['medical_records'].sort(key=lambda row: row['record_date'] or '')
+        return merged
+
+    def federated(self, table, search_term='', url=None, remote_only=False, refresh=False):
+        """Local and remote rows merged into one list, each tagged with its hospital"""
+        results = []
+        if not url and not remote_only:
+            if table in VIEW_FILTERS:
+                rows = self.local_db.list_view(table, search_term)['rows']
+            else:
+                rows = self.local_db.search(table, search_term)
+            results.append((self.local_db.hospital_name, rows))
+        results.extend(self.query(table, search_term, url, refresh))
+        return [{**row, 'hospital': hospital} for hospital, rows in results for row in rows]
+
+app = Flask(__name__)
+service = None
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok', 'hospital': service.local_db.hospital_name,
+                    'hospital_id': service.local_db.hospital_id, 'role': 'federation'})
+
+@app.route('/federated/hospitals', methods=['GET', 'POST', 'DELETE'])
+def federated_hospitals():
+    if request.method == 'GET':
+        if request.args.get('check'):
+            return jsonify(service.hospital_status())
+        return jsonify(service.hospitals())
+    elif request.method == 'POST':
+        url = request.json.get('url', '')
+        hospital = service.add_hospital(url)
+        if not hospital:
+            return jsonify({'status': 'error', 'message': f'Cannot reach {url} or its hospital ID is taken'}), 502
+        return jsonify({'status': 'success', 'url': url, 'hospital': hospital})
+    elif request.method == 'DELETE':
+        service.remove_hospital(request.args.get('url', ''))
+        return jsonify({'status': 'success'})
+
+def registered_url(hospital_id):
+    """URL of the registered hospital with this ID, or None"""
+    return next((url for url, other_id in service.hospital_ids.items() if other_id == hospital_id), None)
+
+@app.route('/replication/<int:hospital_id>', methods=['GET', 'POST'])
+def replication(hospital_id):
+    """Receive a registered hospital's change batches (POST) or report
+    where its replica stands (GET); a batch that doesn't start at that
+    position is refused with 409 and the position to resume from"""
+    if registered_url(hospital_id) is None:
+        return jsonify({'status': 'error', 'message': f'Unknown hospital ID {hospital_id}'}), 404
+    if request.method == 'GET':
+        return jsonify({'seq': service.replica.position(hospital_id)})
+    batch = request.json
+    seq = service.replica.apply(hospital_id, batch['hospital'], batch['from_seq'], batch['seq'], batch['changes'])
+    if seq != batch['seq']:
+        return jsonify({'status': 'error', 'message': 'Out of sequence', 'seq': seq}), 409
+    return jsonify({'status': 'success', 'seq': seq})
+
+@app.route('/replication/<int:hospital_id>/snapshot', methods=['POST'])
+def replication_snapshot(hospital_id):
+    """Seed a registered hospital's replica from a snapshot of its database"""
+    url = registered_url(hospital_id)
+    if url is None:
+        return jsonify({'status': 'error', 'message': f'Unknown hospital ID {hospital_id}'}), 404
+    seq = service.seed_replica(url)
+    if seq is None:
+        return jsonify({'status': 'error', 'message': f'Cannot get a snapshot from {url}'}), 502
+    return jsonify({'status': 'success', 'seq': seq})
+
+@app.route('/federated/linkage', methods=['GET', 'POST'])
+def federated_linkage():
+    """Patients registered at more than one hospital; POST first brings the
+    master patient index up to date"""
+    if request.method == 'POST':
+        linker = service.link_patients()
+    else:
+        linker = PatientLinker(service.local_db)
+    return jsonify({'pairs_compared': linker.pairs_compared,
+                    'duplicates': [{'global_id': global_id,
+                                    'patients': [{'hospital': hospital, 'patient_id': patient_id, 'name': name}
+                                                 for hospital, patient_id, name in members]}
+                                   for global_id, members in linker.duplicates().items()]})
+
+@app.route('/federated/stats', methods=['GET'])
+def federated_stats():
+    """Dashboard summary merged across hospitals (same parameters as /stats)"""
+    return jsonify(service.stats(request.args.get('since') or None, request.args.get('top', 10, type=int)))
+
+@app.route('/federated/availability', methods=['GET'])
+def federated_availability():
+    """Next free slots for ?specialization= across hospitals (same
+    parameters as /availability)"""
+    try:
+        return jsonify(service.free_slots(request.args.get('specialization'),
+                                          request.args.get('count', 5, type=int),
+                                          request.args.get('after') or None))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'after must be YYYY-MM-DD HH:MM'}), 400
+
+@app.route('/federated/patients/<int:patient_gid>/timeline', methods=['GET'])
+def federated_timeline(patient_gid):
+    """A patient's timeline, by global ID, from every hospital they are
+    registered at (?archive=1 includes archived rows)"""
+    timeline = service.timeline(patient_gid, bool(request.args.get('archive')))
+    if timeline is None:
+        return jsonify({'status': 'error', 'message': f'Unknown patient {patient_gid}'}), 404
+    return jsonify(timeline)
+
+@app.route('/federated/<table>', methods=['GET'])
+def federated_table(table):
+    if table not in REMOTE_FETCHERS:
+        return jsonify({'status': 'error', 'message': f'Unknown table {table}'}), 404
+    return jsonify(service.federated(table,
+                                     search_term=request.args.get('search', ''),
+                                     url=request.args.get('hospital') or None,
+                                     remote_only=bool(request.args.get('remote_only')),
+                                     refresh=bool(request.args.get('refresh'))))
+
+def start_service(hospital_name, port, db_name, hospital_urls=()):
+    global service
+    service = FederationService(open_database(db_name, hospital_name))
+    print(f"Restored {len(service.hospitals())} registered hospital(s)")
+    for url in hospital_urls:
+        if not service.add_hospital(url):
+            print(f"Warning: could not reach {url}")
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("Usage: python federation.py <hospital_name> <port> <db_name> [hospital_url ...]")
+        sys.exit(1)
+
+    hospital_name = sys.argv[1]
+    port = int(sys.argv[2])
+    db_name = sys.argv[3]
+
+    start_service(hospital_name, port, db_name, sys.argv[4:])
@@ -1,32 +1,626 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
-from tkcalendar import DateEntry
-from client import HospitalClient
-from database import HospitalDatabase
+from database import DEPENDENTS, ID_COLUMNS, VIEW_FILTERS, make_gid, split_gid
+from sharding import open_database
 import threading
+import queue
 import json
 import re
-from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+class BackgroundExecutor:
+    """Runs blocking work off the Tk main thread.
+
+    Jobs are grouped by key (e.g. 'patients'); submitting a new job for a key
+    makes every older job for that key stale, so its result is dropped.
+    Results are handed back to the main thread from a root.after poll loop.
+    """
+    POLL_MS = 50
+
+    def __init__(self, root, max_workers=8, on_busy_change=None):
+        self.root = root
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gui-loader')
+        self.on_busy_change = on_busy_change
+        self._results = queue.Queue()
+        self._generations = {}
+        self._futures = {}
+        self._idle_callbacks = []
+        self._last_busy = 0
+        self._closed = False
+        self.root.after(self.POLL_MS, self._poll)
+
+    @property
+    def busy(self):
+        return sum(len(futures) for futures in self._futures.values())
+
+    def submit(self, key, func, on_success, on_error=None, replace=True):
+        """Run func() in the pool and call on_success(result) on the main thread.
+
+        Any job still pending for the same key is cancelled or ignored, unless
+        replace is False, in which case the job joins the current batch for
+        the key (used to stream one result per hospital)."""
+        if replace:
+            self.cancel(key)
+        generation = self._generations.get(key, 0)
+        future = self.pool.submit(func)
+        self._futures.setdefault(key, set()).add(future)
+        future.add_done_callback(
+            lambda f: self._results.put((key, generation, f, on_success, on_error)))
+        self._notify_busy()
+        return future
+
+    def cancel(self, key):
+        """Mark every running job for key as stale"""
+        self._generations[key] = self._generations.get(key, 0) + 1
+        for future in self._futures.pop(key, ()):
+            future.cancel()
+        self._notify_busy()
+
+    def when_idle(self, callback):
+        """Call callback once no jobs are pending"""
+        if self.busy:
+            self._idle_callbacks.append(callback)
+        else:
+            callback()
+
+    def shutdown(self):
+        self._closed = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _poll(self):
+        if self._closed:
+            return
+        while True:
+            try:
+                key, generation, future, on_success, on_error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._futures.get(key, set()).discard(future)
+            if future.cancelled() or generation != self._generations.get(key, 0):
+                continue
+            error = future.exception()
+            if error is None:
+                on_success(future.result())
+            elif on_error:
+                on_error(error)
+        self._notify_busy()
+        if not self.busy and self._idle_callbacks:
+            callbacks, self._idle_callbacks = self._idle_callbacks, []
+            for callback in callbacks:
+                callback()
+        self.root.after(self.POLL_MS, self._poll)
+
+    def _notify_busy(self):
+        busy = self.busy
+        if busy != self._last_busy:
+            self._last_busy = busy
+            if self.on_busy_change:
+                self.on_busy_change(busy)
+
+def make_date_entry(parent, **options):
+    """Create a tkcalendar DateEntry; tkcalendar (and babel behind it) is
+    only imported once a dialog needs a date picker"""
+    from tkcalendar import DateEntry
+    return DateEntry(parent, **options)
+
+def sort_key(value):
+    """Natural sort key so IDs and ages sort numerically, e.g. 'Room 10' after 'Room 9'"""
+    if value is None:
+        return ('', -1)
+    match = re.match(r'^(.*?)(\d+)$', str(value))
+    if match:
+        return (match.group(1).lower(), int(match.group(2)))
+    return (str(value).lower(), -1)
+
+class VirtualTable:
+    """Treeview that only materializes a window of rows as Tk items.
+    
+    Rows are kept as plain tuples whose first element is the row's key (its
+    global ID), followed by the displayed column values. Only the visible
+    rows plus BUFFER rows on either side exist in the Treeview; scrolling
+    past the buffer renders the next page, and sorting reorders the tuples
+    instead of moving Tk items.
+    
+    Rendering is a diff against the items already on screen, keyed by the
+    row key, so a refresh where few rows changed only costs a few Tk calls
+    and keeps the selection and scroll position.
+    """
+    BUFFER = 100
+    ROW_HEIGHT = 20
+
+    def __init__(self, parent, columns, column_width):
+        self.columns = columns
+        self.rows = []
+        self.rows_by_key = {}
+        self.key_items = {}
+        self.item_keys = {}
+        self.rendered = {}
+        self.window_keys = []
+        self.top = 0
+        self.window_start = 0
+        self.window_end = 0
+        self.sort_column = None
+        self.sort_reverse = False
+        self.selected_key = None
+        self._render_pending = False
+
+        self.v_scrollbar = tk.Scrollbar(parent, command=self.on_scrollbar)
+        self.v_scrollbar.pack(side='right', fill='y')
+        h_scrollbar = tk.Scrollbar(parent, orient='horizontal')
+        h_scrollbar.pack(side='bottom', fill='x')
+
+        self.tree = ttk.Treeview(parent, columns=columns, show='headings', selectmode='browse',
+                                 yscrollcommand=self.on_tree_scroll,
+                                 xscrollcommand=h_scrollbar.set)
+        for col in columns:
+            self.tree.heading(col, text=col, command=lambda c=col: self.sort_by(c))
+            self.tree.column(col, width=column_width)
+
+        self.tree.pack(fill='both', expand=True)
+        h_scrollbar.config(command=self.tree.xview)
+        self.tree.bind('<<TreeviewSelect>>', self.on_select)
+        self.tree.bind('<Configure>', lambda event: self.schedule_render())
+
+    def visible_count(self):
+        return max(1, self.tree.winfo_height() // self.ROW_HEIGHT)
+
+    def set_rows(self, rows):
+        """Replace the data set; only the differences reach the Treeview"""
+        self.rows_by_key = {row[0]: row for row in rows}
+        self.rows = list(self.rows_by_key.values())
+        self.apply_sort()
+        self.render()
+
+    def apply_changes(self, upserts=(), deletes=()):
+        """Apply a change feed: upsert rows by key and drop deleted keys"""
+        for key in deletes:
+            self.rows_by_key.pop(key, None)
+        new_rows = []
+        for row in upserts:
+            if row[0] not in self.rows_by_key:
+                new_rows.append(row)
+            self.rows_by_key[row[0]] = row
+        self.rows = [self.rows_by_key[row[0]] for row in self.rows if row[0] in self.rows_by_key]
+        self.rows.extend(new_rows)
+        self.apply_sort()
+        self.render()
+
+    def selected_values(self):
+        """Displayed values of the selected row, even if it is scrolled out
+        of the window"""
+        row = self.rows_by_key.get(self.selected_key)
+        return row[1:] if row else None
+
+    def sort_by(self, column):
+        if self.sort_column == column:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            if self.sort_column:
+                self.tree.heading(self.sort_column, text=self.sort_column)
+            self.sort_column = column
+            self.sort_reverse = False
+        arrow = ' ▼' if self.sort_reverse else ' ▲'
+        self.tree.heading(column, text=column + arrow)
+        self.apply_sort()
+        self.render(0)
+
+    def apply_sort(self):
+        if self.sort_column:
+            index = self.columns.index(self.sort_column) + 1
+            self.rows.sort(key=lambda row: sort_key(row[index]), reverse=self.sort_reverse)
+
+    def schedule_render(self):
+        if not self._render_pending:
+            self._render_pending = True
+            self.tree.after_idle(self.render)
+
+    def render(self, top=None):
+        """Bring the Tk items in line with the window around top"""
+        self._render_pending = False
+        total = len(self.rows)
+        visible = self.visible_count()
+        top = self.top if top is None else top
+        top = max(0, min(top, total - visible))
+        start = max(0, top - self.BUFFER)
+        end = min(total, top + visible + self.BUFFER)
+        window = self.rows[start:end]
+        wanted = {row[0] for row in window}
+
+        for key in self.window_keys:
+            if key not in wanted:
+                item = self.key_items.pop(key)
+                del self.item_keys[item]
+                del self.rendered[key]
+                self.tree.delete(item)
+
+        # Items still on screen are in their old relative order; only move
+        # the ones that fell out of it, insert new ones in place.
+        remaining = [key for key in self.window_keys if key in wanted]
+        placed = set()
+        i = 0
+        for position, row in enumerate(window):
+            key = row[0]
+            while i < len(remaining) and remaining[i] in placed:
+                i += 1
+            item = self.key_items.get(key)
+            if item is None:
+                item = self.tree.insert('', position, values=row[1:])
+                self.key_items[key] = item
+                self.item_keys[item] = key
+            else:
+                if self.rendered[key] != row:
+                    self.tree.item(item, values=row[1:])
+                if i < len(remaining) and remaining[i] == key:
+                    i += 1
+                else:
+                    self.tree.move(item, '', position)
+            self.rendered[key] = row
+            placed.add(key)
+        self.window_keys = [row[0] for row in window]
+
+        selected_item = self.key_items.get(self.selected_key)
+        if selected_item and selected_item not in self.tree.selection():
+            self.tree.selection_set(selected_item)
+
+        self.top, self.window_start, self.window_end = top, start, end
+        if end > start:
+            self.tree.yview_moveto((top - start) / (end - start))
+        self.update_scrollbar()
+
+    def scroll_to(self, top):
+        visible = self.visible_count()
+        top = max(0, min(top, len(self.rows) - visible))
+        if self.window_start <= top and top + visible <= self.window_end:
+            self.tree.yview_moveto((top - self.window_start) / (self.window_end - self.window_start))
+        else:
+            self.render(top)
+
+    def update_scrollbar(self):
+        total = len(self.rows)
+        if not total:
+            self.v_scrollbar.set(0, 1)
+            return
+        self.v_scrollbar.set(self.top / total, min(1.0, (self.top + self.visible_count()) / total))
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * len(self.rows)))
+        elif unit == 'pages':
+            self.scroll_to(self.top + int(amount) * self.visible_count())
+        else:
+            self.scroll_to(self.top + int(amount))
+
+    def on_tree_scroll(self, first, last):
+        """Track native scrolling (wheel, arrow keys) inside the window and
+        render the next page once the view gets close to the window edge"""
+        size = self.window_end - self.window_start
+        if not size:
+            self.update_scrollbar()
+            return
+        self.top = self.window_start + int(round(float(first) * size))
+        bottom = self.window_start + int(round(float(last) * size))
+        self.update_scrollbar()
+        near_top = self.window_start > 0 and self.top - self.window_start < self.BUFFER // 2
+        near_bottom = self.window_end < len(self.rows) and self.window_end - bottom < self.BUFFER // 2
+        if near_top or near_bottom:
+            self.schedule_render()
+
+    def on_select(self, event):
+        selection = self.tree.selection()
+        if selection and selection[0] in self.item_keys:
+            self.selected_key = self.item_keys[selection[0]]
+
+# Compact record types held by the DataStore: one namedtuple per table,
+# with the row's global ID and the owning hospital as the last fields
+RECORD_FIELDS = {
+    'patients': ('patient_id', 'name', 'age', 'gender', 'phone', 'address', 'created_at'),
+    'doctors': ('doctor_id', 'name', 'specialization', 'phone', 'email', 'created_at'),
+    'appointments': ('appointment_id', 'patient_id', 'doctor_id', 'appointment_date',
+                     'appointment_time', 'status', 'created_at', 'patient_name', 'doctor_name'),
+    'medical_records': ('record_id', 'patient_id', 'doctor_id', 'diagnosis', 'prescription',
+                        'notes', 'record_date', 'created_at', 'patient_name', 'doctor_name'),
+}
+RECORD_TYPES = {
+    'patients': namedtuple('Patient', RECORD_FIELDS['patients'] + ('gid', 'hospital')),
+    'doctors': namedtuple('Doctor', RECORD_FIELDS['doctors'] + ('gid', 'hospital')),
+    'appointments': namedtuple('Appointment', RECORD_FIELDS['appointments'] + ('gid', 'hospital')),
+    'medical_records': namedtuple('MedicalRecord', RECORD_FIELDS['medical_records'] + ('gid', 'hospital')),
+}
+
+def make_record(table, row, hospital):
+    """Convert a row dict from SQLite or the REST API into a record tuple"""
+    return RECORD_TYPES[table](*(row.get(field) for field in RECORD_FIELDS[table]), row.get('gid'), hospital)
+
+def record_matches(record, term):
+    """Case-insensitive substring match over a record's own fields, like the
+    LIKE search in HospitalDatabase.search"""
+    term = term.lower()
+    return any(term in str(value).lower() for value in record[:-2] if value is not None)
+
+class DataStore:
+    """Single in-memory copy of the local and remote tables.
+    
+    Records are keyed by their global ID. Tabs and dialogs read from the
+    store; listeners subscribed to a table are called with the records that
+    were upserted and deleted by each change.
+    """
+
+    def __init__(self):
+        self.tables = {table: {} for table in RECORD_TYPES}
+        self.loaded = {table: set() for table in RECORD_TYPES}
+        self.listeners = {table: [] for table in RECORD_TYPES}
+
+    def subscribe(self, table, callback):
+        self.listeners[table].append(callback)
+
+    def notify(self, table, upserts, deletes):
+        if upserts or deletes:
+            for callback in self.listeners[table]:
+                callback(upserts, deletes)
+
+    def is_loaded(self, table, hospital):
+        return hospital in self.loaded[table]
+
+    def replace(self, table, hospital, records):
+        """Swap in a full reload of one hospital's table, notifying only
+        the differences"""
+        rows = self.tables[table]
+        fresh = {record.gid: record for record in records}
+        deletes = [record for gid, record in rows.items()
+                   if record.hospital == hospital and gid not in fresh]
+        for record in deletes:
+            del rows[record.gid]
+        upserts = [record for key, record in fresh.items() if rows.get(key) != record]
+        rows.update(fresh)
+        self.loaded[table].add(hospital)
+        self.notify(table, upserts, deletes)
+
+    def merge(self, table, records):
+        """Upsert a partial result set (e.g. search hits) without dropping
+        rows that are not in it"""
+        rows = self.tables[table]
+        upserts = []
+        for record in records:
+            if rows.get(record.gid) != record:
+                rows[record.gid] = record
+                upserts.append(record)
+        self.notify(table, upserts, [])
+
+    def upsert(self, table, record):
+        if self.tables[table].get(record.gid) != record:
+            self.tables[table][record.gid] = record
+            self.notify(table, [record], [])
+
+    def delete(self, table, gid):
+        record = self.tables[table].pop(gid, None)
+        if record:
+            self.notify(table, [], [record])
+
+    def delete_many(self, table, gids):
+        """Delete several records with a single notification"""
+        records = (self.tables[table].pop(gid, None) for gid in gids)
+        self.notify(table, [], [record for record in records if record])
+
+    def get(self, table, gid):
+        return self.tables[table].get(gid)
+
+    def records(self, table, hospital=None):
+        if hospital is None:
+            return list(self.tables[table].values())
+        return [record for record in self.tables[table].values() if record.hospital == hospital]
+
+def patient_label(patient):
+    return f"{patient.patient_id} - {patient.name}"
+
+def doctor_label(doctor):
+    return f"{doctor.doctor_id} - {doctor.name} ({doctor.specialization})"
+
+def reference_label(row_id, name):
+    """Label of a referenced patient or doctor ("5 - Ali Ahmadi"), or just
+    the ID if the name is unknown"""
+    return f"{row_id} - {name}" if name else row_id
+
+def label_key(label):
+    """Row ID from a combobox label ("5 - Ali Ahmadi" -> 5), or None"""
+    try:
+        return int(str(label).split(' - ')[0].strip())
+    except ValueError:
+        return None
+
+class TypeAheadIndex:
+    """Trigram index over combobox labels for substring type-ahead.
+    
+    Built once per table and shared by every dialog; add() and remove()
+    keep it current as rows are saved or deleted.
+    """
+    GRAM = 3
+
+    def __init__(self, labels=None):
+        self.labels = {}
+        self.lowered = {}
+        self.postings = {}
+        for key, label in (labels or {}).items():
+            self.add(key, label)
+
+    def grams(self, text):
+        return {text[i:i + self.GRAM] for i in range(len(text) - self.GRAM + 1)}
+
+    def add(self, key, label):
+        self.remove(key)
+        lowered = label.lower()
+        self.labels[key] = label
+        self.lowered[key] = lowered
+        for gram in self.grams(lowered):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        lowered = self.lowered.pop(key, None)
+        if lowered is None:
+            return
+        del self.labels[key]
+        for gram in self.grams(lowered):
+            keys = self.postings.get(gram)
+            keys.discard(key)
+            if not keys:
+                del self.postings[gram]
+
+    def search(self, term, limit):
+        """Labels containing term (case-insensitive), at most limit of them"""
+        term = term.lower()
+        if len(term) < self.GRAM:
+            candidates = self.lowered
+        else:
+            postings = sorted((self.postings.get(gram, set()) for gram in self.grams(term)), key=len)
+            candidates = sorted(set.intersection(*postings)) if postings[0] else []
+        results = []
+        for key in candidates:
+            if term in self.lowered[key]:
+                results.append(self.labels[key])
+                if len(results) >= limit:
+                    break
+        return results
+
+    def label_for(self, key):
+        try:
+            return self.labels.get(int(key))
+        except (TypeError, ValueError):
+            return None
+
+    def __contains__(self, label):
+        return self.labels.get(label_key(label)) == label
+
+class DatabaseLookup:
+    """Type-ahead source that queries SQLite directly, for tables too large
+    to hold in every dialog"""
+
+    def __init__(self, db, table, id_column, columns, to_label):
+        self.db = db
+        self.table = table
+        self.id_column = id_column
+        self.columns = columns
+        self.to_label = to_label
+
+    def search(self, term, limit):
+        rows = self.db.search(self.table, term, limit=limit, columns=self.columns)
+        return [self.to_label(make_record(self.table, row, self.db.hospital_name)) for row in rows]
+
+    def add(self, key, label):
+        pass
+
+    def remove(self, key):
+        pass
+
+    def label_for(self, key):
+        row = self.db.get(self.table, self.id_column, key)
+        return self.to_label(make_record(self.table, row, self.db.hospital_name)) if row else None
+
+    def __contains__(self, label):
+        key = label_key(label)
+        return key is not None and self.label_for(key) == label
+
+# table -> (id column, columns searched in the database, label function)
+LOOKUP_SPECS = {
+    'patients': ('patient_id', ('patient_id', 'name'), patient_label),
+    'doctors': ('doctor_id', ('doctor_id', 'name', 'specialization'), doctor_label),
+}
 
 class HospitalManagementGUI:
-    def __init__(self, root, is_master=False, local_port=5000, local_db='hospital.db', hospital_name='Hospital'):
+    TYPE_AHEAD_LIMIT = 50
+    TYPE_AHEAD_DELAY_MS = 150
+    SEARCH_DELAY_MS = 250
+    # Above this many rows, comboboxes query SQLite instead of an in-memory index
+    LARGE_TABLE_ROWS = 20000
+    # The status panel re-renders from the federation's cached health state
+    STATUS_REFRESH_MS = 5000
+    
+    def __init__(self, root, is_master=False, local_port=5000, local_db='hospital.db', hospital_name='Hospital',
+                 federation_url=None):
         self.root = root
         self.is_master = is_master
         self.local_port = local_port
         self.local_db = local_db
         self.hospital_name = hospital_name
         
+        # Startup timing marks (ms since gui.py was imported)
+        self.startup_marks = []
+        self.mark_startup('imports done')
+        
         # Initialize local database
-        self.local_db_instance = HospitalDatabase(local_db, hospital_name)
+        self.local_db_instance = open_database(local_db, hospital_name)
+        self.mark_startup('database opened')
+        
+        # Cross-hospital aggregation (if master): in-process, or a shared
+        # headless federation service when federation_url is given. Imported
+        # here so other hospitals don't load Flask, requests and linkage.
+        self.federation = None
+        if is_master:
+            if federation_url:
+                from client import FederationClient
+                self.federation = FederationClient(federation_url)
+            else:
+                from federation import FederationService
+                self.federation = FederationService(self.local_db_instance)
+        self.mark_startup('federation ready')
         
-        # Initialize clients for remote hospitals (if master)
-        self.remote_clients = []
+        # Shared in-memory copy of local and remote tables, and the tab
+        # views rendering it
+        self.store = DataStore()
+        self.views = {}
+        self.view_filters = {}
+        
+        # Type-ahead sources shared by all dialogs, built on first use, and
+        # the callbacks waiting for one that is being built
+        self.lookups = {}
+        self.lookup_waiting = {}
+        
+        # Pending debounced searches per tab
+        self.search_timers = {}
+        self.status_timer = None
+        
+        # Background workers for DB queries and federation calls
+        self.loader = BackgroundExecutor(root, on_busy_change=self.update_busy_indicator)
         
         self.root.title(f"{hospital_name} Management System {'(MASTER)' if is_master else ''}")
         self.root.geometry("1200x700")
         self.root.configure(bg='#f0f0f0')
+        self.root.protocol('WM_DELETE_WINDOW', self.on_close)
+        
+        # Tab frame -> loader, popped the first time the tab is shown
+        self.tab_loaders = {}
         
         self.setup_ui()
+        self.mark_startup('ui built')
+        self.root.after_idle(self.on_first_paint)
+    
+    def mark_startup(self, label):
+        self.startup_marks.append((label, (time.perf_counter() - STARTUP_STARTED) * 1000))
+    
+    def on_first_paint(self):
+        self.root.update_idletasks()
+        self.mark_startup('first paint')
+        self.on_tab_changed()
+        self.loader.when_idle(self.report_startup)
+    
+    def report_startup(self):
+        self.mark_startup('first tab loaded')
+        print("Startup timing (ms since launch):")
+        for label, elapsed in self.startup_marks:
+            print(f"  {label:<18}{elapsed:8.1f}")
+    
+    def on_tab_changed(self, event=None):
+        """Load a tab's data the first time it is shown"""
+        load = self.tab_loaders.pop(self.notebook.select(), None)
+        if load:
+            load()
+    
+    def on_close(self):
+        self.loader.shutdown()
+        self.root.destroy()
     
     def validate_name(self, name):
         """Validate name - minimum 3 characters"""
@@ -168,29 +762,133 @@ class HospitalManagementGUI:
         except ValueError:
             return False, "Invalid time format"
     
+    def check_doctor_free(self, doctor_id, date_value, time_value, status, appointment_id=None):
+        """Error message if the doctor already has an appointment then,
+        naming the doctor's next free slots; None if the booking fits.
+        Queries the database, so it runs on the loader (see save_row)."""
+        if status == 'Cancelled':
+            return None
+        conflicts = self.local_db_instance.conflicts(int(doctor_id), date_value, time_value, appointment_id)
+        if not conflicts:
+            return None
+        free = self.local_db_instance.free_slots(count=3, after=f"{date_value} {time_value}",
+                                                 doctor_id=int(doctor_id))
+        return (f"Doctor is booked at {conflicts[0]['appointment_time']} that day. "
+                f"Next free: {', '.join(slot['date'] + ' ' + slot['time'] for slot in free) or 'none soon'}")
+    
     def add_remote_hospital(self, url):
         """Add a remote hospital connection (for master laptop)"""
-        client = HospitalClient(url)
-        if client.check_health():
-            self.remote_clients.append(client)
-            return True
-        return False
-    
-    def get_hospital_prefix(self, hospital_name=None):
-        """Get unique prefix for hospital to avoid ID conflicts"""
-        if hospital_name is None:
-            hospital_name = self.hospital_name
-        
-        # Create short prefix from hospital name
-        if 'Central' in hospital_name:
-            return 'CEN'
-        elif 'City' in hospital_name:
-            return 'CTY'
-        elif 'General' in hospital_name:
-            return 'GEN'
+        return self.federation.add_hospital(url) is not None
+    
+    def get_lookup(self, table, callback):
+        """Call callback with the shared type-ahead source for 'patients' or
+        'doctors', right away if it is built, otherwise once the loader has
+        built it.
+        
+        Small tables get an in-memory trigram index built once from the
+        store and kept current by a store subscription; large ones are
+        queried in SQLite with a LIMIT so dialogs never load every row.
+        """
+        if table in self.lookups:
+            callback(self.lookups[table])
+            return
+        self.lookup_waiting.setdefault(table, []).append(callback)
+        if len(self.lookup_waiting[table]) > 1:
+            return
+        id_column, columns, to_label = LOOKUP_SPECS[table]
+        loaded = self.store.is_loaded(table, self.hospital_name)
+        
+        def build():
+            if self.local_db_instance.count(table) > self.LARGE_TABLE_ROWS:
+                return DatabaseLookup(self.local_db_instance, table, id_column, columns, to_label)
+            if not loaded:
+                return [make_record(table, row, self.hospital_name)
+                        for row in self.local_db_instance.get_all(table)]
+            return None
+        
+        def built(result):
+            if isinstance(result, DatabaseLookup):
+                source = result
+            else:
+                if result is not None and not self.store.is_loaded(table, self.hospital_name):
+                    self.store.replace(table, self.hospital_name, result)
+                source = TypeAheadIndex({record[0]: to_label(record)
+                                         for record in self.store.records(table, self.hospital_name)})
+                
+                def update_index(upserts, deletes):
+                    for record in deletes:
+                        if record.hospital == self.hospital_name:
+                            source.remove(record[0])
+                    for record in upserts:
+                        if record.hospital == self.hospital_name:
+                            source.add(record[0], to_label(record))
+                
+                self.store.subscribe(table, update_index)
+            self.lookups[table] = source
+            for waiting in self.lookup_waiting.pop(table, []):
+                waiting(source)
+        
+        def failed(error):
+            self.lookup_waiting.pop(table, None)
+            self.show_load_error(table)(error)
+        
+        self.loader.submit(('lookup', table), build, built, failed, replace=False)
+    
+    def ask_lookup(self, key, source, ask, on_answer):
+        """Call on_answer with ask(source): right away for an in-memory
+        index, from the loader for a DatabaseLookup, which queries SQLite"""
+        if isinstance(source, TypeAheadIndex):
+            on_answer(ask(source))
         else:
-            # Generate prefix from first 3 letters
-            return hospital_name[:3].upper()
+            self.loader.submit(key, lambda: ask(source), on_answer)
+    
+    def bind_lookups(self, combos, current=None):
+        """Bind type-ahead to a dialog's patient and doctor combos
+        ({table: (combo, var)}) once their lookups are built.
+        
+        Returns (sources, labels): the lookups by table, filled as they
+        arrive, and the labels of the IDs in current ({table: local ID})
+        that prefill the combos.
+        """
+        sources = {}
+        labels = {}
+        for table, (combo, var) in combos.items():
+            def ready(source, table=table, combo=combo, var=var):
+                if not combo.winfo_exists():
+                    return
+                sources[table] = source
+                self.bind_type_ahead(combo, var, source)
+                if current and current.get(table) is not None:
+                    def prefill(label):
+                        labels[table] = label
+                        if label and combo.winfo_exists() and not var.get():
+                            var.set(label)
+                    self.ask_lookup(('label', str(combo)), source,
+                                    lambda source: source.label_for(current[table]), prefill)
+            self.get_lookup(table, ready)
+        return sources, labels
+    
+    def bind_type_ahead(self, combo, var, source):
+        """Filter combo's dropdown as the user types, debounced and capped"""
+        pending = []
+        
+        def show(labels):
+            if combo.winfo_exists():
+                combo['values'] = labels
+        
+        def refresh():
+            pending.clear()
+            term = var.get().strip()
+            self.ask_lookup(('type-ahead', str(combo)), source,
+                            lambda source: source.search(term, self.TYPE_AHEAD_LIMIT), show)
+        
+        def on_key(event):
+            if pending:
+                combo.after_cancel(pending.pop())
+            pending.append(combo.after(self.TYPE_AHEAD_DELAY_MS, refresh))
+        
+        combo.bind('<KeyRelease>', on_key)
+        refresh()
     
     def setup_ui(self):
         # Title
@@ -207,6 +905,15 @@ class HospitalManagementGUI:
                                    font=('Arial', 10, 'bold'), fg='#f39c12', bg='#2c3e50')
             master_label.pack()
         
+        # Status bar with progress indicator for background loads
+        status_bar = tk.Frame(self.root, bg='#f0f0f0')
+        status_bar.pack(side='bottom', fill='x', padx=10, pady=(0, 5))
+        self.status_var = tk.StringVar(value="Ready")
+        tk.Label(status_bar, textvariable=self.status_var, font=('Arial', 9), 
+                bg='#f0f0f0', anchor='w').pack(side='left', fill='x', expand=True)
+        self.progress = ttk.Progressbar(status_bar, mode='indeterminate', length=150)
+        self.progress.pack(side='right')
+        
         # Main container
         main_container = tk.Frame(self.root, bg='#f0f0f0')
         main_container.pack(fill='both', expand=True, padx=10, pady=10)
@@ -214,6 +921,7 @@ class HospitalManagementGUI:
         # Notebook for tabs
         self.notebook = ttk.Notebook(main_container)
         self.notebook.pack(fill='both', expand=True)
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
         
         # Create tabs
         self.create_patients_tab()
@@ -223,6 +931,7 @@ class HospitalManagementGUI:
         
         if self.is_master:
             self.create_master_control_tab()
+            self.create_dashboard_tab()
     
     def create_patients_tab(self):
         patients_frame = tk.Frame(self.notebook, bg='white')
@@ -236,6 +945,7 @@ class HospitalManagementGUI:
         self.patient_search_var = tk.StringVar()
         search_entry = tk.Entry(search_frame, textvariable=self.patient_search_var, width=30)
         search_entry.pack(side='left', padx=5)
+        search_entry.bind('<KeyRelease>', lambda event: self.schedule_search('patients', self.search_patients))
         
         tk.Button(search_frame, text="Search", command=self.search_patients, 
                  bg='#3498db', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
@@ -250,30 +960,15 @@ class HospitalManagementGUI:
         table_frame = tk.Frame(patients_frame, bg='white')
         table_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        # Scrollbars
-        v_scrollbar = tk.Scrollbar(table_frame)
-        v_scrollbar.pack(side='right', fill='y')
-        h_scrollbar = tk.Scrollbar(table_frame, orient='horizontal')
-        h_scrollbar.pack(side='bottom', fill='x')
-        
-        # Treeview
         columns = ('ID', 'Name', 'Age', 'Gender', 'Phone', 'Address', 'Hospital')
-        self.patients_tree = ttk.Treeview(table_frame, columns=columns, show='headings',
-                                         yscrollcommand=v_scrollbar.set,
-                                         xscrollcommand=h_scrollbar.set)
-        
-        for col in columns:
-            self.patients_tree.heading(col, text=col)
-            self.patients_tree.column(col, width=120)
-        
-        self.patients_tree.pack(fill='both', expand=True)
-        v_scrollbar.config(command=self.patients_tree.yview)
-        h_scrollbar.config(command=self.patients_tree.xview)
+        self.patients_table = VirtualTable(table_frame, columns, 120)
+        self.patients_tree = self.patients_table.tree
         
         # Bind double-click event
         self.patients_tree.bind('<Double-1>', self.update_patient_dialog)
         
-        self.load_patients()
+        self.bind_view('patients', self.patients_table, self.patient_values)
+        self.tab_loaders[str(patients_frame)] = self.load_patients
     
     def create_doctors_tab(self):
         doctors_frame = tk.Frame(self.notebook, bg='white')
@@ -287,6 +982,7 @@ class HospitalManagementGUI:
         self.doctor_search_var = tk.StringVar()
         search_entry = tk.Entry(search_frame, textvariable=self.doctor_search_var, width=30)
         search_entry.pack(side='left', padx=5)
+        search_entry.bind('<KeyRelease>', lambda event: self.schedule_search('doctors', self.search_doctors))
         
         tk.Button(search_frame, text="Search", command=self.search_doctors, 
                  bg='#3498db', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
@@ -301,28 +997,15 @@ class HospitalManagementGUI:
         table_frame = tk.Frame(doctors_frame, bg='white')
         table_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        v_scrollbar = tk.Scrollbar(table_frame)
-        v_scrollbar.pack(side='right', fill='y')
-        h_scrollbar = tk.Scrollbar(table_frame, orient='horizontal')
-        h_scrollbar.pack(side='bottom', fill='x')
-        
         columns = ('ID', 'Name', 'Specialization', 'Phone', 'Email', 'Hospital')
-        self.doctors_tree = ttk.Treeview(table_frame, columns=columns, show='headings',
-                                        yscrollcommand=v_scrollbar.set,
-                                        xscrollcommand=h_scrollbar.set)
-        
-        for col in columns:
-            self.doctors_tree.heading(col, text=col)
-            self.doctors_tree.column(col, width=150)
-        
-        self.doctors_tree.pack(fill='both', expand=True)
-        v_scrollbar.config(command=self.doctors_tree.yview)
-        h_scrollbar.config(command=self.doctors_tree.xview)
+        self.doctors_table = VirtualTable(table_frame, columns, 150)
+        self.doctors_tree = self.doctors_table.tree
         
         # Bind double-click event
         self.doctors_tree.bind('<Double-1>', self.update_doctor_dialog)
         
-        self.load_doctors()
+        self.bind_view('doctors', self.doctors_table, self.doctor_values)
+        self.tab_loaders[str(doctors_frame)] = self.load_doctors
 
     def create_appointments_tab(self):
         appointments_frame = tk.Frame(self.notebook, bg='white')
@@ -338,33 +1021,23 @@ class HospitalManagementGUI:
                  bg='#e74c3c', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
         tk.Button(control_frame, text="Delete Selected", command=self.delete_appointment, 
                  bg='#c0392b', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
+        self.appointments_archive_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(control_frame, text="Include archive", variable=self.appointments_archive_var,
+                       command=self.load_appointments, bg='white', font=('Arial', 10)).pack(side='left', padx=5)
         
         # Table frame
         table_frame = tk.Frame(appointments_frame, bg='white')
         table_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        v_scrollbar = tk.Scrollbar(table_frame)
-        v_scrollbar.pack(side='right', fill='y')
-        h_scrollbar = tk.Scrollbar(table_frame, orient='horizontal')
-        h_scrollbar.pack(side='bottom', fill='x')
-        
-        columns = ('ID', 'Patient ID', 'Doctor ID', 'Date', 'Time', 'Status', 'Hospital')
-        self.appointments_tree = ttk.Treeview(table_frame, columns=columns, show='headings',
-                                             yscrollcommand=v_scrollbar.set,
-                                             xscrollcommand=h_scrollbar.set)
-        
-        for col in columns:
-            self.appointments_tree.heading(col, text=col)
-            self.appointments_tree.column(col, width=120)
-        
-        self.appointments_tree.pack(fill='both', expand=True)
-        v_scrollbar.config(command=self.appointments_tree.yview)
-        h_scrollbar.config(command=self.appointments_tree.xview)
+        columns = ('ID', 'Patient', 'Doctor', 'Date', 'Time', 'Status', 'Hospital')
+        self.appointments_table = VirtualTable(table_frame, columns, 120)
+        self.appointments_tree = self.appointments_table.tree
         
         # Bind double-click event
         self.appointments_tree.bind('<Double-1>', self.update_appointment_dialog)
         
-        self.load_appointments()
+        self.bind_view('appointments', self.appointments_table, self.appointment_values)
+        self.tab_loaders[str(appointments_frame)] = self.load_appointments
     
     def create_medical_records_tab(self):
         records_frame = tk.Frame(self.notebook, bg='white')
@@ -380,33 +1053,23 @@ class HospitalManagementGUI:
                  bg='#e74c3c', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
         tk.Button(control_frame, text="Delete Selected", command=self.delete_medical_record, 
                  bg='#c0392b', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
+        self.records_archive_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(control_frame, text="Include archive", variable=self.records_archive_var,
+                       command=self.load_medical_records, bg='white', font=('Arial', 10)).pack(side='left', padx=5)
         
         # Table frame
         table_frame = tk.Frame(records_frame, bg='white')
         table_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        v_scrollbar = tk.Scrollbar(table_frame)
-        v_scrollbar.pack(side='right', fill='y')
-        h_scrollbar = tk.Scrollbar(table_frame, orient='horizontal')
-        h_scrollbar.pack(side='bottom', fill='x')
-        
-        columns = ('ID', 'Patient ID', 'Doctor ID', 'Diagnosis', 'Prescription', 'Date', 'Hospital')
-        self.records_tree = ttk.Treeview(table_frame, columns=columns, show='headings',
-                                        yscrollcommand=v_scrollbar.set,
-                                        xscrollcommand=h_scrollbar.set)
-        
-        for col in columns:
-            self.records_tree.heading(col, text=col)
-            self.records_tree.column(col, width=150)
-        
-        self.records_tree.pack(fill='both', expand=True)
-        v_scrollbar.config(command=self.records_tree.yview)
-        h_scrollbar.config(command=self.records_tree.xview)
+        columns = ('ID', 'Patient', 'Doctor', 'Diagnosis', 'Prescription', 'Date', 'Hospital')
+        self.records_table = VirtualTable(table_frame, columns, 150)
+        self.records_tree = self.records_table.tree
         
         # Bind double-click event
         self.records_tree.bind('<Double-1>', self.update_medical_record_dialog)
         
-        self.load_medical_records()
+        self.bind_view('medical_records', self.records_table, self.record_values)
+        self.tab_loaders[str(records_frame)] = self.load_medical_records
     
     def create_master_control_tab(self):
         master_frame = tk.Frame(self.notebook, bg='white')
@@ -435,250 +1098,406 @@ class HospitalManagementGUI:
         tk.Button(master_frame, text="Refresh All Data", command=self.refresh_all_data, 
                  bg='#2ecc71', fg='white', font=('Arial', 12, 'bold')).pack(pady=20)
         
-        self.update_connection_status()
+        self.tab_loaders[str(master_frame)] = self.update_connection_status
+    
+    def create_dashboard_tab(self):
+        dashboard_frame = tk.Frame(self.notebook, bg='white')
+        self.notebook.add(dashboard_frame, text='Dashboard')
+        
+        control_frame = tk.Frame(dashboard_frame, bg='white')
+        control_frame.pack(fill='x', padx=10, pady=10)
+        
+        tk.Button(control_frame, text="Refresh", command=self.load_dashboard, 
+                 bg='#2ecc71', fg='white', font=('Arial', 10)).pack(side='left', padx=5)
+        tk.Label(control_frame, text="Days:", font=('Arial', 10), bg='white').pack(side='left', padx=5)
+        self.dashboard_days_var = tk.StringVar(value='30')
+        tk.Entry(control_frame, textvariable=self.dashboard_days_var, width=5).pack(side='left', padx=5)
+        self.dashboard_summary_var = tk.StringVar()
+        tk.Label(control_frame, textvariable=self.dashboard_summary_var, font=('Arial', 10), 
+                bg='white').pack(side='left', padx=15)
+        
+        # Appointments by status and hospital, and per day
+        top_frame = tk.Frame(dashboard_frame, bg='white')
+        top_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        self.status_tree = self.dashboard_tree(top_frame, ('Hospital', 'Status', 'Appointments'))
+        self.days_tree = self.dashboard_tree(top_frame, ('Day', 'Status', 'Appointments'))
+        
+        # Patients per doctor and most common diagnoses
+        bottom_frame = tk.Frame(dashboard_frame, bg='white')
+        bottom_frame.pack(fill='both', expand=True, padx=10, pady=5)
+        self.doctor_load_tree = self.dashboard_tree(bottom_frame, ('Doctor', 'Specialization', 'Hospital', 'Patients'))
+        self.diagnoses_tree = self.dashboard_tree(bottom_frame, ('Diagnosis', 'Records'))
+        
+        self.tab_loaders[str(dashboard_frame)] = self.load_dashboard
+    
+    def dashboard_tree(self, parent, columns):
+        frame = tk.Frame(parent, bg='white')
+        frame.pack(side='left', fill='both', expand=True, padx=5)
+        tree = ttk.Treeview(frame, columns=columns, show='headings', height=8)
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=110)
+        scrollbar = ttk.Scrollbar(frame, orient='vertical', command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side='left', fill='both', expand=True)
+        scrollbar.pack(side='right', fill='y')
+        return tree
+    
+    def load_dashboard(self):
+        """Fetch the federated statistics summary in the background"""
+        try:
+            days = int(self.dashboard_days_var.get())
+        except ValueError:
+            days = 30
+        since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        self.loader.submit('dashboard', lambda: self.federation.stats(since),
+                           self.show_dashboard, self.show_load_error('dashboard'))
+    
+    def show_dashboard(self, stats):
+        if not stats:
+            return
+        for tree in (self.status_tree, self.days_tree, self.doctor_load_tree, self.diagnoses_tree):
+            tree.delete(*tree.get_children())
+        for hospital, by_status in stats['appointments_by_hospital'].items():
+            for status, count in sorted(by_status.items(), key=lambda item: str(item[0])):
+                self.status_tree.insert('', 'end', values=(hospital, status, count))
+        for status, count in sorted(stats['appointments_by_status'].items(), key=lambda item: str(item[0])):
+            self.status_tree.insert('', 'end', values=('All', status, count))
+        for row in reversed(stats['appointments_by_day']):
+            self.days_tree.insert('', 'end', values=(row['day'], row['status'], row['count']))
+        for row in stats['patients_per_doctor']:
+            self.doctor_load_tree.insert('', 'end', values=(row['name'], row['specialization'],
+                                                            row['hospital'], row['patients']))
+        for row in stats['top_diagnoses']:
+            self.diagnoses_tree.insert('', 'end', values=(row['diagnosis'], row['count']))
+        summary = f"{sum(stats['appointments_by_status'].values())} appointments in {len(stats['hospitals'])} hospitals"
+        if stats['missing']:
+            summary += f" (unavailable: {', '.join(stats['missing'])})"
+        self.dashboard_summary_var.set(summary)
     
     def connect_hospital(self):
         url = self.hospital_url_var.get().strip()
         if url:
-            if self.add_remote_hospital(url):
-                messagebox.showinfo("Success", f"Connected to hospital at {url}")
-                self.update_connection_status()
-                self.hospital_url_var.set('')
-            else:
-                messagebox.showerror("Error", f"Failed to connect to {url}")
+            # Registration (and its health check) runs in the background
+            def connected(hospital):
+                if hospital:
+                    messagebox.showinfo("Success", f"Connected to hospital at {url}")
+                    self.update_connection_status()
+                    self.hospital_url_var.set('')
+                else:
+                    messagebox.showerror("Error", f"Failed to connect to {url}")
+            
+            self.loader.submit(('connect', url), lambda: self.federation.add_hospital(url),
+                               connected, self.show_load_error(url))
     
     def update_connection_status(self):
+        """Fetch the monitor's cached hospital health in the background,
+        render the status panel and schedule the next refresh"""
+        if self.status_timer:
+            self.root.after_cancel(self.status_timer)
+        self.status_timer = self.root.after(self.STATUS_REFRESH_MS, self.update_connection_status)
+        self.loader.submit('connection-status', self.federation.hospital_status,
+                           self.show_connection_status,
+                           self.show_load_error('connection status'))
+    
+    def show_connection_status(self, statuses):
         self.status_text.delete(1.0, tk.END)
         self.status_text.insert(tk.END, f"Local Hospital: {self.hospital_name} (localhost:{self.local_port})\n\n")
         
-        if self.remote_clients:
+        if statuses:
             self.status_text.insert(tk.END, "Connected Remote Hospitals:\n")
-            for i, client in enumerate(self.remote_clients, 1):
-                health = client.check_health()
-                if health:
-                    self.status_text.insert(tk.END, f"{i}. {health['hospital']} - {client.base_url} [ONLINE]\n")
-                else:
-                    self.status_text.insert(tk.END, f"{i}. {client.base_url} [OFFLINE]\n")
+            for i, status in enumerate(statuses, 1):
+                state = 'ONLINE' if status['online'] else ('DEGRADED' if status['healthy'] else 'OFFLINE')
+                self.status_text.insert(tk.END, f"{i}. {status['hospital']} - {status['url']} [{state}]\n")
+                self.status_text.insert(tk.END, f"     {self.format_health(status)}\n")
         else:
             self.status_text.insert(tk.END, "No remote hospitals connected.\n")
     
-    def load_patients(self):
-        for item in self.patients_tree.get_children():
-            self.patients_tree.delete(item)
-        
-        # Load local patients
-        local_patients = self.local_db_instance.get_all('patients')
-        for patient in local_patients:
-            patient_id = f"{self.get_hospital_prefix()}-{patient.get('patient_id', '')}"
-            self.patients_tree.insert('', 'end', values=(
-                patient_id,
-                patient.get('name', ''),
-                patient.get('age', ''),
-                patient.get('gender', ''),
-                patient.get('phone', ''),
-                patient.get('address', ''),
-                self.hospital_name
-            ))
-        
-        # Load remote patients if master
+    def format_health(self, status):
+        if not status['checks']:
+            return "not checked yet"
+        parts = []
+        if status['latency_p50_ms'] is not None:
+            parts.append(f"latency p50 {status['latency_p50_ms']}ms / p95 {status['latency_p95_ms']}ms"
+                         f" / p99 {status['latency_p99_ms']}ms")
+        parts.append(f"uptime {status['uptime'] * 100:.1f}%")
+        if status['last_seen']:
+            parts.append(f"last seen {int(time.time() - status['last_seen'])}s ago")
+        else:
+            parts.append("never seen")
+        return ", ".join(parts)
+    
+    def update_busy_indicator(self, busy):
+        if busy:
+            self.status_var.set(f"Loading... ({busy} pending)")
+            self.progress.start(10)
+        else:
+            self.status_var.set("Ready")
+            self.progress.stop()
+    
+    def show_load_error(self, what):
+        def handler(error):
+            self.status_var.set(f"Failed to load {what}: {error}")
+        return handler
+    
+    def patient_values(self, patient):
+        return (
+            patient.gid,
+            patient.patient_id,
+            patient.name,
+            patient.age,
+            patient.gender,
+            patient.phone,
+            patient.address,
+            patient.hospital
+        )
+    
+    def doctor_values(self, doctor):
+        return (
+            doctor.gid,
+            doctor.doctor_id,
+            doctor.name,
+            doctor.specialization,
+            doctor.phone,
+            doctor.email,
+            doctor.hospital
+        )
+    
+    def appointment_values(self, appt):
+        return (
+            appt.gid,
+            appt.appointment_id,
+            reference_label(appt.patient_id, appt.patient_name),
+            reference_label(appt.doctor_id, appt.doctor_name),
+            appt.appointment_date,
+            appt.appointment_time,
+            appt.status,
+            appt.hospital
+        )
+    
+    def record_values(self, record):
+        return (
+            record.gid,
+            record.record_id,
+            reference_label(record.patient_id, record.patient_name),
+            reference_label(record.doctor_id, record.doctor_name),
+            record.diagnosis,
+            record.prescription,
+            record.record_date,
+            record.hospital
+        )
+    
+    def bind_view(self, table, view, to_values):
+        """Render the store's table into a VirtualTable, filtered by the
+        tab's search term, and keep it current as the store changes"""
+        self.views[table] = (view, to_values)
+        self.view_filters[table] = ''
+        self.store.subscribe(table, lambda upserts, deletes: self.on_store_change(table, upserts, deletes))
+    
+    def on_store_change(self, table, upserts, deletes):
+        view, to_values = self.views[table]
+        term = self.view_filters[table]
+        shown = []
+        hidden = [record.gid for record in deletes]
+        for record in upserts:
+            if not term or record_matches(record, term):
+                shown.append(to_values(record))
+            else:
+                hidden.append(record.gid)
+        view.apply_changes(shown, hidden)
+    
+    def refresh_view(self, table):
+        view, to_values = self.views[table]
+        term = self.view_filters[table]
+        view.set_rows([to_values(record) for record in self.store.records(table)
+                       if not term or record_matches(record, term)])
+    
+    def load_table(self, table, local_fetch):
+        """Reload a table into the store from the local database (and every
+        remote hospital, via the federation, on the master) in the background. A newer load for
+        the same table supersedes any that is still running."""
+        if self.view_filters[table]:
+            self.view_filters[table] = ''
+            self.refresh_view(table)
+        
+        def fetch():
+            results = [(self.hospital_name, local_fetch())]
+            if self.is_master:
+                results.extend(self.federation.query(table))
+            return [(hospital, [make_record(table, row, hospital) for row in rows])
+                    for hospital, rows in results]
+        
+        def apply(results):
+            for hospital, records in results:
+                self.store.replace(table, hospital, records)
+        
+        self.loader.submit(table, fetch, apply, self.show_load_error(table))
+    
+    def schedule_search(self, table, search):
+        """Debounce search-as-you-type: run search once typing pauses"""
+        timer = self.search_timers.pop(table, None)
+        if timer:
+            self.root.after_cancel(timer)
+        self.search_timers[table] = self.root.after(self.SEARCH_DELAY_MS, search)
+    
+    def search_table(self, table, search_term, local_search):
+        """Filter a tab from the store right away, then query the local
+        database (if not already in the store) and every remote hospital in
+        parallel, merging each hospital's hits into the store as they return.
+        
+        A newer search on the same tab cancels pending requests and drops
+        late results from older ones.
+        """
+        self.search_timers.pop(table, None)
+        search_term = search_term.strip()
+        self.view_filters[table] = search_term
+        self.refresh_view(table)
+        
+        key = ('search', table)
+        self.loader.cancel(key)
+        if not search_term:
+            return
+        
+        def merge(hospital, rows):
+            self.store.merge(table, [make_record(table, row, hospital) for row in rows])
+        
+        if not self.store.is_loaded(table, self.hospital_name):
+            self.loader.submit(key, lambda: local_search(search_term),
+                               lambda rows: merge(self.hospital_name, rows),
+                               self.show_load_error(table), replace=False)
         if self.is_master:
-            for client in self.remote_clients:
-                remote_patients = client.get_patients()
-                health = client.check_health()
-                hospital_name = health['hospital'] if health else 'Unknown'
-                hospital_prefix = self.get_hospital_prefix(hospital_name)
-                for patient in remote_patients:
-                    patient_id = f"{hospital_prefix}-{patient.get('patient_id', '')}"
-                    self.patients_tree.insert('', 'end', values=(
-                        patient_id,
-                        patient.get('name', ''),
-                        patient.get('age', ''),
-                        patient.get('gender', ''),
-                        patient.get('phone', ''),
-                        patient.get('address', ''),
-                        hospital_name
-                    ))
+            # One federation query per hospital, so each streams in on its own
+            def search_each(hospitals):
+                for hospital in hospitals:
+                    self.loader.submit(key,
+                                       lambda url=hospital['url']: self.federation.query(table, search_term, url),
+                                       lambda results: [merge(*result) for result in results],
+                                       self.show_load_error(hospital['url']), replace=False)
+            
+            self.loader.submit(key, self.federation.hospitals, search_each,
+                               self.show_load_error(table), replace=False)
+    
+    def written_row(self, table, result):
+        """The row a write returned, with the patient's and doctor's names
+        joined in for list views. Queries the database, so it runs on the
+        loader."""
+        row = result['row']
+        if row is not None and table in VIEW_FILTERS:
+            rows = self.local_db_instance.list_view(table, filters={ID_COLUMNS[table]: row[ID_COLUMNS[table]]})['rows']
+            row = rows[0] if rows else row
+        return {**result, 'row': row}
+    
+    def store_written_row(self, table, result):
+        """Publish the row returned by a write of this GUI (see written_row)
+        to the store, so only that row is redrawn"""
+        if result['row'] is not None:
+            self.store.upsert(table, make_record(table, result['row'], self.hospital_name))
+    
+    def drop_local_row(self, table, row_id):
+        """Remove a row this GUI deleted from the store, with the
+        appointments and medical records deleted along with it"""
+        self.store.delete(table, make_gid(self.local_db_instance.hospital_id, row_id))
+        for dependent, column in DEPENDENTS.get(table, ()):
+            self.store.delete_many(dependent, [record.gid for record in self.store.records(dependent, self.hospital_name)
+                                               if getattr(record, column) == row_id])
+    
+    def save_row(self, dialog, table, write, message, refused=None):
+        """Run a dialog's write on the loader rather than the Tk thread.
+        
+        write() returns a write_result, or an error message if the row
+        can't be saved (checks that need the database run in write() too),
+        which goes to refused(). Once saved, the row is published to the
+        store and the dialog closed. The dialog's buttons are disabled
+        meanwhile, so a row is never saved twice.
+        """
+        buttons = [child for child in dialog.winfo_children() if isinstance(child, tk.Button)]
+        for button in buttons:
+            button.config(state='disabled')
+        
+        def run():
+            result = write()
+            return result if isinstance(result, str) else self.written_row(table, result)
+        
+        def reopen():
+            if dialog.winfo_exists():
+                for button in buttons:
+                    button.config(state='normal')
+                return True
+            return False
+        
+        def done(result):
+            if isinstance(result, str):
+                if reopen() and refused:
+                    refused(result)
+                return
+            self.store_written_row(table, result)
+            messagebox.showinfo("Success", message)
+            if dialog.winfo_exists():
+                dialog.destroy()
+        
+        def failed(error):
+            reopen()
+            messagebox.showerror("Error", f"Could not save: {error}")
+        
+        self.loader.submit(('write', table), run, done, failed, replace=False)
+    
+    def delete_row(self, table, row_id, message):
+        """Delete a local row on the loader; once done, drop it and the rows
+        deleted with it from the store"""
+        def done(result):
+            self.drop_local_row(table, row_id)
+            messagebox.showinfo("Success", message)
+        
+        def failed(error):
+            messagebox.showerror("Error", f"Could not delete: {error}")
+        
+        self.loader.submit(('write', table),
+                           lambda: self.local_db_instance.delete(table, ID_COLUMNS[table], row_id),
+                           done, failed, replace=False)
+    
+    def selected_local_id(self, view):
+        """Local row ID of the view's selected row, or None if the row
+        belongs to a remote hospital"""
+        hospital_id, row_id = split_gid(view.selected_key)
+        return row_id if hospital_id == self.local_db_instance.hospital_id else None
+    
+    def load_patients(self):
+        self.load_table('patients',
+                        lambda: self.local_db_instance.get_all('patients'))
     
     def search_patients(self):
-        search_term = self.patient_search_var.get()
-        for item in self.patients_tree.get_children():
-            self.patients_tree.delete(item)
-        
-        # Search local
-        local_patients = self.local_db_instance.search('patients', search_term)
-        for patient in local_patients:
-            patient_id = f"{self.get_hospital_prefix()}-{patient.get('patient_id', '')}"
-            self.patients_tree.insert('', 'end', values=(
-                patient_id,
-                patient.get('name', ''),
-                patient.get('age', ''),
-                patient.get('gender', ''),
-                patient.get('phone', ''),
-                patient.get('address', ''),
-                self.hospital_name
-            ))
-        
-        # Search remote if master
-        if self.is_master:
-            for client in self.remote_clients:
-                remote_patients = client.get_patients(search_term)
-                health = client.check_health()
-                hospital_name = health['hospital'] if health else 'Unknown'
-                hospital_prefix = self.get_hospital_prefix(hospital_name)
-                for patient in remote_patients:
-                    patient_id = f"{hospital_prefix}-{patient.get('patient_id', '')}"
-                    self.patients_tree.insert('', 'end', values=(
-                        patient_id,
-                        patient.get('name', ''),
-                        patient.get('age', ''),
-                        patient.get('gender', ''),
-                        patient.get('phone', ''),
-                        patient.get('address', ''),
-                        hospital_name
-                    ))
+        self.search_table('patients', self.patient_search_var.get(),
+                          lambda term: self.local_db_instance.search('patients', term))
     
     def load_doctors(self):
-        for item in self.doctors_tree.get_children():
-            self.doctors_tree.delete(item)
-        
-        local_doctors = self.local_db_instance.get_all('doctors')
-        for doctor in local_doctors:
-            doctor_id = f"{self.get_hospital_prefix()}-{doctor.get('doctor_id', '')}"
-            self.doctors_tree.insert('', 'end', values=(
-                doctor_id,
-                doctor.get('name', ''),
-                doctor.get('specialization', ''),
-                doctor.get('phone', ''),
-                doctor.get('email', ''),
-                self.hospital_name
-            ))
-        
-        if self.is_master:
-            for client in self.remote_clients:
-                remote_doctors = client.get_doctors()
-                health = client.check_health()
-                hospital_name = health['hospital'] if health else 'Unknown'
-                hospital_prefix = self.get_hospital_prefix(hospital_name)
-                for doctor in remote_doctors:
-                    doctor_id = f"{hospital_prefix}-{doctor.get('doctor_id', '')}"
-                    self.doctors_tree.insert('', 'end', values=(
-                        doctor_id,
-                        doctor.get('name', ''),
-                        doctor.get('specialization', ''),
-                        doctor.get('phone', ''),
-                        doctor.get('email', ''),
-                        hospital_name
-                    ))
+        self.load_table('doctors',
+                        lambda: self.local_db_instance.get_all('doctors'))
     
     def search_doctors(self):
-        search_term = self.doctor_search_var.get()
-        for item in self.doctors_tree.get_children():
-            self.doctors_tree.delete(item)
-        
-        local_doctors = self.local_db_instance.search('doctors', search_term)
-        for doctor in local_doctors:
-            doctor_id = f"{self.get_hospital_prefix()}-{doctor.get('doctor_id', '')}"
-            self.doctors_tree.insert('', 'end', values=(
-                doctor_id,
-                doctor.get('name', ''),
-                doctor.get('specialization', ''),
-                doctor.get('phone', ''),
-                doctor.get('email', ''),
-                self.hospital_name
-            ))
-        
-        if self.is_master:
-            for client in self.remote_clients:
-                remote_doctors = client.get_doctors(search_term)
-                health = client.check_health()
-                hospital_name = health['hospital'] if health else 'Unknown'
-                hospital_prefix = self.get_hospital_prefix(hospital_name)
-                for doctor in remote_doctors:
-                    doctor_id = f"{hospital_prefix}-{doctor.get('doctor_id', '')}"
-                    self.doctors_tree.insert('', 'end', values=(
-                        doctor_id,
-                        doctor.get('name', ''),
-                        doctor.get('specialization', ''),
-                        doctor.get('phone', ''),
-                        doctor.get('email', ''),
-                        hospital_name
-                    ))
+        self.search_table('doctors', self.doctor_search_var.get(),
+                          lambda term: self.local_db_instance.search('doctors', term))
 
     def load_appointments(self):
-        for item in self.appointments_tree.get_children():
-            self.appointments_tree.delete(item)
-        
-        local_appointments = self.local_db_instance.get_all('appointments')
-        hospital_prefix = self.get_hospital_prefix()
-        for appt in local_appointments:
-            self.appointments_tree.insert('', 'end', values=(
-                f"{hospital_prefix}-{appt.get('appointment_id', '')}",
-                f"{hospital_prefix}-{appt.get('patient_id', '')}",
-                f"{hospital_prefix}-{appt.get('doctor_id', '')}",
-                appt.get('appointment_date', ''),
-                appt.get('appointment_time', ''),
-                appt.get('status', ''),
-                self.hospital_name
-            ))
-        
-        if self.is_master:
-            for client in self.remote_clients:
-                remote_appointments = client.get_appointments()
-                health = client.check_health()
-                hospital_name = health['hospital'] if health else 'Unknown'
-                hospital_prefix = self.get_hospital_prefix(hospital_name)
-                for appt in remote_appointments:
-                    self.appointments_tree.insert('', 'end', values=(
-                        f"{hospital_prefix}-{appt.get('appointment_id', '')}",
-                        f"{hospital_prefix}-{appt.get('patient_id', '')}",
-                        f"{hospital_prefix}-{appt.get('doctor_id', '')}",
-                        appt.get('appointment_date', ''),
-                        appt.get('appointment_time', ''),
-                        appt.get('status', ''),
-                        hospital_name
-                    ))
+        # Archived appointments are only read (from this hospital) on request
+        include_archive = self.appointments_archive_var.get()
+        self.load_table('appointments',
+                        lambda: self.local_db_instance.list_view('appointments',
+                                                                 include_archive=include_archive)['rows'])
     
     def load_medical_records(self):
-        for item in self.records_tree.get_children():
-            self.records_tree.delete(item)
-        
-        local_records = self.local_db_instance.get_all('medical_records')
-        hospital_prefix = self.get_hospital_prefix()
-        for record in local_records:
-            self.records_tree.insert('', 'end', values=(
-                f"{hospital_prefix}-{record.get('record_id', '')}",
-                f"{hospital_prefix}-{record.get('patient_id', '')}",
-                f"{hospital_prefix}-{record.get('doctor_id', '')}",
-                record.get('diagnosis', ''),
-                record.get('prescription', ''),
-                record.get('record_date', ''),
-                self.hospital_name
-            ))
-        
-        if self.is_master:
-            for client in self.remote_clients:
-                remote_records = client.get_medical_records()
-                health = client.check_health()
-                hospital_name = health['hospital'] if health else 'Unknown'
-                hospital_prefix = self.get_hospital_prefix(hospital_name)
-                for record in remote_records:
-                    self.records_tree.insert('', 'end', values=(
-                        f"{hospital_prefix}-{record.get('record_id', '')}",
-                        f"{hospital_prefix}-{record.get('patient_id', '')}",
-                        f"{hospital_prefix}-{record.get('doctor_id', '')}",
-                        record.get('diagnosis', ''),
-                        record.get('prescription', ''),
-                        record.get('record_date', ''),
-                        hospital_name
-                    ))
+        include_archive = self.records_archive_var.get()
+        self.load_table('medical_records',
+                        lambda: self.local_db_instance.list_view('medical_records',
+                                                                 include_archive=include_archive)['rows'])
     
     def refresh_all_data(self):
+        self.tab_loaders.clear()
         self.load_patients()
         self.load_doctors()
         self.load_appointments()
         self.load_medical_records()
         self.update_connection_status()
-        messagebox.showinfo("Success", "All data refreshed!")
+        self.loader.when_idle(lambda: messagebox.showinfo("Success", "All data refreshed!"))
     
     def add_patient_dialog(self):
         dialog = tk.Toplevel(self.root)
@@ -772,10 +1591,8 @@ class HospitalManagementGUI:
             if has_error:
                 return
             
-            self.local_db_instance.insert('patients', data)
-            messagebox.showinfo("Success", "Patient added successfully!")
-            dialog.destroy()
-            self.load_patients()
+            self.save_row(dialog, 'patients', lambda: self.local_db_instance.insert('patients', data),
+                          "Patient added successfully!")
         
         tk.Button(dialog, text="Save", command=save_patient, 
                  bg='#2ecc71', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
@@ -842,10 +1659,8 @@ class HospitalManagementGUI:
             if has_error:
                 return
             
-            self.local_db_instance.insert('doctors', data)
-            messagebox.showinfo("Success", "Doctor added successfully!")
-            dialog.destroy()
-            self.load_doctors()
+            self.save_row(dialog, 'doctors', lambda: self.local_db_instance.insert('doctors', data),
+                          "Doctor added successfully!")
         
         tk.Button(dialog, text="Save", command=save_doctor, 
                  bg='#2ecc71', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
@@ -861,53 +1676,25 @@ class HospitalManagementGUI:
         form_frame = tk.Frame(dialog, bg='white')
         form_frame.pack(padx=20, pady=10)
         
-        # Get all patients and doctors
-        all_patients = self.local_db_instance.get_all('patients')
-        all_doctors = self.local_db_instance.get_all('doctors')
-        
-        # Create patient list with ID and Name
-        patient_list = [f"{p['patient_id']} - {p['name']}" for p in all_patients]
-        doctor_list = [f"{d['doctor_id']} - {d['name']} ({d['specialization']})" for d in all_doctors]
-        
         # Patient selection with search
         tk.Label(form_frame, text="Patient:", font=('Arial', 10), bg='white').grid(row=0, column=0, sticky='w', pady=5)
         patient_search_var = tk.StringVar()
         patient_combo = ttk.Combobox(form_frame, textvariable=patient_search_var, width=40)
-        patient_combo['values'] = patient_list
         patient_combo.grid(row=0, column=1, pady=5, padx=10, columnspan=2)
         
-        # Filter patients as user types
-        def filter_patients(event):
-            search_term = patient_search_var.get().lower()
-            if search_term:
-                filtered = [p for p in patient_list if search_term in p.lower()]
-                patient_combo['values'] = filtered
-            else:
-                patient_combo['values'] = patient_list
-        
-        patient_combo.bind('<KeyRelease>', filter_patients)
-        
         # Doctor selection with search
         tk.Label(form_frame, text="Doctor:", font=('Arial', 10), bg='white').grid(row=1, column=0, sticky='w', pady=5)
         doctor_search_var = tk.StringVar()
         doctor_combo = ttk.Combobox(form_frame, textvariable=doctor_search_var, width=40)
-        doctor_combo['values'] = doctor_list
         doctor_combo.grid(row=1, column=1, pady=5, padx=10, columnspan=2)
         
-        # Filter doctors as user types
-        def filter_doctors(event):
-            search_term = doctor_search_var.get().lower()
-            if search_term:
-                filtered = [d for d in doctor_list if search_term in d.lower()]
-                doctor_combo['values'] = filtered
-            else:
-                doctor_combo['values'] = doctor_list
-        
-        doctor_combo.bind('<KeyRelease>', filter_doctors)
+        # Shared type-ahead sources for patients and doctors, built on the loader
+        sources, _ = self.bind_lookups({'patients': (patient_combo, patient_search_var),
+                                        'doctors': (doctor_combo, doctor_search_var)})
         
         # Appointment Date with Calendar
         tk.Label(form_frame, text="Date:", font=('Arial', 10), bg='white').grid(row=2, column=0, sticky='w', pady=5)
-        date_entry = DateEntry(form_frame, width=39, background='darkblue',
+        date_entry = make_date_entry(form_frame, width=39, background='darkblue',
                               foreground='white', borderwidth=2, date_pattern='yyyy-mm-dd')
         date_entry.grid(row=2, column=1, pady=5, padx=10, columnspan=2)
         
@@ -924,9 +1711,12 @@ class HospitalManagementGUI:
         status_combo.grid(row=4, column=1, pady=5, padx=10, columnspan=2)
         
         # Error labels
-        error_label = tk.Label(form_frame, text="", font=('Arial', 9), fg='red', bg='white')
+        error_label = tk.Label(form_frame, text="", font=('Arial', 9), fg='red', bg='white', wraplength=450)
         error_label.grid(row=5, column=0, columnspan=3, pady=5)
         
+        invalid_patient = "Please select a valid patient from the list!"
+        invalid_doctor = "Please select a valid doctor from the list!"
+        
         def save_appointment():
             error_label.config(text="")
             
@@ -939,21 +1729,11 @@ class HospitalManagementGUI:
                 error_label.config(text="Please select a patient!")
                 return
             
-            if patient_selection not in patient_list:
-                error_label.config(text="Please select a valid patient from the list!")
-                patient_search_var.set('')
-                return
-            
             # Validate doctor selection - must be from dropdown list
             if not doctor_selection:
                 error_label.config(text="Please select a doctor!")
                 return
             
-            if doctor_selection not in doctor_list:
-                error_label.config(text="Please select a valid doctor from the list!")
-                doctor_search_var.set('')
-                return
-            
             # Extract IDs (format: "ID - Name")
             try:
                 patient_id = patient_selection.split(' - ')[0].strip()
@@ -984,10 +1764,27 @@ class HospitalManagementGUI:
                 'status': status_combo.get()
             }
             
-            self.local_db_instance.insert('appointments', data)
-            messagebox.showinfo("Success", "Appointment added successfully!")
-            dialog.destroy()
-            self.load_appointments()
+            if len(sources) < 2:
+                error_label.config(text="Patients and doctors are still loading, try again in a moment")
+                return
+            
+            # Checks that query the database run with the write, on the loader
+            def write():
+                if patient_selection not in sources['patients']:
+                    return invalid_patient
+                if doctor_selection not in sources['doctors']:
+                    return invalid_doctor
+                return (self.check_doctor_free(doctor_id, date_value, time_value, data['status'])
+                        or self.local_db_instance.insert('appointments', data))
+            
+            def refused(message):
+                error_label.config(text=message)
+                if message == invalid_patient:
+                    patient_search_var.set('')
+                elif message == invalid_doctor:
+                    doctor_search_var.set('')
+            
+            self.save_row(dialog, 'appointments', write, "Appointment added successfully!", refused)
         
         tk.Button(dialog, text="Save", command=save_appointment, 
                  bg='#2ecc71', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
@@ -1003,53 +1800,25 @@ class HospitalManagementGUI:
         form_frame = tk.Frame(dialog, bg='white')
         form_frame.pack(padx=20, pady=10)
         
-        # Get all patients and doctors
-        all_patients = self.local_db_instance.get_all('patients')
-        all_doctors = self.local_db_instance.get_all('doctors')
-        
-        # Create patient list with ID and Name
-        patient_list = [f"{p['patient_id']} - {p['name']}" for p in all_patients]
-        doctor_list = [f"{d['doctor_id']} - {d['name']} ({d['specialization']})" for d in all_doctors]
-        
         # Patient selection with search
         tk.Label(form_frame, text="Patient:", font=('Arial', 10), bg='white').grid(row=0, column=0, sticky='w', pady=(5,0))
         patient_search_var = tk.StringVar()
         patient_combo = ttk.Combobox(form_frame, textvariable=patient_search_var, width=40)
-        patient_combo['values'] = patient_list
         patient_combo.grid(row=0, column=1, pady=(5,0), padx=10)
         patient_id_error = tk.Label(form_frame, text="", font=('Arial', 8), fg='red', bg='white')
         patient_id_error.grid(row=1, column=1, sticky='w', padx=10)
         
-        # Filter patients as user types
-        def filter_patients(event):
-            search_term = patient_search_var.get().lower()
-            if search_term:
-                filtered = [p for p in patient_list if search_term in p.lower()]
-                patient_combo['values'] = filtered
-            else:
-                patient_combo['values'] = patient_list
-        
-        patient_combo.bind('<KeyRelease>', filter_patients)
-        
         # Doctor selection with search
         tk.Label(form_frame, text="Doctor:", font=('Arial', 10), bg='white').grid(row=2, column=0, sticky='w', pady=(5,0))
         doctor_search_var = tk.StringVar()
         doctor_combo = ttk.Combobox(form_frame, textvariable=doctor_search_var, width=40)
-        doctor_combo['values'] = doctor_list
         doctor_combo.grid(row=2, column=1, pady=(5,0), padx=10)
         doctor_id_error = tk.Label(form_frame, text="", font=('Arial', 8), fg='red', bg='white')
         doctor_id_error.grid(row=3, column=1, sticky='w', padx=10)
         
-        # Filter doctors as user types
-        def filter_doctors(event):
-            search_term = doctor_search_var.get().lower()
-            if search_term:
-                filtered = [d for d in doctor_list if search_term in d.lower()]
-                doctor_combo['values'] = filtered
-            else:
-                doctor_combo['values'] = doctor_list
-        
-        doctor_combo.bind('<KeyRelease>', filter_doctors)
+        # Shared type-ahead sources for patients and doctors, built on the loader
+        self.bind_lookups({'patients': (patient_combo, patient_search_var),
+                           'doctors': (doctor_combo, doctor_search_var)})
         
         # Diagnosis
         tk.Label(form_frame, text="Diagnosis:", font=('Arial', 10), bg='white').grid(row=4, column=0, sticky='w', pady=(5,0))
@@ -1072,7 +1841,7 @@ class HospitalManagementGUI:
         
         # Record Date with Calendar
         tk.Label(form_frame, text="Record Date:", font=('Arial', 10), bg='white').grid(row=9, column=0, sticky='w', pady=(5,0))
-        date_entry = DateEntry(form_frame, width=27, background='darkblue',
+        date_entry = make_date_entry(form_frame, width=27, background='darkblue',
                               foreground='white', borderwidth=2, date_pattern='yyyy-mm-dd')
         date_entry.grid(row=9, column=1, pady=(5,0), padx=10)
         date_error = tk.Label(form_frame, text="", font=('Arial', 8), fg='red', bg='white')
@@ -1141,122 +1910,87 @@ class HospitalManagementGUI:
             if has_error:
                 return
             
-            self.local_db_instance.insert('medical_records', data)
-            messagebox.showinfo("Success", "Medical record added successfully!")
-            dialog.destroy()
-            self.load_medical_records()
+            self.save_row(dialog, 'medical_records', lambda: self.local_db_instance.insert('medical_records', data),
+                          "Medical record added successfully!")
         
         tk.Button(dialog, text="Save", command=save_record, 
                  bg='#2ecc71', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
     
     def delete_patient(self):
-        selected = self.patients_tree.selection()
-        if not selected:
+        values = self.patients_table.selected_values()
+        if not values:
             messagebox.showwarning("Warning", "Please select a patient to delete!")
             return
         
-        item = self.patients_tree.item(selected[0])
-        values = item['values']
-        patient_id_with_prefix = values[0]
+        patient_id = values[0]
         patient_name = values[1]
-        hospital = values[6]
-        
-        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete patient '{patient_name}' (ID: {patient_id_with_prefix})?"):
-            if hospital == self.hospital_name:
-                # Extract actual ID from prefix (e.g., "CEN-5" -> "5")
-                actual_id = patient_id_with_prefix.split('-')[1] if '-' in str(patient_id_with_prefix) else patient_id_with_prefix
-                # Delete from local database
-                self.local_db_instance.delete('patients', 'patient_id', actual_id)
-                messagebox.showinfo("Success", "Patient deleted successfully!")
-                self.load_patients()
+        
+        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete patient '{patient_name}' (ID: {patient_id})?\n\n"
+                               "Their appointments and medical records will be deleted too."):
+            actual_id = self.selected_local_id(self.patients_table)
+            if actual_id is not None:
+                self.delete_row('patients', actual_id, "Patient deleted successfully!")
             else:
                 messagebox.showerror("Error", "Cannot delete patients from remote hospitals!")
     
     def delete_doctor(self):
-        selected = self.doctors_tree.selection()
-        if not selected:
+        values = self.doctors_table.selected_values()
+        if not values:
             messagebox.showwarning("Warning", "Please select a doctor to delete!")
             return
         
-        item = self.doctors_tree.item(selected[0])
-        values = item['values']
-        doctor_id_with_prefix = values[0]
+        doctor_id = values[0]
         doctor_name = values[1]
-        hospital = values[5]
-        
-        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete doctor '{doctor_name}' (ID: {doctor_id_with_prefix})?"):
-            if hospital == self.hospital_name:
-                # Extract actual ID from prefix
-                actual_id = doctor_id_with_prefix.split('-')[1] if '-' in str(doctor_id_with_prefix) else doctor_id_with_prefix
-                # Delete from local database
-                self.local_db_instance.delete('doctors', 'doctor_id', actual_id)
-                messagebox.showinfo("Success", "Doctor deleted successfully!")
-                self.load_doctors()
+        
+        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete doctor '{doctor_name}' (ID: {doctor_id})?\n\n"
+                               "Their appointments and medical records will be deleted too."):
+            actual_id = self.selected_local_id(self.doctors_table)
+            if actual_id is not None:
+                self.delete_row('doctors', actual_id, "Doctor deleted successfully!")
             else:
                 messagebox.showerror("Error", "Cannot delete doctors from remote hospitals!")
     
     def delete_appointment(self):
-        selected = self.appointments_tree.selection()
-        if not selected:
+        values = self.appointments_table.selected_values()
+        if not values:
             messagebox.showwarning("Warning", "Please select an appointment to delete!")
             return
         
-        item = self.appointments_tree.item(selected[0])
-        values = item['values']
-        appointment_id_with_prefix = values[0]
-        hospital = values[6]
-        
-        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete appointment ID: {appointment_id_with_prefix}?"):
-            if hospital == self.hospital_name:
-                # Extract actual ID from prefix
-                actual_id = appointment_id_with_prefix.split('-')[1] if '-' in str(appointment_id_with_prefix) else appointment_id_with_prefix
-                # Delete from local database
-                self.local_db_instance.delete('appointments', 'appointment_id', actual_id)
-                messagebox.showinfo("Success", "Appointment deleted successfully!")
-                self.load_appointments()
+        appointment_id = values[0]
+        
+        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete appointment ID: {appointment_id}?"):
+            actual_id = self.selected_local_id(self.appointments_table)
+            if actual_id is not None:
+                self.delete_row('appointments', actual_id, "Appointment deleted successfully!")
             else:
                 messagebox.showerror("Error", "Cannot delete appointments from remote hospitals!")
     
     def delete_medical_record(self):
-        selected = self.records_tree.selection()
-        if not selected:
+        values = self.records_table.selected_values()
+        if not values:
             messagebox.showwarning("Warning", "Please select a medical record to delete!")
             return
         
-        item = self.records_tree.item(selected[0])
-        values = item['values']
-        record_id_with_prefix = values[0]
-        hospital = values[6]
-        
-        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete medical record ID: {record_id_with_prefix}?"):
-            if hospital == self.hospital_name:
-                # Extract actual ID from prefix
-                actual_id = record_id_with_prefix.split('-')[1] if '-' in str(record_id_with_prefix) else record_id_with_prefix
-                # Delete from local database
-                self.local_db_instance.delete('medical_records', 'record_id', actual_id)
-                messagebox.showinfo("Success", "Medical record deleted successfully!")
-                self.load_medical_records()
+        record_id = values[0]
+        
+        if messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete medical record ID: {record_id}?"):
+            actual_id = self.selected_local_id(self.records_table)
+            if actual_id is not None:
+                self.delete_row('medical_records', actual_id, "Medical record deleted successfully!")
             else:
                 messagebox.showerror("Error", "Cannot delete medical records from remote hospitals!")
 
     def update_patient_dialog(self, event):
-        selected = self.patients_tree.selection()
-        if not selected:
+        values = self.patients_table.selected_values()
+        if not values:
             return
         
-        item = self.patients_tree.item(selected[0])
-        values = item['values']
-        patient_id_with_prefix = values[0]
-        hospital = values[6]
-        
         # Only allow updating local hospital records
-        if hospital != self.hospital_name:
+        actual_id = self.selected_local_id(self.patients_table)
+        if actual_id is None:
             messagebox.showerror("Error", "Cannot update patients from remote hospitals!")
             return
         
-        # Extract actual ID from prefix
-        actual_id = patient_id_with_prefix.split('-')[1] if '-' in str(patient_id_with_prefix) else patient_id_with_prefix
-        
         dialog = tk.Toplevel(self.root)
         dialog.title("Update Patient")
         dialog.geometry("450x450")
@@ -1353,30 +2087,22 @@ class HospitalManagementGUI:
             if has_error:
                 return
             
-            self.local_db_instance.update('patients', 'patient_id', actual_id, data)
-            messagebox.showinfo("Success", "Patient updated successfully!")
-            dialog.destroy()
-            self.load_patients()
+            self.save_row(dialog, 'patients', lambda: self.local_db_instance.update('patients', 'patient_id', actual_id, data),
+                          "Patient updated successfully!")
         
         tk.Button(dialog, text="Update", command=update_patient, 
                  bg='#f39c12', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
     
     def update_doctor_dialog(self, event):
-        selected = self.doctors_tree.selection()
-        if not selected:
+        values = self.doctors_table.selected_values()
+        if not values:
             return
         
-        item = self.doctors_tree.item(selected[0])
-        values = item['values']
-        doctor_id_with_prefix = values[0]
-        hospital = values[5]
-        
-        if hospital != self.hospital_name:
+        actual_id = self.selected_local_id(self.doctors_table)
+        if actual_id is None:
             messagebox.showerror("Error", "Cannot update doctors from remote hospitals!")
             return
         
-        actual_id = doctor_id_with_prefix.split('-')[1] if '-' in str(doctor_id_with_prefix) else doctor_id_with_prefix
-        
         dialog = tk.Toplevel(self.root)
         dialog.title("Update Doctor")
         dialog.geometry("450x400")
@@ -1439,30 +2165,22 @@ class HospitalManagementGUI:
             if has_error:
                 return
             
-            self.local_db_instance.update('doctors', 'doctor_id', actual_id, data)
-            messagebox.showinfo("Success", "Doctor updated successfully!")
-            dialog.destroy()
-            self.load_doctors()
+            self.save_row(dialog, 'doctors', lambda: self.local_db_instance.update('doctors', 'doctor_id', actual_id, data),
+                          "Doctor updated successfully!")
         
         tk.Button(dialog, text="Update", command=update_doctor, 
                  bg='#f39c12', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
     
     def update_appointment_dialog(self, event):
-        selected = self.appointments_tree.selection()
-        if not selected:
+        values = self.appointments_table.selected_values()
+        if not values:
             return
         
-        item = self.appointments_tree.item(selected[0])
-        values = item['values']
-        appointment_id_with_prefix = values[0]
-        hospital = values[6]
-        
-        if hospital != self.hospital_name:
+        actual_id = self.selected_local_id(self.appointments_table)
+        if actual_id is None:
             messagebox.showerror("Error", "Cannot update appointments from remote hospitals!")
             return
         
-        actual_id = appointment_id_with_prefix.split('-')[1] if '-' in str(appointment_id_with_prefix) else appointment_id_with_prefix
-        
         dialog = tk.Toplevel(self.root)
         dialog.title("Update Appointment")
         dialog.geometry("550x450")
@@ -1473,75 +2191,31 @@ class HospitalManagementGUI:
         form_frame = tk.Frame(dialog, bg='white')
         form_frame.pack(padx=20, pady=10)
         
-        # Extract patient_id and doctor_id without prefix
-        patient_id_full = str(values[1])
-        doctor_id_full = str(values[2])
-        patient_id = patient_id_full.split('-')[1] if '-' in patient_id_full else patient_id_full
-        doctor_id = doctor_id_full.split('-')[1] if '-' in doctor_id_full else doctor_id_full
-        
-        # Get all patients and doctors
-        all_patients = self.local_db_instance.get_all('patients')
-        all_doctors = self.local_db_instance.get_all('doctors')
-        
-        # Create patient list with ID and Name
-        patient_list = [f"{p['patient_id']} - {p['name']}" for p in all_patients]
-        doctor_list = [f"{d['doctor_id']} - {d['name']} ({d['specialization']})" for d in all_doctors]
-        
-        # Find current patient and doctor in lists
-        current_patient = None
-        current_doctor = None
-        for p in patient_list:
-            if p.startswith(f"{patient_id} -"):
-                current_patient = p
-                break
-        for d in doctor_list:
-            if d.startswith(f"{doctor_id} -"):
-                current_doctor = d
-                break
+        # Local patient and doctor IDs of the row
+        patient_id = label_key(values[1])
+        doctor_id = label_key(values[2])
         
         # Patient selection with search
         tk.Label(form_frame, text="Patient:", font=('Arial', 10), bg='white').grid(row=0, column=0, sticky='w', pady=5)
         patient_search_var = tk.StringVar()
-        if current_patient:
-            patient_search_var.set(current_patient)
         patient_combo = ttk.Combobox(form_frame, textvariable=patient_search_var, width=40)
-        patient_combo['values'] = patient_list
         patient_combo.grid(row=0, column=1, pady=5, padx=10, columnspan=2)
         
-        # Filter patients as user types
-        def filter_patients(event):
-            search_term = patient_search_var.get().lower()
-            if search_term:
-                filtered = [p for p in patient_list if search_term in p.lower()]
-                patient_combo['values'] = filtered
-            else:
-                patient_combo['values'] = patient_list
-        
-        patient_combo.bind('<KeyRelease>', filter_patients)
-        
         # Doctor selection with search
         tk.Label(form_frame, text="Doctor:", font=('Arial', 10), bg='white').grid(row=1, column=0, sticky='w', pady=5)
         doctor_search_var = tk.StringVar()
-        if current_doctor:
-            doctor_search_var.set(current_doctor)
         doctor_combo = ttk.Combobox(form_frame, textvariable=doctor_search_var, width=40)
-        doctor_combo['values'] = doctor_list
         doctor_combo.grid(row=1, column=1, pady=5, padx=10, columnspan=2)
         
-        # Filter doctors as user types
-        def filter_doctors(event):
-            search_term = doctor_search_var.get().lower()
-            if search_term:
-                filtered = [d for d in doctor_list if search_term in d.lower()]
-                doctor_combo['values'] = filtered
-            else:
-                doctor_combo['values'] = doctor_list
-        
-        doctor_combo.bind('<KeyRelease>', filter_doctors)
+        # Shared type-ahead sources for patients and doctors, built on the loader,
+        # and the labels of the row's current patient and doctor
+        sources, labels = self.bind_lookups({'patients': (patient_combo, patient_search_var),
+                                             'doctors': (doctor_combo, doctor_search_var)},
+                                            {'patients': patient_id, 'doctors': doctor_id})
         
         # Appointment Date with Calendar
         tk.Label(form_frame, text="Date:", font=('Arial', 10), bg='white').grid(row=2, column=0, sticky='w', pady=5)
-        date_entry = DateEntry(form_frame, width=39, background='darkblue',
+        date_entry = make_date_entry(form_frame, width=39, background='darkblue',
                               foreground='white', borderwidth=2, date_pattern='yyyy-mm-dd')
         # Set current date value
         try:
@@ -1564,9 +2238,12 @@ class HospitalManagementGUI:
         status_combo.grid(row=4, column=1, pady=5, padx=10, columnspan=2)
         
         # Error labels
-        error_label = tk.Label(form_frame, text="", font=('Arial', 9), fg='red', bg='white')
+        error_label = tk.Label(form_frame, text="", font=('Arial', 9), fg='red', bg='white', wraplength=450)
         error_label.grid(row=5, column=0, columnspan=3, pady=5)
         
+        invalid_patient = "Please select a valid patient from the list!"
+        invalid_doctor = "Please select a valid doctor from the list!"
+        
         def update_appointment():
             error_label.config(text="")
             
@@ -1579,21 +2256,11 @@ class HospitalManagementGUI:
                 error_label.config(text="Please select a patient!")
                 return
             
-            if patient_selection not in patient_list:
-                error_label.config(text="Please select a valid patient from the list!")
-                patient_search_var.set(current_patient if current_patient else '')
-                return
-            
             # Validate doctor selection - must be from dropdown list
             if not doctor_selection:
                 error_label.config(text="Please select a doctor!")
                 return
             
-            if doctor_selection not in doctor_list:
-                error_label.config(text="Please select a valid doctor from the list!")
-                doctor_search_var.set(current_doctor if current_doctor else '')
-                return
-            
             # Extract IDs (format: "ID - Name")
             try:
                 patient_id = patient_selection.split(' - ')[0].strip()
@@ -1624,37 +2291,43 @@ class HospitalManagementGUI:
                 'status': status_combo.get()
             }
             
-            self.local_db_instance.update('appointments', 'appointment_id', actual_id, data)
-            messagebox.showinfo("Success", "Appointment updated successfully!")
-            dialog.destroy()
-            self.load_appointments()
+            if len(sources) < 2:
+                error_label.config(text="Patients and doctors are still loading, try again in a moment")
+                return
+            
+            # Checks that query the database run with the write, on the loader
+            def write():
+                if patient_selection not in sources['patients']:
+                    return invalid_patient
+                if doctor_selection not in sources['doctors']:
+                    return invalid_doctor
+                return (self.check_doctor_free(doctor_id, date_value, time_value, data['status'], actual_id)
+                        or self.local_db_instance.update('appointments', 'appointment_id', actual_id, data))
+            
+            def refused(message):
+                error_label.config(text=message)
+                if message == invalid_patient:
+                    patient_search_var.set(labels.get('patients') or '')
+                elif message == invalid_doctor:
+                    doctor_search_var.set(labels.get('doctors') or '')
+            
+            self.save_row(dialog, 'appointments', write, "Appointment updated successfully!", refused)
         
         tk.Button(dialog, text="Update", command=update_appointment, 
                  bg='#f39c12', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
     
     def update_medical_record_dialog(self, event):
-        selected = self.records_tree.selection()
-        if not selected:
+        values = self.records_table.selected_values()
+        if not values:
             return
         
-        item = self.records_tree.item(selected[0])
-        values = item['values']
-        record_id_with_prefix = values[0]
-        hospital = values[6]
-        
-        if hospital != self.hospital_name:
+        actual_id = self.selected_local_id(self.records_table)
+        if actual_id is None:
             messagebox.showerror("Error", "Cannot update medical records from remote hospitals!")
             return
         
-        actual_id = record_id_with_prefix.split('-')[1] if '-' in str(record_id_with_prefix) else record_id_with_prefix
-        
-        # Get full record from database to get notes field
-        records = self.local_db_instance.get_all('medical_records')
-        current_record = None
-        for record in records:
-            if str(record.get('record_id')) == str(actual_id):
-                current_record = record
-                break
+        # Get full record from the store to get notes field
+        current_record = self.store.get('medical_records', self.records_table.selected_key)
         
         dialog = tk.Toplevel(self.root)
         dialog.title("Update Medical Record")
@@ -1666,75 +2339,31 @@ class HospitalManagementGUI:
         form_frame = tk.Frame(dialog, bg='white')
         form_frame.pack(padx=20, pady=10)
         
-        # Extract patient_id and doctor_id without prefix
-        patient_id_full = str(values[1])
-        doctor_id_full = str(values[2])
-        patient_id = patient_id_full.split('-')[1] if '-' in patient_id_full else patient_id_full
-        doctor_id = doctor_id_full.split('-')[1] if '-' in doctor_id_full else doctor_id_full
-        
-        # Get all patients and doctors
-        all_patients = self.local_db_instance.get_all('patients')
-        all_doctors = self.local_db_instance.get_all('doctors')
-        
-        # Create patient list with ID and Name
-        patient_list = [f"{p['patient_id']} - {p['name']}" for p in all_patients]
-        doctor_list = [f"{d['doctor_id']} - {d['name']} ({d['specialization']})" for d in all_doctors]
-        
-        # Find current patient and doctor in lists
-        current_patient = None
-        current_doctor = None
-        for p in patient_list:
-            if p.startswith(f"{patient_id} -"):
-                current_patient = p
-                break
-        for d in doctor_list:
-            if d.startswith(f"{doctor_id} -"):
-                current_doctor = d
-                break
+        # Local patient and doctor IDs of the row
+        patient_id = label_key(values[1])
+        doctor_id = label_key(values[2])
         
         # Patient selection with search
         tk.Label(form_frame, text="Patient:", font=('Arial', 10), bg='white').grid(row=0, column=0, sticky='w', pady=(5,0))
         patient_search_var = tk.StringVar()
-        if current_patient:
-            patient_search_var.set(current_patient)
         patient_combo = ttk.Combobox(form_frame, textvariable=patient_search_var, width=40)
-        patient_combo['values'] = patient_list
         patient_combo.grid(row=0, column=1, pady=(5,0), padx=10)
         patient_id_error = tk.Label(form_frame, text="", font=('Arial', 8), fg='red', bg='white')
         patient_id_error.grid(row=1, column=1, sticky='w', padx=10)
         
-        # Filter patients as user types
-        def filter_patients(event):
-            search_term = patient_search_var.get().lower()
-            if search_term:
-                filtered = [p for p in patient_list if search_term in p.lower()]
-                patient_combo['values'] = filtered
-            else:
-                patient_combo['values'] = patient_list
-        
-        patient_combo.bind('<KeyRelease>', filter_patients)
-        
         # Doctor selection with search
         tk.Label(form_frame, text="Doctor:", font=('Arial', 10), bg='white').grid(row=2, column=0, sticky='w', pady=(5,0))
         doctor_search_var = tk.StringVar()
-        if current_doctor:
-            doctor_search_var.set(current_doctor)
         doctor_combo = ttk.Combobox(form_frame, textvariable=doctor_search_var, width=40)
-        doctor_combo['values'] = doctor_list
         doctor_combo.grid(row=2, column=1, pady=(5,0), padx=10)
         doctor_id_error = tk.Label(form_frame, text="", font=('Arial', 8), fg='red', bg='white')
         doctor_id_error.grid(row=3, column=1, sticky='w', padx=10)
         
-        # Filter doctors as user types
-        def filter_doctors(event):
-            search_term = doctor_search_var.get().lower()
-            if search_term:
-                filtered = [d for d in doctor_list if search_term in d.lower()]
-                doctor_combo['values'] = filtered
-            else:
-                doctor_combo['values'] = doctor_list
-        
-        doctor_combo.bind('<KeyRelease>', filter_doctors)
+        # Shared type-ahead sources for patients and doctors, built on the
+        # loader, prefilled with the row's current patient and doctor
+        self.bind_lookups({'patients': (patient_combo, patient_search_var),
+                           'doctors': (doctor_combo, doctor_search_var)},
+                          {'patients': patient_id, 'doctors': doctor_id})
         
         # Diagnosis
         tk.Label(form_frame, text="Diagnosis:", font=('Arial', 10), bg='white').grid(row=4, column=0, sticky='w', pady=(5,0))
@@ -1755,13 +2384,13 @@ class HospitalManagementGUI:
         # Notes
         tk.Label(form_frame, text="Notes:", font=('Arial', 10), bg='white').grid(row=8, column=0, sticky='nw', pady=(5,0))
         notes_text = tk.Text(form_frame, width=30, height=5)
-        if current_record and current_record.get('notes'):
-            notes_text.insert(1.0, current_record.get('notes'))
+        if current_record and current_record.notes:
+            notes_text.insert(1.0, current_record.notes)
         notes_text.grid(row=8, column=1, pady=(5,0), padx=10)
         
         # Record Date with Calendar
         tk.Label(form_frame, text="Record Date:", font=('Arial', 10), bg='white').grid(row=9, column=0, sticky='w', pady=(5,0))
-        date_entry = DateEntry(form_frame, width=27, background='darkblue',
+        date_entry = make_date_entry(form_frame, width=27, background='darkblue',
                               foreground='white', borderwidth=2, date_pattern='yyyy-mm-dd')
         # Set current date value
         try:
@@ -1833,10 +2462,8 @@ class HospitalManagementGUI:
             if has_error:
                 return
             
-            self.local_db_instance.update('medical_records', 'record_id', actual_id, data)
-            messagebox.showinfo("Success", "Medical record updated successfully!")
-            dialog.destroy()
-            self.load_medical_records()
+            self.save_row(dialog, 'medical_records', lambda: self.local_db_instance.update('medical_records', 'record_id', actual_id, data),
+                          "Medical record updated successfully!")
         
         tk.Button(dialog, text="Update", command=update_record, 
                  bg='#f39c12', fg='white', font=('Arial', 10, 'bold')).pack(pady=20)
@@ -1845,18 +2472,20 @@ def main():
     import sys
     
     if len(sys.argv) < 2:
-        print("Usage: python gui.py <hospital_name> [port] [is_master]")
+        print("Usage: python gui.py <hospital_name> [port] [is_master] [federation_url]")
         print("Example: python gui.py 'City Hospital' 5000 master")
         sys.exit(1)
     
     hospital_name = sys.argv[1]
     port = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
     is_master = len(sys.argv) > 3 and sys.argv[3].lower() == 'master'
+    federation_url = sys.argv[4] if len(sys.argv) > 4 else None
     db_name = f"{hospital_name.replace(' ', '_').lower()}.db"
     
     root = tk.Tk()
     app = HospitalManagementGUI(root, is_master=is_master, local_port=port, 
-                                local_db=db_name, hospital_name=hospital_name)
+                                local_db=db_name, hospital_name=hospital_name,
+                                federation_url=federation_url)
     root.mainloop()
 
 if __name__ == '__main__':
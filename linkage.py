@@ -0,0 +1,375 @@
+"""Cross-hospital duplicate patient detection.
+
+Patients from every hospital are grouped by blocking keys (phonetic name,
+phone number, birth year) so only records sharing a key are compared.
+Candidate pairs are fuzzy-scored and matches are clustered into a global
+patient ID, stored in the master_patient_index table of the master's
+database. Registrations are keyed by hospital ID, so a renamed hospital
+keeps its links. Later runs only process rows from each hospital's change
+feed.
+"""
+from client import HospitalClient
+from sharding import open_database
+from datetime import datetime
+import sqlite3
+import time
+import sys
+
+SOUNDEX_CODES = {}
+for letters, code in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'), ('mn', '5'), ('r', '6')):
+    for letter in letters:
+        SOUNDEX_CODES[letter] = code
+
+def soundex(word):
+    word = ''.join(c for c in word.lower() if c.isalpha())
+    if not word:
+        return ''
+    result = word[0].upper()
+    previous = SOUNDEX_CODES.get(word[0], '')
+    for c in word[1:]:
+        code = SOUNDEX_CODES.get(c, '')
+        if code and code != previous:
+            result += code
+            if len(result) == 4:
+                break
+        if c not in 'hw':
+            previous = code
+    return result.ljust(4, '0')
+
+def jaro_winkler(a, b):
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    window = max(0, max(len(a), len(b)) // 2 - 1)
+    a_matched = [False] * len(a)
+    b_matched = [False] * len(b)
+    matches = 0
+    for i, c in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not b_matched[j] and b[j] == c:
+                a_matched[i] = b_matched[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+    a_chars = [c for c, m in zip(a, a_matched) if m]
+    b_chars = [c for c, m in zip(b, b_matched) if m]
+    transpositions = sum(x != y for x, y in zip(a_chars, b_chars)) / 2
+    jaro = (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+def normalize_phone(phone):
+    digits = ''.join(c for c in str(phone or '') if c.isdigit())
+    # Last 7 digits, so country/area code formatting doesn't matter
+    return digits[-7:] if len(digits) >= 7 else None
+
+def birth_year(row):
+    try:
+        age = int(row.get('age'))
+    except (TypeError, ValueError):
+        return None
+    created = str(row.get('created_at') or '')
+    year = int(created[:4]) if created[:4].isdigit() else datetime.now().year
+    return year - age
+
+def features(hospital_id, hospital, row):
+    """Comparison fields and blocking keys of a patient row"""
+    name = ' '.join(str(row.get('name') or '').lower().split())
+    tokens = name.split() or ['']
+    last_key = soundex(tokens[-1])
+    year = birth_year(row)
+    return {
+        'hospital_id': hospital_id,
+        'hospital': hospital,
+        'patient_id': row['patient_id'],
+        'name': name,
+        'phone': normalize_phone(row.get('phone')),
+        'birth_year': year,
+        'gender': (row.get('gender') or '').lower() or None,
+        'name_key': soundex(tokens[0]) + last_key if name else None,
+        'phone_key': normalize_phone(row.get('phone')),
+        'year_key': f'{year}{last_key}' if year is not None and name else None,
+    }
+
+BLOCKING_KEYS = ('name_key', 'phone_key', 'year_key')
+
+# Feature weights (summing to 1). A feature missing on either side counts
+# as half agreement, so e.g. a missing phone needs a near-exact name.
+WEIGHTS = {'name': 0.55, 'phone': 0.25, 'birth_year': 0.15, 'gender': 0.05}
+
+def agreement(x, y, same):
+    if x is None or y is None:
+        return 0.5
+    return float(same(x, y))
+
+def score(a, b, threshold=0.0):
+    """Similarity of two patients between 0 and 1. Returns 0 early when
+    even an exact name match could not reach threshold."""
+    total = (WEIGHTS['phone'] * agreement(a['phone'], b['phone'], lambda x, y: x == y) +
+             WEIGHTS['birth_year'] * agreement(a['birth_year'], b['birth_year'], lambda x, y: abs(x - y) <= 1) +
+             WEIGHTS['gender'] * agreement(a['gender'], b['gender'], lambda x, y: x == y))
+    # The name comparison is the expensive part
+    if total + WEIGHTS['name'] < threshold:
+        return 0.0
+    return total + WEIGHTS['name'] * agreement(a['name'] or None, b['name'] or None, jaro_winkler)
+
+class LocalSource:
+    """A hospital database opened directly (the master's own)"""
+    def __init__(self, db):
+        self.db = db
+        self.hospital_id = db.hospital_id
+        self.hospital = db.hospital_name
+
+    def snapshot(self):
+        seq = self.db.last_change()
+        return seq, self.db.get_all('patients')
+
+    def changes(self, since):
+        return self.db.change_feed(since, ['patients'], limit=5000)
+
+class RemoteSource:
+    """A hospital reached through its server's API and change feed"""
+    def __init__(self, client, hospital_id, hospital):
+        self.client = client
+        self.hospital_id = hospital_id
+        self.hospital = hospital
+
+    def snapshot(self):
+        feed = self.client.get_changes(0, ['patients'], limit=0)
+        if feed is None:
+            return None
+        return feed['latest'], self.client.get_patients()
+
+    def changes(self, since):
+        feed = self.client.get_changes(since, ['patients'], limit=5000)
+        if feed is None:
+            return None
+        return feed['seq'], feed['changes']
+
+class PatientLinker:
+    """Maintains the master patient index in the master's database"""
+    THRESHOLD = 0.85
+    # Blocks larger than this (very common names) are not compared
+    MAX_BLOCK = 200
+
+    COLUMNS = ('hospital_id', 'hospital', 'patient_id', 'global_id', 'name', 'phone', 'birth_year', 'gender',
+               'name_key', 'phone_key', 'year_key')
+
+    def __init__(self, db):
+        self.db = db
+        self.pairs_compared = 0
+        conn = sqlite3.connect(db.db_name)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(master_patient_index)')]
+        if columns and 'hospital_id' not in columns:
+            # Index from before registrations were keyed by hospital ID;
+            # dropping it makes the next sync() rebuild it
+            conn.executescript('DROP TABLE master_patient_index; DROP TABLE IF EXISTS linkage_cursors;')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS master_patient_index (
+                hospital_id INTEGER NOT NULL,
+                hospital TEXT NOT NULL,
+                patient_id INTEGER NOT NULL,
+                global_id INTEGER NOT NULL,
+                name TEXT,
+                phone TEXT,
+                birth_year INTEGER,
+                gender TEXT,
+                name_key TEXT,
+                phone_key TEXT,
+                year_key TEXT,
+                PRIMARY KEY (hospital_id, patient_id)
+            );
+            CREATE INDEX IF NOT EXISTS mpi_global ON master_patient_index (global_id);
+            CREATE INDEX IF NOT EXISTS mpi_name_key ON master_patient_index (name_key);
+            CREATE INDEX IF NOT EXISTS mpi_phone_key ON master_patient_index (phone_key);
+            CREATE INDEX IF NOT EXISTS mpi_year_key ON master_patient_index (year_key);
+            CREATE TABLE IF NOT EXISTS linkage_cursors (
+                hospital_id INTEGER PRIMARY KEY,
+                seq INTEGER NOT NULL
+            );
+        ''')
+        conn.close()
+
+    def rebuild(self, sources):
+        """Link every patient of every source from scratch"""
+        records = []
+        cursors = {}
+        for source in sources:
+            snapshot = source.snapshot()
+            if snapshot is None:
+                continue
+            cursors[source.hospital_id], rows = snapshot
+            records.extend(features(source.hospital_id, source.hospital, row) for row in rows)
+        self.link_batch(records, cursors)
+
+    def link_batch(self, records, cursors):
+        parent = list(range(len(records)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for key in BLOCKING_KEYS:
+            blocks = {}
+            for i, record in enumerate(records):
+                if record[key]:
+                    blocks.setdefault(record[key], []).append(i)
+            for members in blocks.values():
+                if len(members) < 2 or len(members) > self.MAX_BLOCK:
+                    continue
+                for x in range(len(members)):
+                    a = members[x]
+                    for b in members[x + 1:]:
+                        if records[a]['hospital_id'] == records[b]['hospital_id']:
+                            continue
+                        root_a, root_b = find(a), find(b)
+                        if root_a == root_b:
+                            continue
+                        self.pairs_compared += 1
+                        if score(records[a], records[b], self.THRESHOLD) >= self.THRESHOLD:
+                            parent[root_b] = root_a
+
+        global_ids = {}
+        for i, record in enumerate(records):
+            record['global_id'] = global_ids.setdefault(find(i), len(global_ids) + 1)
+
+        conn = sqlite3.connect(self.db.db_name)
+        conn.execute('DELETE FROM master_patient_index')
+        conn.executemany(f'INSERT INTO master_patient_index ({", ".join(self.COLUMNS)}) '
+                         f'VALUES ({", ".join("?" for _ in self.COLUMNS)})',
+                         ([record[column] for column in self.COLUMNS] for record in records))
+        conn.execute('DELETE FROM linkage_cursors')
+        conn.executemany('INSERT INTO linkage_cursors (hospital_id, seq) VALUES (?, ?)', cursors.items())
+        conn.commit()
+        conn.close()
+
+    def sync(self, sources):
+        """Bring the index up to date from each source's change feed.
+        Sources never seen before are loaded in full."""
+        conn = sqlite3.connect(self.db.db_name)
+        conn.row_factory = sqlite3.Row
+        cursors = {row['hospital_id']: row['seq'] for row in conn.execute('SELECT * FROM linkage_cursors')}
+        conn.close()
+        if not cursors:
+            self.rebuild(sources)
+            return
+
+        for source in sources:
+            if source.hospital_id not in cursors:
+                snapshot = source.snapshot()
+                if snapshot is None:
+                    continue
+                seq, rows = snapshot
+                self.apply(source.hospital_id, source.hospital,
+                           [{'row_id': row['patient_id'], 'row': row} for row in rows], seq)
+                continue
+            seq = cursors[source.hospital_id]
+            while True:
+                feed = source.changes(seq)
+                if feed is None or not feed[1]:
+                    break
+                seq, entries = feed
+                self.apply(source.hospital_id, source.hospital, entries, seq)
+
+    def apply(self, hospital_id, hospital, entries, seq):
+        """Re-link changed rows of one hospital and advance its cursor.
+        Deleted rows leave the index; existing clusters are never split."""
+        conn = sqlite3.connect(self.db.db_name)
+        conn.row_factory = sqlite3.Row
+        for entry in entries:
+            conn.execute('DELETE FROM master_patient_index WHERE hospital_id = ? AND patient_id = ?',
+                         (hospital_id, entry['row_id']))
+            if entry['row']:
+                self.link_record(conn, features(hospital_id, hospital, entry['row']))
+        conn.execute('INSERT OR REPLACE INTO linkage_cursors (hospital_id, seq) VALUES (?, ?)', (hospital_id, seq))
+        conn.commit()
+        conn.close()
+
+    def link_record(self, conn, record):
+        keys = [key for key in BLOCKING_KEYS if record[key]]
+        global_ids = set()
+        if keys:
+            candidates = conn.execute(
+                f'SELECT * FROM master_patient_index WHERE hospital_id != ? AND '
+                f'({" OR ".join(f"{key} = ?" for key in keys)})',
+                [record['hospital_id']] + [record[key] for key in keys]).fetchall()
+            for candidate in candidates:
+                self.pairs_compared += 1
+                if score(record, dict(candidate), self.THRESHOLD) >= self.THRESHOLD:
+                    global_ids.add(candidate['global_id'])
+
+        if global_ids:
+            record['global_id'] = min(global_ids)
+            others = list(global_ids - {record['global_id']})
+            if others:
+                conn.execute(f'UPDATE master_patient_index SET global_id = ? WHERE global_id IN '
+                             f'({", ".join("?" for _ in others)})', [record['global_id']] + others)
+        else:
+            record['global_id'] = conn.execute(
+                'SELECT COALESCE(MAX(global_id), 0) + 1 FROM master_patient_index').fetchone()[0]
+        conn.execute(f'INSERT INTO master_patient_index ({", ".join(self.COLUMNS)}) '
+                     f'VALUES ({", ".join("?" for _ in self.COLUMNS)})',
+                     [record[column] for column in self.COLUMNS])
+
+    def global_id(self, hospital_id, patient_id):
+        rows = self.db.execute_query('SELECT global_id FROM master_patient_index '
+                                     'WHERE hospital_id = ? AND patient_id = ?', (hospital_id, patient_id))
+        return rows[0]['global_id'] if rows else None
+
+    def linked(self, hospital_id, patient_id):
+        """(hospital_id, patient_id) of a registration and of every other
+        one of the same global patient, itself first"""
+        rows = self.db.execute_query('''
+            SELECT hospital_id, patient_id FROM master_patient_index
+            WHERE global_id = (SELECT global_id FROM master_patient_index WHERE hospital_id = ? AND patient_id = ?)
+            ORDER BY hospital_id, patient_id
+        ''', (hospital_id, patient_id))
+        return [(hospital_id, patient_id)] + [(row['hospital_id'], row['patient_id']) for row in rows
+                                              if (row['hospital_id'], row['patient_id']) != (hospital_id, patient_id)]
+
+    def duplicates(self):
+        """Global patients registered more than once, as lists of
+        (hospital, patient_id, name)"""
+        rows = self.db.execute_query('''
+            SELECT global_id, hospital, patient_id, name FROM master_patient_index
+            WHERE global_id IN (SELECT global_id FROM master_patient_index
+                                GROUP BY global_id HAVING COUNT(*) > 1)
+            ORDER BY global_id, hospital, patient_id
+        ''')
+        clusters = {}
+        for row in rows:
+            clusters.setdefault(row['global_id'], []).append((row['hospital'], row['patient_id'], row['name']))
+        return clusters
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: python linkage.py <hospital_name> <db_name> [hospital_url ...]")
+        sys.exit(1)
+
+    db = open_database(sys.argv[2], sys.argv[1])
+    sources = [LocalSource(db)]
+    for url in sys.argv[3:]:
+        client = HospitalClient(url)
+        health = client.check_health()
+        if not health:
+            print(f"Warning: could not reach {url}")
+            continue
+        sources.append(RemoteSource(client, health['hospital_id'], health['hospital']))
+
+    linker = PatientLinker(db)
+    started = time.perf_counter()
+    linker.sync(sources)
+    clusters = linker.duplicates()
+    print(f"Linked in {time.perf_counter() - started:.2f}s, {linker.pairs_compared} pairs compared")
+    print(f"{len(clusters)} patient(s) registered at more than one hospital")
+    for global_id, members in clusters.items():
+        print(f"  G{global_id}: " + ", ".join(f"{name} ({hospital} #{patient_id})"
+                                              for hospital, patient_id, name in members))
@@ -0,0 +1,178 @@
+"""Scheduled maintenance of a hospital database.
+
+A MaintenanceScheduler runs next to a hospital server and, whenever the
+server has been quiet for a moment, performs whatever is due: passive WAL
+checkpoints, PRAGMA optimize, incremental vacuum (on databases where it is
+enabled) and purging appointments and medical records of deleted patients
+or doctors. Given a backup directory it also rotates hot backups, and
+given an archive age it moves old appointments and medical records to the
+archive database. Every task reports the time it took and the pages or
+rows it moved.
+
+Usage: python maintenance.py <db_name> [backup_file] [--enable-vacuum]
+    Runs every task once, backing up to backup_file if given. With
+    --enable-vacuum, first switches the database to incremental vacuum,
+    which rewrites the whole file.
+"""
+from collections import deque
+from sharding import open_database
+from datetime import datetime, timedelta
+import glob
+import os
+import sys
+import threading
+import time
+
+class MaintenanceScheduler:
+    """Runs due maintenance tasks during low load.
+
+    The server calls touch() on every request; tasks only start once no
+    request has arrived for QUIET_SECONDS, and the scheduler checks again
+    after every task, so a burst of traffic pauses the remaining work.
+    """
+    INTERVAL = 5
+    QUIET_SECONDS = 2
+    # Seconds between runs of each task
+    CHECKPOINT_EVERY = 60
+    OPTIMIZE_EVERY = 3600
+    VACUUM_EVERY = 3600
+    ORPHANS_EVERY = 3600
+    BACKUP_EVERY = 6 * 3600
+    ARCHIVE_EVERY = 24 * 3600
+    # Backups kept in the backup directory
+    BACKUP_KEEP = 5
+    REPORTS = 50
+
+    def __init__(self, db, backup_dir=None, archive_days=None):
+        self.db = db
+        self.backup_dir = backup_dir
+        self.archive_days = archive_days
+        self.last_request = time.time()
+        self.last_run = {}
+        self.reports = deque(maxlen=self.REPORTS)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='maintenance', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def touch(self):
+        """Record activity; maintenance waits until things are quiet again"""
+        self.last_request = time.time()
+
+    def quiet(self):
+        return time.time() - self.last_request >= self.QUIET_SECONDS
+
+    def tasks(self):
+        """(name, period, function) of every scheduled task"""
+        tasks = [('checkpoint', self.CHECKPOINT_EVERY, self.db.checkpoint),
+                 ('optimize', self.OPTIMIZE_EVERY, self.db.optimize),
+                 ('vacuum', self.VACUUM_EVERY, self.vacuum),
+                 ('orphans', self.ORPHANS_EVERY, self.db.purge_orphans)]
+        if self.backup_dir:
+            tasks.append(('backup', self.BACKUP_EVERY, self.backup))
+        if self.archive_days is not None:
+            tasks.append(('archive', self.ARCHIVE_EVERY, self.archive))
+        return tasks
+
+    def archive(self):
+        """Archive appointments and medical records older than archive_days"""
+        return self.db.archive((datetime.now() - timedelta(days=self.archive_days)).strftime('%Y-%m-%d'))
+
+    def vacuum(self):
+        """Incremental vacuum, skipped until it is enabled (see
+        enable_vacuum)"""
+        if not self.db.incremental_vacuum_enabled():
+            return {'task': 'incremental_vacuum', 'skipped': 'incremental vacuum is not enabled',
+                    'pages': 0, 'seconds': 0}
+        return self.db.incremental_vacuum()
+
+    def enable_vacuum(self):
+        """Switch the database to incremental vacuum now, which rewrites
+        the whole file (and every shard); only done on request"""
+        return self.run_task('enable_vacuum', self.db.enable_incremental_vacuum)
+
+    def backup(self):
+        """Back up into the backup directory and drop the oldest backups"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(self.db.db_name))[0]
+        target = os.path.join(self.backup_dir, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+        # Written under a temporary name so a crash never leaves a partial
+        # file that looks like a backup
+        report = self.db.backup(target + '.part')
+        os.replace(target + '.part', target)
+        report['file'] = target
+        for old in sorted(glob.glob(os.path.join(self.backup_dir, f'{name}-*.db')))[:-self.BACKUP_KEEP]:
+            os.remove(old)
+        return report
+
+    def run_task(self, name, function):
+        try:
+            report = function()
+        except Exception as e:
+            report = {'task': name, 'error': str(e), 'pages': 0, 'seconds': 0}
+        report['finished_at'] = time.time()
+        with self.lock:
+            self.last_run[name] = report['finished_at']
+            self.reports.append(report)
+        if report.get('error'):
+            print(f"Maintenance {name} failed: {report['error']}")
+        elif report.get('pages'):
+            print(f"Maintenance {report['task']}: {report['pages']} pages in {report['seconds'] * 1000:.0f} ms")
+        elif report.get('rows'):
+            print(f"Maintenance {report['task']}: {report['rows']} rows in {report['seconds'] * 1000:.0f} ms")
+        return report
+
+    def run_due(self, force=False):
+        """Run the tasks that are due (all of them with force); returns
+        their reports"""
+        reports = []
+        for name, period, function in self.tasks():
+            if not force and (not self.quiet() or time.time() - self.last_run.get(name, 0) < period):
+                continue
+            reports.append(self.run_task(name, function))
+        return reports
+
+    def summary(self):
+        """Recent task reports, plus total time and pages (or rows) per task"""
+        with self.lock:
+            reports = list(self.reports)
+        totals = {}
+        for report in reports:
+            total = totals.setdefault(report['task'], {'runs': 0, 'pages': 0, 'rows': 0, 'seconds': 0})
+            total['runs'] += 1
+            total['pages'] += report.get('pages', 0)
+            total['rows'] += report.get('rows', 0)
+            total['seconds'] += report['seconds']
+        return {'totals': totals, 'reports': reports}
+
+    def run(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.run_due()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    enable_vacuum = '--enable-vacuum' in args
+    if enable_vacuum:
+        args.remove('--enable-vacuum')
+    if not args:
+        print("Usage: python maintenance.py <db_name> [backup_file] [--enable-vacuum]")
+        sys.exit(1)
+
+    db = open_database(args[0], os.path.splitext(os.path.basename(args[0]))[0])
+    reports = [db.checkpoint('TRUNCATE'), db.optimize()]
+    if enable_vacuum and not db.incremental_vacuum_enabled():
+        reports.append(db.enable_incremental_vacuum())
+    if db.incremental_vacuum_enabled():
+        reports.append(db.incremental_vacuum())
+    else:
+        print("incremental_vacuum: skipped, not enabled (see --enable-vacuum)")
+    if len(args) > 1:
+        reports.append(db.backup(args[1]))
+    for report in reports:
+        print(f"{report['task']}: {report['pages']} pages in {report['seconds'] * 1000:.0f} ms")
@@ -0,0 +1,232 @@
+"""Log-shipping replication of hospital databases into a master replica.
+
+Each hospital server runs a ChangeShipper that reads its change log and
+pushes committed changes to the master in batches. The master applies them
+to a ReplicaDatabase, recording per hospital the last change sequence it
+applied, so a shipper that was disconnected resumes from exactly there.
+"""
+from client import FederationClient
+from database import GID_REFERENCES, make_gid
+import sqlite3
+import threading
+import time
+
+# Columns copied for each table, besides the global IDs
+REPLICATED_COLUMNS = {
+    'patients': ('patient_id', 'name', 'age', 'gender', 'phone', 'address', 'created_at'),
+    'doctors': ('doctor_id', 'name', 'specialization', 'phone', 'email', 'created_at'),
+    'appointments': ('appointment_id', 'patient_id', 'doctor_id', 'appointment_date',
+                     'appointment_time', 'status', 'created_at'),
+    'medical_records': ('record_id', 'patient_id', 'doctor_id', 'diagnosis', 'prescription',
+                        'notes', 'record_date', 'created_at'),
+}
+
+class ReplicaDatabase:
+    """Master-side copy of remote hospitals' tables, keyed by global ID"""
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        conn = sqlite3.connect(db_name)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS replication_sources (
+                hospital_id INTEGER PRIMARY KEY,
+                hospital TEXT,
+                seq INTEGER NOT NULL DEFAULT 0,
+                applied_at REAL
+            )
+        ''')
+        for table, columns in REPLICATED_COLUMNS.items():
+            references = [f'{column[:-3]}_gid INTEGER' for column in GID_REFERENCES.get(table, ())]
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    gid INTEGER PRIMARY KEY,
+                    {", ".join(columns + tuple(references))}
+                )
+            ''')
+        conn.commit()
+        conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def position(self, hospital_id):
+        """Last change sequence applied for a hospital (0 if never seen)"""
+        conn = self.connect()
+        row = conn.execute('SELECT seq FROM replication_sources WHERE hospital_id = ?', (hospital_id,)).fetchone()
+        conn.close()
+        return row['seq'] if row else 0
+
+    def sources(self):
+        conn = self.connect()
+        rows = [dict(row) for row in conn.execute('SELECT * FROM replication_sources')]
+        conn.close()
+        return rows
+
+    def has_source(self, hospital_id):
+        return any(source['hospital_id'] == hospital_id for source in self.sources())
+
+    def apply(self, hospital_id, hospital, from_seq, seq, changes):
+        """Apply one batch of a hospital's change feed.
+
+        The batch is only applied if it starts where the last one ended, and
+        the rows and the new position are committed together, so a retried
+        or overlapping batch is never applied twice. Returns the position
+        after the call.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT seq FROM replication_sources WHERE hospital_id = ?',
+                               (hospital_id,)).fetchone()
+            position = row['seq'] if row else 0
+            if from_seq != position:
+                conn.rollback()
+                return position
+            for change in changes:
+                table = change['table']
+                if table not in REPLICATED_COLUMNS:
+                    continue
+                if change['row'] is None:
+                    # An archived row is still there, only no longer hot
+                    if change['op'] == 'archive':
+                        continue
+                    conn.execute(f'DELETE FROM {table} WHERE gid = ?',
+                                 (make_gid(hospital_id, change['row_id']),))
+                    continue
+                columns = ('gid',) + REPLICATED_COLUMNS[table] + tuple(
+                    f'{column[:-3]}_gid' for column in GID_REFERENCES.get(table, ()))
+                conn.execute(f'INSERT OR REPLACE INTO {table} ({", ".join(columns)}) '
+                             f'VALUES ({", ".join("?" for _ in columns)})',
+                             [change['row'].get(column) for column in columns])
+            conn.execute('INSERT OR REPLACE INTO replication_sources (hospital_id, hospital, seq, applied_at) '
+                         'VALUES (?, ?, ?, ?)', (hospital_id, hospital, seq, time.time()))
+            conn.commit()
+            return seq
+        finally:
+            conn.close()
+
+    def load_snapshot(self, hospital_id, hospital, path, seq):
+        """Replace a hospital's replica with a snapshot of its database
+        (see HospitalDatabase.snapshot) taken at change sequence seq.
+
+        Skipped if the replica is already at or past seq. Afterwards change
+        batches are accepted from seq on, so shipping resumes from the
+        snapshot. Returns the position after the call.
+        """
+        low, high = make_gid(hospital_id, 0), make_gid(hospital_id + 1, 0)
+        conn = self.connect()
+        try:
+            conn.execute('ATTACH DATABASE ? AS snapshot', (path,))
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT seq FROM replication_sources WHERE hospital_id = ?',
+                               (hospital_id,)).fetchone()
+            if row and row['seq'] >= seq:
+                conn.rollback()
+                return row['seq']
+            for table, columns in REPLICATED_COLUMNS.items():
+                references = GID_REFERENCES.get(table, ())
+                conn.execute(f'DELETE FROM main.{table} WHERE gid >= ? AND gid < ?', (low, high))
+                conn.execute(f'''
+                    INSERT INTO main.{table} (gid, {", ".join(columns)}{"".join(f", {c[:-3]}_gid" for c in references)})
+                    SELECT ? | {columns[0]}, {", ".join(columns)}{"".join(f", ? | {c}" for c in references)}
+                    FROM snapshot.{table}
+                ''', (low,) * (1 + len(references)))
+            conn.execute('INSERT OR REPLACE INTO replication_sources (hospital_id, hospital, seq, applied_at) '
+                         'VALUES (?, ?, ?, ?)', (hospital_id, hospital, seq, time.time()))
+            conn.commit()
+            return seq
+        finally:
+            conn.close()
+
+    def search(self, table, hospital_id, search_term=''):
+        """A hospital's replicated rows, filtered like HospitalDatabase.search;
+        appointments and records come with names like list views"""
+        # A hospital's global IDs are one contiguous range of the primary key
+        if table in GID_REFERENCES:
+            query = (f'SELECT e.*, p.name AS patient_name, d.name AS doctor_name, '
+                     f'd.specialization AS doctor_specialization FROM {table} e '
+                     f'LEFT JOIN patients p ON p.gid = e.patient_gid LEFT JOIN doctors d ON d.gid = e.doctor_gid')
+        else:
+            query = f'SELECT * FROM {table} e'
+        query += ' WHERE e.gid >= ? AND e.gid < ?'
+        params = [make_gid(hospital_id, 0), make_gid(hospital_id + 1, 0)]
+        if search_term:
+            columns = REPLICATED_COLUMNS[table]
+            query += f' AND ({" OR ".join(f"e.{column} LIKE ?" for column in columns)})'
+            params.extend(f'%{search_term}%' for _ in columns)
+        conn = self.connect()
+        rows = [dict(row) for row in conn.execute(query, params)]
+        conn.close()
+        return rows
+
+class ChangeShipper:
+    """Pushes a hospital's committed changes to the master in the background.
+
+    Polls the change log every INTERVAL seconds (or right away after
+    notify()), sends up to BATCH_SIZE changes per request and keeps going
+    until caught up. After an error it backs off and then asks the master
+    where it left off, so a disconnect is caught up on reconnection.
+    """
+    INTERVAL = 1.0
+    BATCH_SIZE = 500
+    MAX_BACKOFF = 30
+
+    def __init__(self, db, master_url):
+        self.db = db
+        self.master = FederationClient(master_url)
+        self.position = None
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='replication-shipper', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def notify(self):
+        """Ship soon, e.g. right after a write"""
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def ship(self):
+        """Push everything after the master's position; returns the number of changes sent"""
+        if self.position is None:
+            self.position = self.master.replication_position(self.db.hospital_id)
+            if self.position is None:
+                raise ConnectionError('master unreachable')
+        sent = 0
+        while True:
+            seq, changes = self.db.change_feed(self.position, limit=self.BATCH_SIZE)
+            if not changes:
+                return sent
+            applied = self.master.push_changes(self.db.hospital_id, {
+                'hospital': self.db.hospital_name,
+                'from_seq': self.position,
+                'seq': seq,
+                'changes': changes,
+            })
+            if applied is None:
+                self.position = None
+                raise ConnectionError('push failed')
+            # The master answers with its own position, which differs from
+            # seq only if it had a different idea of where we were
+            self.position = applied
+            if applied == seq:
+                sent += len(changes)
+
+    def run(self):
+        backoff = self.INTERVAL
+        while not self.stopped.is_set():
+            try:
+                self.ship()
+                backoff = self.INTERVAL
+            except ConnectionError:
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+            self.wake.wait(backoff)
+            self.wake.clear()
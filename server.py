@@ -1,84 +1,315 @@
-from flask import Flask, request, jsonify
-from database import HospitalDatabase
+from flask import Flask, Response, request, jsonify
+from database import ID_COLUMNS, VIEW_FILTERS
+from sharding import open_database
+from bloom import SearchSketch
+from replication import ChangeShipper
+from maintenance import MaintenanceScheduler
+import os
 import sys
+import tempfile
+import time
+import zlib
+
+# Bytes of database file read and compressed at a time for /snapshot
+SNAPSHOT_CHUNK = 64 * 1024
+# Longest a /changes request waits for new changes (?wait=), and how often
+# a waiting request looks at the change log
+CHANGES_MAX_WAIT = 60
+CHANGES_POLL = 0.25
 
 app = Flask(__name__)
 db = None
+sketch = None
+shipper = None
+maintenance = None
+
+@app.after_request
+def ship_writes(response):
+    """Wake the replication shipper after every write and hold off
+    maintenance while requests keep coming"""
+    if shipper and request.method in ('POST', 'PUT', 'DELETE'):
+        shipper.notify()
+    if maintenance:
+        maintenance.touch()
+    return response
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'hospital': db.hospital_name})
+    return jsonify({'status': 'ok', 'hospital': db.hospital_name, 'hospital_id': db.hospital_id})
+
+@app.route('/sketch', methods=['GET'])
+def search_sketch():
+    """Bloom filters of searchable values, so the master can skip this
+    hospital for searches that can't match. Pass ?seq= to get an empty
+    answer when nothing changed since that version."""
+    sketch.refresh()
+    if request.args.get('seq', type=int) == sketch.seq:
+        return jsonify({'hospital': db.hospital_name, 'seq': sketch.seq, 'unchanged': True})
+    return jsonify({'hospital': db.hospital_name, **sketch.to_dict()})
+
+@app.route('/changes', methods=['GET'])
+def changes():
+    """Change feed: rows written after ?since=<seq>, optionally for
+    ?table=<name> only and at most ?limit=<n> log entries. With ?wait=<s>,
+    waits up to that many seconds for a change if there is none yet."""
+    tables = request.args.getlist('table') or None
+    since, limit = request.args.get('since', 0, type=int), request.args.get('limit', type=int)
+    deadline = time.monotonic() + min(request.args.get('wait', 0, type=float), CHANGES_MAX_WAIT)
+    seq, entries = db.change_feed(since, tables, limit)
+    while not entries and time.monotonic() < deadline:
+        time.sleep(CHANGES_POLL)
+        seq, entries = db.change_feed(since, tables, limit)
+    return jsonify({'hospital': db.hospital_name, 'seq': seq, 'latest': db.last_change(),
+                    'changes': entries})
+
+@app.route('/snapshot', methods=['GET'])
+def snapshot():
+    """Consistent copy of the whole database, gzip-compressed and streamed
+    in chunks. X-Snapshot-Seq is the change sequence it corresponds to, to
+    continue from with /changes?since=."""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        seq = db.snapshot(path)
+    except:
+        os.remove(path)
+        raise
+    
+    def stream():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(SNAPSHOT_CHUNK)
+                    if not chunk:
+                        break
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+            yield compressor.flush()
+        finally:
+            os.remove(path)
+    
+    return Response(stream(), mimetype='application/gzip',
+                    headers={'X-Snapshot-Seq': str(seq), 'X-Hospital-Id': str(db.hospital_id)})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Dashboard summary from the statistics tables: appointments by status
+    and by day (from ?since=YYYY-MM-DD), patients per doctor and the ?top=
+    most common diagnoses"""
+    return jsonify(db.stats(request.args.get('since') or None, request.args.get('top', 10, type=int)))
 
-@app.route('/patients', methods=['GET', 'POST'])
+@app.route('/doctors/<int:doctor_id>/availability', methods=['GET'])
+def doctor_availability(doctor_id):
+    """Whether the doctor is free at ?date=YYYY-MM-DD&time=HH:MM, with the
+    appointments in the way"""
+    date, time_text = request.args.get('date'), request.args.get('time')
+    try:
+        conflicts = db.conflicts(doctor_id, date or '', time_text)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'date (YYYY-MM-DD) and time (HH:MM) are required'}), 400
+    return jsonify({'hospital': db.hospital_name, 'doctor_id': doctor_id, 'date': date, 'time': time_text,
+                    'available': not conflicts, 'conflicts': conflicts})
+
+@app.route('/availability', methods=['GET'])
+def availability():
+    """The next ?count= free slots of the ?specialization= doctors (or of
+    ?doctor_id=), from ?after=YYYY-MM-DD HH:MM or now"""
+    try:
+        slots = db.free_slots(request.args.get('specialization'), request.args.get('count', 5, type=int),
+                              request.args.get('after') or None, request.args.get('doctor_id', type=int))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'after must be YYYY-MM-DD HH:MM'}), 400
+    return jsonify({'hospital': db.hospital_name, 'slots': slots})
+
+@app.route('/maintenance', methods=['GET', 'POST'])
+def maintenance_status():
+    """Time spent and pages moved by recent maintenance tasks; POST runs
+    every task now, with ?enable_vacuum=1 after switching the database to
+    incremental vacuum"""
+    if request.method == 'POST':
+        reports = [maintenance.enable_vacuum()] if request.args.get('enable_vacuum') else []
+        return jsonify(reports + maintenance.run_due(force=True))
+    return jsonify(maintenance.summary())
+
+@app.route('/patients', methods=['GET', 'POST', 'DELETE'])
 def patients():
     if request.method == 'GET':
         search_term = request.args.get('search', '')
         return jsonify(db.search('patients', search_term))
     elif request.method == 'POST':
-        data = request.json
-        patient_id = db.insert('patients', data)
-        return jsonify({'patient_id': patient_id, 'status': 'success'})
+        return insert_row('patients')
+    else:
+        return delete_listed('patients')
 
-@app.route('/doctors', methods=['GET', 'POST'])
+@app.route('/doctors', methods=['GET', 'POST', 'DELETE'])
 def doctors():
     if request.method == 'GET':
         search_term = request.args.get('search', '')
         return jsonify(db.search('doctors', search_term))
     elif request.method == 'POST':
-        data = request.json
-        doctor_id = db.insert('doctors', data)
-        return jsonify({'doctor_id': doctor_id, 'status': 'success'})
+        return insert_row('doctors')
+    else:
+        return delete_listed('doctors')
 
-@app.route('/appointments', methods=['GET', 'POST'])
+@app.route('/appointments', methods=['GET', 'POST', 'DELETE'])
 def appointments():
     if request.method == 'GET':
-        return jsonify(db.get_all('appointments'))
+        return jsonify(db.get_all('appointments', include_archive=bool(request.args.get('archive'))))
     elif request.method == 'POST':
-        data = request.json
-        appointment_id = db.insert('appointments', data)
-        return jsonify({'appointment_id': appointment_id, 'status': 'success'})
+        return insert_row('appointments')
+    else:
+        return delete_listed('appointments')
 
-@app.route('/medical_records', methods=['GET', 'POST'])
+@app.route('/medical_records', methods=['GET', 'POST', 'DELETE'])
 def medical_records():
     if request.method == 'GET':
-        return jsonify(db.get_all('medical_records'))
+        return jsonify(db.get_all('medical_records', include_archive=bool(request.args.get('archive'))))
     elif request.method == 'POST':
-        data = request.json
-        record_id = db.insert('medical_records', data)
-        return jsonify({'record_id': record_id, 'status': 'success'})
-
-@app.route('/patients/<int:patient_id>', methods=['DELETE'])
-def delete_patient(patient_id):
-    db.delete('patients', 'patient_id', patient_id)
-    return jsonify({'status': 'success'})
-
-@app.route('/doctors/<int:doctor_id>', methods=['DELETE'])
-def delete_doctor(doctor_id):
-    db.delete('doctors', 'doctor_id', doctor_id)
-    return jsonify({'status': 'success'})
-
-@app.route('/appointments/<int:appointment_id>', methods=['DELETE'])
-def delete_appointment(appointment_id):
-    db.delete('appointments', 'appointment_id', appointment_id)
-    return jsonify({'status': 'success'})
-
-@app.route('/medical_records/<int:record_id>', methods=['DELETE'])
-def delete_medical_record(record_id):
-    db.delete('medical_records', 'record_id', record_id)
-    return jsonify({'status': 'success'})
-
-def start_server(hospital_name, port, db_name):
-    global db
-    db = HospitalDatabase(db_name, hospital_name)
+        return insert_row('medical_records')
+    else:
+        return delete_listed('medical_records')
+
+@app.route('/patients/<int:patient_id>/timeline', methods=['GET'])
+def patient_timeline(patient_id):
+    """The patient with their appointments and medical records, oldest
+    first, with the doctors' names (?archive=1 includes archived ones)"""
+    timeline = db.timeline(patient_id, bool(request.args.get('archive')))
+    if timeline is None:
+        return jsonify({'status': 'error', 'message': f'Unknown patient {patient_id}'}), 404
+    return jsonify(timeline)
+
+@app.route('/views/<table>', methods=['GET'])
+def list_view(table):
+    """Appointments or medical records with the patient's and doctor's
+    names: ?search=, column filters (?status=, ?doctor_id=, ...), ?since= and
+    ?until= dates, ?limit= and ?offset= paging, ?archive=1"""
+    if table not in VIEW_FILTERS:
+        return jsonify({'status': 'error', 'message': f'Unknown view {table}'}), 404
+    filters = {column: request.args[column] for column in VIEW_FILTERS[table] if column in request.args}
+    limit, offset = request.args.get('limit', type=int), request.args.get('offset', 0, type=int)
+    page = db.list_view(table, request.args.get('search', ''), filters, request.args.get('since'),
+                        request.args.get('until'), limit, offset, bool(request.args.get('archive')))
+    return jsonify({'hospital': db.hospital_name, 'limit': limit, 'offset': offset, **page})
+
+def write_answer(table, result):
+    """Answer to a write: the row as stored (or as deleted) and the number
+    of rows affected, plus the row's ID and global ID as before, and for
+    deletes the rows deleted with it per table"""
+    answer = {'status': 'success', 'row': result['row'], 'count': result['count']}
+    if 'cascaded' in result:
+        answer['cascaded'] = result['cascaded']
+    if result['row']:
+        answer[ID_COLUMNS[table]] = result['row'][ID_COLUMNS[table]]
+        answer['gid'] = result['row']['gid']
+    return answer
+
+def write_response(table, result):
+    return jsonify(write_answer(table, result))
+
+def valid_ids(ids):
+    """Whether ids is a list of row IDs (integers, not booleans)"""
+    return isinstance(ids, list) and all(isinstance(row_id, int) and not isinstance(row_id, bool)
+                                         for row_id in ids)
+
+def insert_row(table):
+    """POST inserts the row in the JSON body (415 if the body isn't JSON)"""
+    if not isinstance(request.json, dict) or not request.json:
+        return jsonify({'status': 'error', 'message': 'Expected the new row as a JSON object'}), 400
+    return write_response(table, db.insert(table, request.json))
+
+def delete_listed(table):
+    """Bulk delete of the rows whose IDs are listed in the JSON body's
+    'ids', in one transaction; patients and doctors take their appointments
+    and medical records with them"""
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not valid_ids(ids):
+        return jsonify({'status': 'error', 'message': 'Expected a list of IDs in ids'}), 400
+    return jsonify({'status': 'success', **db.delete_many(table, ID_COLUMNS[table], ids)})
+
+def write_row(table, row_id):
+    """PUT updates the row with the columns in the JSON body; DELETE
+    deletes it"""
+    if request.method == 'PUT':
+        if not isinstance(request.json, dict) or not request.json:
+            return jsonify({'status': 'error', 'message': 'No columns to update'}), 400
+        return write_response(table, db.update(table, ID_COLUMNS[table], row_id, request.json))
+    return write_response(table, db.delete(table, ID_COLUMNS[table], row_id))
+
+@app.route('/patients/<int:patient_id>', methods=['PUT', 'DELETE'])
+def patient_row(patient_id):
+    return write_row('patients', patient_id)
+
+@app.route('/doctors/<int:doctor_id>', methods=['PUT', 'DELETE'])
+def doctor_row(doctor_id):
+    return write_row('doctors', doctor_id)
+
+@app.route('/appointments/<int:appointment_id>', methods=['PUT', 'DELETE'])
+def appointment_row(appointment_id):
+    return write_row('appointments', appointment_id)
+
+@app.route('/medical_records/<int:record_id>', methods=['PUT', 'DELETE'])
+def medical_record_row(record_id):
+    return write_row('medical_records', record_id)
+
+def setup(hospital_name, db_name, hospital_id=None, master_url=None, backup_dir=None, archive_days=None,
+          shards=None):
+    """Open the database and start the background services of a hospital
+    server (also used by asgi_server.py)"""
+    global db, sketch, shipper, maintenance
+    db = open_database(db_name, hospital_name, shards)
+    db.register_hospital_id(hospital_id)
+    print(f"{hospital_name} registered with hospital ID {db.hospital_id}")
+    if getattr(db, 'shards', None):
+        print(f"Patients, appointments and medical records are split over {len(db.shards)} shards")
+    sketch = SearchSketch(db)
+    if master_url:
+        shipper = ChangeShipper(db, master_url).start()
+        print(f"Replicating changes to {master_url}")
+    maintenance = MaintenanceScheduler(db, backup_dir, archive_days).start()
+    if backup_dir:
+        print(f"Backing up to {backup_dir}")
+    if archive_days is not None:
+        print(f"Archiving appointments and medical records older than {archive_days} days to {db.archive_name}")
+
+def start_server(hospital_name, port, db_name, hospital_id=None, master_url=None, backup_dir=None,
+                 archive_days=None, shards=None):
+    setup(hospital_name, db_name, hospital_id, master_url, backup_dir, archive_days, shards)
     app.run(host='0.0.0.0', port=port, debug=False)
 
-if __name__ == '__main__':
-    if len(sys.argv) < 4:
-        print("Usage: python server.py <hospital_name> <port> <db_name>")
+def pop_option(args, name):
+    """Remove --name <value> from args and return the value ('' if the
+    value is missing, None if the option isn't there)"""
+    if name not in args:
+        return None
+    index = args.index(name)
+    value = args[index + 1] if index + 1 < len(args) else ''
+    del args[index:index + 2]
+    return value
+
+def parse_arguments(args, program):
+    """start_server() arguments from the command line, or exit with the
+    usage message"""
+    args = list(args)
+    master_url = pop_option(args, '--master')
+    backup_dir = pop_option(args, '--backup-dir')
+    archive_days = pop_option(args, '--archive-days')
+    shards = pop_option(args, '--shards')
+    if len(args) < 3 or '' in (master_url, backup_dir, archive_days, shards):
+        print(f"Usage: python {program} <hospital_name> <port> <db_name> [hospital_id] "
+              "[--master <federation_url>] [--backup-dir <dir>] [--archive-days <days>] [--shards <n>]")
         sys.exit(1)
     
-    hospital_name = sys.argv[1]
-    port = int(sys.argv[2])
-    db_name = sys.argv[3]
+    hospital_name = args[0]
+    port = int(args[1])
+    db_name = args[2]
+    hospital_id = int(args[3]) if len(args) > 3 else None
     
-    start_server(hospital_name, port, db_name)
+    return (hospital_name, port, db_name, hospital_id, master_url, backup_dir,
+            int(archive_days) if archive_days is not None else None,
+            int(shards) if shards is not None else None)
+
+if __name__ == '__main__':
+    start_server(*parse_arguments(sys.argv[1:], 'server.py'))
@@ -0,0 +1,511 @@
+"""Hash-sharded storage of patient-centric tables.
+
+A ShardedHospitalDatabase keeps doctors, settings and the change log in the
+main database file, and spreads patients, appointments and medical records
+over N shard files (<db>_shard0.db, ...) by patient ID, so writes for
+different patients go to different files with their own write locks. It is
+a drop-in HospitalDatabase: reads scatter to every shard in parallel and
+merge the rows by ID.
+
+Each shard logs its own writes; merge_logs() copies them into the main
+change log, so change feed consumers still see one sequence.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from database import (HospitalDatabase, ARCHIVE_DATES, DEPENDENTS, ID_COLUMNS, STATS_TABLES,
+                      TIMELINE_COLUMNS, delete_dependents, delete_rows, returned_rows)
+import itertools
+import json
+import os
+import sqlite3
+import threading
+
+# Tables spread over the shards, all keyed by patient ID
+SHARDED_TABLES = ('patients', 'appointments', 'medical_records')
+
+# Key columns of each statistics table
+STATS_KEYS = {summary: keys for summaries in STATS_TABLES.values()
+              for summary, keys, expressions, condition in summaries}
+
+def open_database(db_name, hospital_name, shards=None):
+    """HospitalDatabase for db_name, sharded if it was set up with shards
+    (or shards is given, which shards an existing database)"""
+    if shards is None:
+        shards = stored_shard_count(db_name)
+    if shards:
+        return ShardedHospitalDatabase(db_name, hospital_name, shards)
+    return HospitalDatabase(db_name, hospital_name)
+
+def stored_shard_count(db_name):
+    if not os.path.exists(db_name):
+        return None
+    conn = sqlite3.connect(db_name)
+    try:
+        row = conn.execute("SELECT value FROM hospital_meta WHERE key = 'shards'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return int(row[0]) if row else None
+
+def returning(query, params):
+    """Statement for write() that returns the rows of its RETURNING clause"""
+    return lambda conn: returned_rows(conn.execute(query, params))
+
+class ShardedHospitalDatabase(HospitalDatabase):
+    """HospitalDatabase with patients, appointments and medical records in
+    shard files.
+
+    A patient lives in shard patient_id % N, together with its
+    appointments and medical records. New rows get IDs that are unique
+    across shards: shard i only hands out IDs equal to i modulo N, above
+    any ID used before. Every shard has its own writer thread, so writes to
+    different shards run in parallel.
+    """
+    # Log entries copied from a shard per main-database transaction
+    MERGE_BATCH = 5000
+
+    def __init__(self, db_name, hospital_name, shards, archive_name=None):
+        self.shards = []
+        super().__init__(db_name, hospital_name, archive_name)
+        stored = stored_shard_count(db_name)
+        if stored is not None and stored != shards:
+            raise ValueError(f"{db_name} is split into {stored} shards, not {shards}")
+
+        base = os.path.splitext(db_name)[0]
+        for index in range(shards):
+            shard = HospitalDatabase(f'{base}_shard{index}.db', hospital_name)
+            shard.register_hospital_id(self.hospital_id)
+            self.shards.append(shard)
+        self.next_shard = itertools.count()
+        self.merge_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=shards, thread_name_prefix='shard')
+        # Runs the *_async writes, which fan out to shards through pool
+        self.async_writes = ThreadPoolExecutor(max_workers=shards, thread_name_prefix='shard-write')
+        self.execute_query('CREATE TABLE IF NOT EXISTS shard_cursors (shard INTEGER PRIMARY KEY, seq INTEGER)')
+        if stored is None:
+            self.split_existing()
+
+    def register_hospital_id(self, hospital_id=None):
+        hospital_id = super().register_hospital_id(hospital_id)
+        for shard in self.shards:
+            shard.register_hospital_id(hospital_id)
+        return hospital_id
+
+    def shard_index(self, patient_id):
+        return int(patient_id) % len(self.shards) if patient_id not in (None, '') else 0
+
+    def scatter(self, function):
+        """function(shard) on every shard in parallel; results in shard order"""
+        return list(self.pool.map(function, self.shards))
+
+    def gather(self, table, results, limit=None):
+        """Merge per-shard row lists by ID (a row caught moving between
+        shards counts once)"""
+        id_column = ID_COLUMNS[table]
+        rows = {row[id_column]: row for result in results for row in result}
+        rows = [rows[row_id] for row_id in sorted(rows)]
+        return rows[:limit] if limit else rows
+
+    def locate(self, table, id_column, id_value):
+        """Index of the shard holding the row, or None"""
+        if table == 'patients' and id_column == 'patient_id':
+            return self.shard_index(id_value)
+        found = self.scatter(lambda shard: shard.execute_query(
+            f'SELECT 1 FROM {table} WHERE {id_column} = ? LIMIT 1', (id_value,)))
+        return next((index for index, rows in enumerate(found) if rows), None)
+
+    def write(self, index, statements):
+        """Run statements ((sql, params) pairs, or callables taking the
+        connection) together on a shard's writer thread; returns the last
+        result"""
+        def run(conn):
+            for statement in statements:
+                result = statement(conn) if callable(statement) else conn.execute(*statement)
+            return result
+        return self.shards[index].submit(run).result()
+
+    def allocate_id(self, conn, index, table):
+        """Next unused ID for a new row of table in shard index; called in
+        the write transaction that inserts it"""
+        row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+        last = row[0] if row else 0
+        shards = len(self.shards)
+        return (last // shards + 1) * shards + index
+
+    # Writes
+
+    def insert_async(self, table, data):
+        if table not in SHARDED_TABLES:
+            return super().insert_async(table, data)
+        return self.async_writes.submit(self.insert, table, data)
+
+    def update_async(self, table, id_column, id_value, data):
+        if table not in SHARDED_TABLES:
+            return super().update_async(table, id_column, id_value, data)
+        return self.async_writes.submit(self.update, table, id_column, id_value, data)
+
+    def delete_async(self, table, id_column, id_value):
+        return self.async_writes.submit(self.delete, table, id_column, id_value)
+
+    def delete_many_async(self, table, id_column, ids):
+        return self.async_writes.submit(self.delete_many, table, id_column, ids)
+
+    def insert(self, table, data):
+        if table not in SHARDED_TABLES:
+            return super().insert(table, data)
+        if table == 'patients':
+            index = next(self.next_shard) % len(self.shards)
+        else:
+            index = self.shard_index(data.get('patient_id'))
+
+        def insert_row(conn):
+            row = {**data, ID_COLUMNS[table]: self.allocate_id(conn, index, table)}
+            return returned_rows(conn.execute(f'INSERT INTO {table} ({", ".join(row)}) '
+                                              f'VALUES ({", ".join("?" for _ in row)}) RETURNING *',
+                                              list(row.values())))
+        return self.write_result(table, self.write(index, [insert_row]))
+
+    def update(self, table, id_column, id_value, data):
+        if table not in SHARDED_TABLES:
+            return super().update(table, id_column, id_value, data)
+        index = self.locate(table, id_column, id_value)
+        if index is None:
+            return self.write_result(table, [])
+        assignments = ', '.join(f'{key} = ?' for key in data)
+        target = self.shard_index(data['patient_id']) if table != 'patients' and 'patient_id' in data else index
+        if target == index:
+            return self.write_result(table, self.write(index, [returning(
+                f'UPDATE {table} SET {assignments} WHERE {id_column} = ? RETURNING *',
+                list(data.values()) + [id_value])]))
+        # Moved to another patient in another shard: copy the updated row
+        # over first, so it is never missing, then drop the old one. The
+        # drop isn't logged: merge_logs copies shard logs in shard order, so
+        # a logged delete could land after the copy's insert.
+        row = self.shards[index].execute_query(f'SELECT * FROM {table} WHERE {id_column} = ?', (id_value,))[0]
+        row.update(data)
+        rows = self.write(target, [returning(f'INSERT OR REPLACE INTO {table} ({", ".join(row)}) '
+                                             f'VALUES ({", ".join("?" for _ in row)}) RETURNING *',
+                                             list(row.values()))])
+        self.write(index, [("INSERT OR REPLACE INTO hospital_meta (key, value) VALUES ('moving_rows', 'shard')",),
+                           (f'DELETE FROM {table} WHERE {id_column} = ?', (id_value,)),
+                           ("DELETE FROM hospital_meta WHERE key = 'moving_rows'",)])
+        return self.write_result(table, rows)
+
+    def delete(self, table, id_column, id_value):
+        result = self.delete_many(table, id_column, [id_value])
+        return {**self.write_result(table, result['rows']), 'cascaded': result['cascaded']}
+
+    def delete_many(self, table, id_column, ids):
+        """Patients are deleted with their appointments and medical records
+        in one transaction per shard, as these share the patient's shard. A
+        doctor's rows are in every shard, so they are deleted shard by shard
+        before the doctor: an interrupted delete leaves the doctor in place,
+        and purge_orphans would remove rows it missed."""
+        cascaded = {dependent: 0 for dependent, column in DEPENDENTS.get(table, ())}
+        if table not in SHARDED_TABLES:
+            if table in DEPENDENTS:
+                parent_ids = [row[ID_COLUMNS[table]] for row in self.read(
+                    f'SELECT {ID_COLUMNS[table]} FROM {table} WHERE {id_column} IN (SELECT value FROM json_each(?))',
+                    (json.dumps(list(ids)),))]
+                for counts in self.scatter(lambda shard: shard.submit(
+                        lambda conn: delete_dependents(conn, table, parent_ids)).result()):
+                    for dependent, count in counts.items():
+                        cascaded[dependent] += count
+            result = super().delete_many_async(table, id_column, ids).result()
+            return {**result, 'cascaded': {dependent: count + result['cascaded'][dependent]
+                                           for dependent, count in cascaded.items()}}
+        if table == 'patients' and id_column == 'patient_id':
+            by_shard = {}
+            for patient_id in ids:
+                by_shard.setdefault(self.shard_index(patient_id), []).append(patient_id)
+        else:
+            by_shard = {index: list(ids) for index in range(len(self.shards))}
+        rows = []
+        for index, shard_ids in by_shard.items():
+            shard_rows, shard_cascaded = self.write(index, [lambda conn: delete_rows(conn, table, id_column, shard_ids)])
+            rows.extend(shard_rows)
+            for dependent, count in shard_cascaded.items():
+                cascaded[dependent] += count
+        rows.sort(key=lambda row: row[ID_COLUMNS[table]])
+        return {'rows': [self.with_gids(table, row) for row in rows], 'count': len(rows), 'cascaded': cascaded}
+
+    # Reads
+
+    def search(self, table, search_term='', limit=None, columns=None, include_archive=False):
+        if table not in SHARDED_TABLES:
+            return super().search(table, search_term, limit, columns, include_archive)
+        return self.gather(table, self.scatter(
+            lambda shard: shard.search(table, search_term, limit, columns, include_archive)), limit)
+
+    def get_all(self, table, include_archive=False):
+        if table not in SHARDED_TABLES:
+            return super().get_all(table, include_archive)
+        return self.gather(table, self.scatter(lambda shard: shard.get_all(table, include_archive)))
+
+    def get(self, table, id_column, id_value, include_archive=False):
+        if table not in SHARDED_TABLES:
+            return super().get(table, id_column, id_value, include_archive)
+        if table == 'patients' and id_column == 'patient_id':
+            return self.shards[self.shard_index(id_value)].get(table, id_column, id_value, include_archive)
+        return next((row for row in self.scatter(lambda shard: shard.get(table, id_column, id_value, include_archive))
+                     if row), None)
+
+    def count(self, table, include_archive=False):
+        if table not in SHARDED_TABLES:
+            return super().count(table, include_archive)
+        return sum(self.scatter(lambda shard: shard.count(table, include_archive)))
+
+    def existing_ids(self, table, ids):
+        if table != 'patients':
+            return super().existing_ids(table, ids)
+        by_shard = {}
+        for patient_id in ids:
+            by_shard.setdefault(self.shard_index(patient_id), []).append(patient_id)
+        return set().union(*(self.shards[index].existing_ids(table, shard_ids)
+                             for index, shard_ids in by_shard.items()))
+
+    def rows_by_id(self, table, ids, include_archive=False):
+        if table not in SHARDED_TABLES:
+            return super().rows_by_id(table, ids, include_archive)
+        return self.gather(table, self.scatter(lambda shard: shard.rows_by_id(table, ids, include_archive)))
+
+    def stats_rows(self, since=None):
+        """Statistics of all shards added up (a patient and their rows are
+        in one shard, so doctor/patient pairs never overlap)"""
+        merged = {}
+        for rows in self.scatter(lambda shard: shard.stats_rows(since)):
+            for name, entries in rows.items():
+                totals = merged.setdefault(name, {})
+                for entry in entries:
+                    key = tuple(value for column, value in entry.items() if column not in ('count', 'patients'))
+                    if key in totals:
+                        for column in ('count', 'patients'):
+                            if column in entry:
+                                totals[key][column] += entry[column]
+                    else:
+                        totals[key] = dict(entry)
+        return {name: list(totals.values()) for name, totals in merged.items()}
+
+    def timeline(self, patient_id, include_archive=False):
+        """From the patient's shard, with the doctors (kept in the main
+        database) filled in afterwards"""
+        result = self.shards[self.shard_index(patient_id)].timeline(patient_id, include_archive)
+        if result is not None:
+            self.fill_doctors([row for table in TIMELINE_COLUMNS for row in result[table]])
+        return result
+
+    def view_rows(self, table, where, params, limit=None, offset=0, include_archive=False):
+        """Each shard's first offset + limit rows, merged and cut down to
+        the page, with the doctors filled in"""
+        window = None if limit is None else offset + limit
+        results = self.scatter(lambda shard: shard.view_rows(table, where, params, window, 0, include_archive))
+        rows = self.gather(table, [result['rows'] for result in results])
+        rows = rows[offset:] if limit is None else rows[offset:offset + limit]
+        self.fill_doctors(rows)
+        return {'rows': rows, 'total': sum(result['total'] for result in results)}
+
+    def fill_doctors(self, rows):
+        """Set doctor_name and doctor_specialization of rows read from the
+        shards, whose doctors tables are empty"""
+        ids = sorted({row['doctor_id'] for row in rows if row['doctor_id'] is not None})
+        doctors = {row['doctor_id']: row for row in self.read(
+            f'SELECT doctor_id, name, specialization FROM doctors WHERE doctor_id IN ({", ".join("?" for _ in ids)})',
+            ids)} if ids else {}
+        for row in rows:
+            doctor = doctors.get(row['doctor_id'], {})
+            row['doctor_name'] = doctor.get('name')
+            row['doctor_specialization'] = doctor.get('specialization')
+
+    def bookings(self, doctor_ids, first_day, last_day):
+        """A doctor's appointments are spread over all shards"""
+        return self.gather('appointments', self.scatter(
+            lambda shard: shard.bookings(doctor_ids, first_day, last_day)))
+
+    # Change log
+
+    def merge_logs(self):
+        """Copy shard change log entries not yet in the main change log.
+        Each batch and the shard's cursor are committed together, so every
+        entry is copied exactly once, also with several processes merging."""
+        with self.merge_lock:
+            conn = sqlite3.connect(self.db_name, timeout=30)
+            try:
+                for index, shard in enumerate(self.shards):
+                    while True:
+                        row = conn.execute('SELECT seq FROM shard_cursors WHERE shard = ?', (index,)).fetchone()
+                        if shard.last_change() <= (row[0] if row else 0):
+                            break
+                        conn.execute('BEGIN IMMEDIATE')
+                        row = conn.execute('SELECT seq FROM shard_cursors WHERE shard = ?', (index,)).fetchone()
+                        entries = shard.changes_since(row[0] if row else 0, limit=self.MERGE_BATCH)
+                        conn.executemany('INSERT INTO change_log (table_name, row_id, op) VALUES (?, ?, ?)',
+                                         [(e['table_name'], e['row_id'], e['op']) for e in entries])
+                        if entries:
+                            conn.execute('INSERT OR REPLACE INTO shard_cursors (shard, seq) VALUES (?, ?)',
+                                         (index, entries[-1]['seq']))
+                        conn.commit()
+            finally:
+                conn.close()
+
+    def last_change(self):
+        self.merge_logs()
+        return super().last_change()
+
+    def changes_since(self, seq, tables=None, limit=None):
+        self.merge_logs()
+        return super().changes_since(seq, tables, limit)
+
+    # Setting up
+
+    def split_existing(self):
+        """Move the rows of a database that wasn't sharded yet into the
+        shards, archived ones into the shards' archives, then record the
+        shard count. Safe to repeat if interrupted."""
+        floor = 0
+        for table in SHARDED_TABLES:
+            rows = self.execute_query(f'SELECT * FROM {table}')
+            by_shard = {}
+            for row in rows:
+                by_shard.setdefault(self.shard_index(row['patient_id']), []).append(row)
+            for index, shard_rows in by_shard.items():
+                columns = list(shard_rows[0])
+                self.write(index, [lambda conn: conn.executemany(
+                    f'INSERT OR REPLACE INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+                    [[row[column] for column in columns] for row in shard_rows])])
+            sequence = self.execute_query('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,))
+            floor = max([floor] + [row[ID_COLUMNS[table]] for row in rows] + [row['seq'] for row in sequence])
+
+        archived = os.path.exists(self.archive_name)
+        if archived:
+            split = set()
+            for table in ARCHIVE_DATES:
+                rows = self.execute_query(f'SELECT * FROM archive.{table}', include_archive=True)
+                by_shard = {}
+                for row in rows:
+                    by_shard.setdefault(self.shard_index(row['patient_id']), []).append(row)
+                for index, shard_rows in by_shard.items():
+                    columns = list(shard_rows[0])
+                    conn = sqlite3.connect(self.shards[index].db_name, timeout=30)
+                    try:
+                        self.shards[index].attach_archive(conn)
+                        conn.executemany(f'INSERT OR REPLACE INTO archive.{table} ({", ".join(columns)}) '
+                                         f'VALUES ({", ".join("?" for _ in columns)})',
+                                         [[row[column] for column in columns] for row in shard_rows])
+                        conn.commit()
+                    finally:
+                        conn.close()
+                    split.add(index)
+                floor = max([floor] + [row[ID_COLUMNS[table]] for row in rows])
+            # Statistics count archived rows too
+            for index in split:
+                self.shards[index].rebuild_stats()
+
+        # New IDs in every shard start above every ID used so far
+        for index in range(len(self.shards)):
+            self.write(index, [(f"DELETE FROM sqlite_sequence WHERE name = '{table}'",) for table in SHARDED_TABLES] +
+                              [('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, floor))
+                               for table in SHARDED_TABLES])
+
+        # Rows copied into the shards were logged there as inserts; they are
+        # already in the main log, so merging starts after them
+        cursors = [(index, shard.last_change()) for index, shard in enumerate(self.shards)]
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            if archived:
+                self.attach_archive(conn)
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("INSERT OR REPLACE INTO hospital_meta (key, value) VALUES ('moving_rows', '1')")
+            for table in SHARDED_TABLES:
+                conn.execute(f'DELETE FROM {table}')
+            if archived:
+                for table in ARCHIVE_DATES:
+                    conn.execute(f'DELETE FROM archive.{table}')
+            conn.execute("DELETE FROM hospital_meta WHERE key = 'moving_rows'")
+            conn.executemany('INSERT OR REPLACE INTO shard_cursors (shard, seq) VALUES (?, ?)', cursors)
+            conn.execute("INSERT OR REPLACE INTO hospital_meta (key, value) VALUES ('shards', ?)",
+                         (str(len(self.shards)),))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Maintenance, on every file
+
+    def backup(self, target):
+        """Backup of the main database with the shards' rows folded back in,
+        so it reads like an unsharded database. Shards are copied after the
+        main file, so their rows can only be newer than the change sequence
+        reported; replaying the change feed from there converges.
+
+        The copy's statistics are the shards' added up, as these count
+        archived rows too, which the copy doesn't hold. The statistics
+        triggers are set aside while the rows are folded in, so they don't
+        count the rows a second time."""
+        self.merge_logs()
+        report = super().backup(target)
+        conn = sqlite3.connect(target)
+        try:
+            names = [f'{table}_stats_{op}' for table in STATS_TABLES for op in ('insert', 'update', 'delete')]
+            triggers = conn.execute(f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN "
+                                    f"({', '.join('?' for _ in names)})", names).fetchall()
+            for name, sql in triggers:
+                conn.execute(f'DROP TRIGGER {name}')
+            for summary in STATS_KEYS:
+                conn.execute(f'DELETE FROM {summary}')
+            for index, shard in enumerate(self.shards):
+                part = f'{target}.shard{index}'
+                shard_report = shard.backup(part)
+                report['pages'] += shard_report['pages']
+                report['steps'] += shard_report['steps']
+                conn.execute('ATTACH DATABASE ? AS shard', (part,))
+                for table in SHARDED_TABLES:
+                    conn.execute(f'INSERT OR REPLACE INTO main.{table} SELECT * FROM shard.{table}')
+                for summary, keys in STATS_KEYS.items():
+                    conn.execute(f'INSERT INTO main.{summary} ({", ".join(keys)}, count) '
+                                 f'SELECT {", ".join(keys)}, count FROM shard.{summary} WHERE 1 '
+                                 f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET count = count + excluded.count')
+                conn.commit()
+                conn.execute('DETACH DATABASE shard')
+                os.remove(part)
+            # Folding the rows in logged them again; the copy's log ends
+            # where the main database's did
+            conn.execute('DELETE FROM change_log WHERE seq > ?', (report['seq'],))
+            conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'change_log'", (report['seq'],))
+            conn.execute("DELETE FROM hospital_meta WHERE key = 'shards'")
+            conn.execute('DELETE FROM shard_cursors')
+            for name, sql in triggers:
+                conn.execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+        return report
+
+    def combine(self, reports):
+        report = reports[0]
+        for other in reports[1:]:
+            for key, value in other.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key in report:
+                    report[key] += value
+        return report
+
+    def checkpoint(self, mode='PASSIVE'):
+        return self.combine([super().checkpoint(mode)] + [shard.checkpoint(mode) for shard in self.shards])
+
+    def optimize(self):
+        return self.combine([super().optimize()] + [shard.optimize() for shard in self.shards])
+
+    def incremental_vacuum(self, pages=None):
+        return self.combine([super().incremental_vacuum(pages)] +
+                            [shard.incremental_vacuum(pages) for shard in self.shards])
+
+    def incremental_vacuum_enabled(self):
+        return super().incremental_vacuum_enabled() and all(
+            shard.incremental_vacuum_enabled() for shard in self.shards)
+
+    def enable_incremental_vacuum(self):
+        return self.combine([super().enable_incremental_vacuum()] +
+                            [shard.enable_incremental_vacuum() for shard in self.shards])
+
+    def archive(self, cutoff):
+        return self.combine([shard.archive(cutoff) for shard in self.shards])
+
+    def purge_orphans(self):
+        return self.combine([self.purge_orphans_in(shard) for shard in self.shards])
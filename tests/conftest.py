@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import HospitalDatabase
+from sharding import ShardedHospitalDatabase
+
+@pytest.fixture
+def db(tmp_path):
+    return HospitalDatabase(str(tmp_path / 'hospital.db'), 'Test Hospital')
+
+@pytest.fixture
+def sharded(tmp_path):
+    return ShardedHospitalDatabase(str(tmp_path / 'hospital.db'), 'Test Hospital', 2)
@@ -0,0 +1,39 @@
+import threading
+import time
+
+from bloom import SearchSketch, might_match
+
+def test_concurrent_refreshes_fold_each_change_in_once(db):
+    sketch = SearchSketch(db)
+    patient = db.insert('patients', {'name': 'Sara Ahmadi'})['row']
+    db.update('patients', 'patient_id', patient['patient_id'], {'name': 'Sara Karimi'})
+
+    # Slow the log read so both refreshes are inside it at once
+    changes_since = db.changes_since
+    def slow_changes_since(*args):
+        changes = changes_since(*args)
+        time.sleep(0.1)
+        return changes
+    db.changes_since = slow_changes_since
+
+    threads = [threading.Thread(target=sketch.refresh) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert sketch.stale == 1
+    assert might_match(sketch.filters['patients'], 'Karimi')
+
+def test_refresh_rebuilds_after_enough_overwrites(db):
+    sketch = SearchSketch(db)
+    sketch.REBUILD_AFTER = 2
+    patient = db.insert('patients', {'name': 'Sara Ahmadi'})['row']
+    db.update('patients', 'patient_id', patient['patient_id'], {'name': 'Sara Karimi'})
+    db.update('patients', 'patient_id', patient['patient_id'], {'name': 'Sara Tehrani'})
+
+    sketch.refresh()
+
+    assert sketch.stale == 0
+    assert sketch.seq == db.last_change()
+    assert might_match(sketch.filters['patients'], 'Tehrani')
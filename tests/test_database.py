@@ -0,0 +1,192 @@
+import threading
+
+import pytest
+
+def patients(db):
+    return [row['name'] for row in db.execute_query('SELECT name FROM patients ORDER BY patient_id')]
+
+def add(name):
+    return lambda conn: conn.execute('INSERT INTO patients (name) VALUES (?)', (name,)).lastrowid
+
+def submit_group(db, writes):
+    """Submit writes so they are committed as one group"""
+    started, release = threading.Event(), threading.Event()
+    blocker = db.submit(lambda conn: started.set() or release.wait(5))
+    started.wait(5)
+    futures = [db.submit(write) for write in writes]
+    release.set()
+    blocker.result(5)
+    return futures
+
+def test_failing_write_only_fails_itself(db):
+    def failing(conn):
+        conn.execute("INSERT INTO patients (name) VALUES ('Rolled back')")
+        raise ValueError('bad row')
+
+    first, bad, last = submit_group(db, [add('First'), failing, add('Last')])
+    with pytest.raises(ValueError):
+        bad.result(5)
+    assert first.result(5) and last.result(5)
+    assert patients(db) == ['First', 'Last']
+
+def test_failing_savepoint_fails_the_group(db):
+    def breaks_savepoint(conn):
+        conn.execute('RELEASE write')
+        raise ValueError('bad row')
+
+    futures = submit_group(db, [add('First'), breaks_savepoint, add('Last')])
+    for future in futures:
+        with pytest.raises(Exception):
+            future.result(5)
+    assert patients(db) == []
+    assert db.submit(add('After')).result(5)
+    assert patients(db) == ['After']
+
+def test_broken_connection_is_replaced(db):
+    def closes(conn):
+        conn.close()
+
+    futures = submit_group(db, [add('First'), closes])
+    for future in futures:
+        with pytest.raises(Exception):
+            future.result(5)
+    assert db.insert('patients', {'name': 'After'})['row']['name'] == 'After'
+    assert patients(db) == ['After']
+
+def add_history(db):
+    """A patient with an archived appointment and medical record, and a
+    recent appointment"""
+    patient = db.insert('patients', {'name': 'Sara Ahmadi', 'age': 30})['row']
+    doctor = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    for date in ('2020-01-01', '2030-01-01'):
+        db.insert('appointments', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                   'appointment_date': date, 'appointment_time': '10:00', 'status': 'Scheduled'})
+    db.insert('medical_records', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                  'diagnosis': 'Flu', 'record_date': '2020-01-01'})
+    db.archive('2025-01-01')
+    return patient, doctor
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_deletes_cascade_to_archived_rows(database, request):
+    db = request.getfixturevalue(database)
+    patient, doctor = add_history(db)
+    archived = db.get_all('appointments', include_archive=True)[0]
+    seq = db.last_change()
+
+    result = db.delete('patients', 'patient_id', patient['patient_id'])
+    assert result['cascaded'] == {'appointments': 2, 'medical_records': 1}
+    assert db.get_all('appointments', include_archive=True) == []
+    assert db.get_all('medical_records', include_archive=True) == []
+    _, changes = db.change_feed(seq)
+    assert {'table': 'appointments', 'row_id': archived['appointment_id'], 'op': 'delete', 'row': None} in changes
+    stats = db.stats()
+    assert stats['appointments_by_status'] == {} and stats['top_diagnoses'] == []
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_purge_orphans_covers_the_archive(database, request):
+    db = request.getfixturevalue(database)
+    patient, doctor = add_history(db)
+    # A delete from before deletes cascaded
+    home = db.shards[db.shard_index(patient['patient_id'])] if database == 'sharded' else db
+    home.execute_query('DELETE FROM patients')
+
+    report = db.purge_orphans()
+    assert (report['appointments'], report['medical_records']) == (2, 1)
+    assert db.get_all('appointments', include_archive=True) == []
+    assert db.get_all('medical_records', include_archive=True) == []
+
+def book(db, doctor, date, time_text, status='Scheduled'):
+    patient = db.insert('patients', {'name': 'Sara Ahmadi', 'age': 30})['row']
+    return db.insert('appointments', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                      'appointment_date': date, 'appointment_time': time_text,
+                                      'status': status})['row']
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_conflicts_across_midnight(database, request):
+    db = request.getfixturevalue(database)
+    doctor = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    late = book(db, doctor, '2030-01-01', '23:30')
+    book(db, doctor, '2030-01-02', '12:00', 'Cancelled')
+
+    assert [row['appointment_id'] for row in db.conflicts(doctor['doctor_id'], '2030-01-02', '00:15')] == \
+        [late['appointment_id']]
+    assert db.conflicts(doctor['doctor_id'], '2030-01-02', '00:15', late['appointment_id']) == []
+    assert db.conflicts(doctor['doctor_id'], '2030-01-02', '00:30') == []
+    assert db.conflicts(doctor['doctor_id'], '2030-01-02', '12:00') == []
+    with pytest.raises(ValueError):
+        db.conflicts(doctor['doctor_id'], '2030-01-02', 'noon')
+    with pytest.raises(ValueError):
+        db.conflicts(doctor['doctor_id'], 'tomorrow', '10:00')
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_free_slots_roll_over_to_the_next_day(database, request):
+    db = request.getfixturevalue(database)
+    doctor = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    db.insert('doctors', {'name': 'Dr. Karimi', 'specialization': 'Dermatology'})
+    book(db, doctor, '2030-01-02', '08:00')
+    book(db, doctor, '2030-01-02', '09:30')
+
+    slots = db.free_slots('cardiology', count=3, after='2030-01-01 16:30')
+    assert [(slot['date'], slot['time']) for slot in slots] == \
+        [('2030-01-01', '17:00'), ('2030-01-02', '11:00'), ('2030-01-02', '12:00')]
+    assert {slot['doctor_id'] for slot in slots} == {doctor['doctor_id']}
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_timeline_is_oldest_first_with_or_without_the_archive(database, request):
+    db = request.getfixturevalue(database)
+    patient = db.insert('patients', {'name': 'Sara Ahmadi', 'age': 30})['row']
+    doctor = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    for date, time_text in (('2030-01-01', '09:00'), ('2020-01-01', '10:00'), ('2030-01-01', '08:00')):
+        db.insert('appointments', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                   'appointment_date': date, 'appointment_time': time_text, 'status': 'Scheduled'})
+    for date in ('2029-06-01', '2019-06-01'):
+        db.insert('medical_records', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                      'diagnosis': 'Flu', 'record_date': date})
+    db.archive('2025-01-01')
+
+    timeline = db.timeline(patient['patient_id'])
+    assert timeline['patient']['name'] == 'Sara Ahmadi'
+    assert [(row['appointment_date'], row['appointment_time']) for row in timeline['appointments']] == \
+        [('2030-01-01', '08:00'), ('2030-01-01', '09:00')]
+    assert [row['record_date'] for row in timeline['medical_records']] == ['2029-06-01']
+    assert timeline['appointments'][0]['doctor_name'] == 'Dr. Rahimi'
+
+    timeline = db.timeline(patient['patient_id'], include_archive=True)
+    assert [(row['appointment_date'], row['appointment_time']) for row in timeline['appointments']] == \
+        [('2020-01-01', '10:00'), ('2030-01-01', '08:00'), ('2030-01-01', '09:00')]
+    assert [row['record_date'] for row in timeline['medical_records']] == ['2019-06-01', '2029-06-01']
+    assert db.timeline(patient['patient_id'] + 100) is None
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_list_view_search_dates_and_paging(database, request):
+    db = request.getfixturevalue(database)
+    rahimi = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    karimi = db.insert('doctors', {'name': 'Dr. Karimi', 'specialization': 'Dermatology'})['row']
+    for i in range(6):
+        patient = db.insert('patients', {'name': f'Patient {i}', 'age': 30 + i})['row']
+        db.insert('appointments', {'patient_id': patient['patient_id'],
+                                   'doctor_id': (rahimi if i % 2 else karimi)['doctor_id'],
+                                   'appointment_date': f'2030-01-0{i + 1}', 'appointment_time': '10:00',
+                                   'status': 'Completed' if i < 3 else 'Scheduled'})
+
+    page = db.list_view('appointments', limit=4)
+    assert page['total'] == 6 and len(page['rows']) == 4
+    ids = [row['appointment_id'] for row in page['rows']]
+    assert ids == sorted(ids)
+    rest = db.list_view('appointments', limit=4, offset=4)
+    assert rest['total'] == 6 and len(rest['rows']) == 2
+    assert not set(ids) & {row['appointment_id'] for row in rest['rows']}
+
+    # By patient name, doctor name or specialization, and the row itself
+    assert [row['patient_name'] for row in db.list_view('appointments', 'Patient 4')['rows']] == ['Patient 4']
+    cardiology = db.list_view('appointments', 'cardio')
+    assert cardiology['total'] == 3 and {row['doctor_name'] for row in cardiology['rows']} == {'Dr. Rahimi'}
+    assert db.list_view('appointments', 'Scheduled')['total'] == 3
+
+    dated = db.list_view('appointments', since='2030-01-02', until='2030-01-04', limit=2)
+    assert dated['total'] == 3
+    assert [row['appointment_date'] for row in dated['rows']] == ['2030-01-02', '2030-01-03']
+    filtered = db.list_view('appointments', 'Patient', {'doctor_id': karimi['doctor_id'], 'status': 'Completed'})
+    assert filtered['total'] == 2
+    with pytest.raises(ValueError):
+        db.list_view('appointments', filters={'notes': 'x'})
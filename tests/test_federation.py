@@ -0,0 +1,39 @@
+from database import make_gid
+import federation
+from federation import FederationService
+from linkage import PatientLinker
+
+class ListSource:
+    def __init__(self, hospital_id, hospital, rows):
+        self.hospital_id = hospital_id
+        self.hospital = hospital
+        self.rows = rows
+
+    def snapshot(self):
+        return 0, self.rows
+
+def test_timeline_resolves_hospitals_by_id(db):
+    service = FederationService(db, monitor=False)
+    # Same name as the master, and nothing listening at the URL
+    service.register('http://127.0.0.1:9', db.hospital_name, db.hospital_id + 1)
+    patient = db.insert('patients', {'name': 'Sara Ahmadi', 'age': 30, 'phone': '0912 111 2233'})['row']
+    PatientLinker(db).rebuild([ListSource(db.hospital_id, db.hospital_name, [patient]),
+                               ListSource(db.hospital_id + 1, db.hospital_name, [patient])])
+
+    timeline = service.timeline(make_gid(db.hospital_id, patient['patient_id']))
+    assert [(r['hospital_id'], r['patient_id']) for r in timeline['registrations']] == \
+        [(db.hospital_id, patient['patient_id'])]
+    assert timeline['missing'] == [db.hospital_name]
+    assert service.timeline(make_gid(db.hospital_id + 2, 1)) is None
+
+def test_replication_refuses_unregistered_hospitals(db):
+    federation.service = FederationService(db, monitor=False)
+    client = federation.app.test_client()
+    batch = {'hospital': 'Other Hospital', 'from_seq': 0, 'seq': 1, 'changes': []}
+    assert client.get('/replication/77').status_code == 404
+    assert client.post('/replication/77', json=batch).status_code == 404
+    assert client.post('/replication/77/snapshot').status_code == 404
+
+    federation.service.register('http://127.0.0.1:9', 'Other Hospital', 77)
+    assert client.get('/replication/77').get_json() == {'seq': 0}
+    assert client.post('/replication/77', json=batch).get_json() == {'status': 'success', 'seq': 1}
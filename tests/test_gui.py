@@ -0,0 +1,249 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import wait
+
+import pytest
+
+import gui
+from gui import BackgroundExecutor, VirtualTable
+
+class FakeRoot:
+    """Stands in for the Tk root: after() callbacks run when run() is called"""
+    def __init__(self):
+        self.pending = []
+
+    def after(self, ms, callback):
+        self.pending.append(callback)
+
+    def run(self):
+        callbacks, self.pending = self.pending, []
+        for callback in callbacks:
+            callback()
+
+class FakeScrollbar:
+    def __init__(self, *args, **options):
+        pass
+
+    def pack(self, **options):
+        pass
+
+    def set(self, first, last):
+        pass
+
+    def config(self, **options):
+        pass
+
+class FakeTreeview:
+    """Stands in for ttk.Treeview: keeps the items in order and counts the
+    calls that change them"""
+    def __init__(self, parent, columns, **options):
+        self.order = []
+        self.values = {}
+        self.selected = ()
+        self.calls = Counter()
+        self.created = 0
+
+    def heading(self, column, **options):
+        pass
+
+    def column(self, column, **options):
+        pass
+
+    def pack(self, **options):
+        pass
+
+    def bind(self, event, callback):
+        pass
+
+    def winfo_height(self):
+        return 10 * VirtualTable.ROW_HEIGHT
+
+    def yview_moveto(self, fraction):
+        pass
+
+    def xview(self, *args):
+        pass
+
+    def insert(self, parent, index, values):
+        self.created += 1
+        item = f'I{self.created}'
+        self.order.insert(index, item)
+        self.values[item] = tuple(values)
+        self.calls['insert'] += 1
+        return item
+
+    def item(self, item, values):
+        self.values[item] = tuple(values)
+        self.calls['item'] += 1
+
+    def move(self, item, parent, index):
+        self.order.remove(item)
+        self.order.insert(index, item)
+        self.calls['move'] += 1
+
+    def delete(self, item):
+        self.order.remove(item)
+        del self.values[item]
+        self.calls['delete'] += 1
+
+    def selection(self):
+        return self.selected
+
+    def selection_set(self, item):
+        self.selected = (item,)
+
+    def shown(self):
+        return [self.values[item] for item in self.order]
+
+@pytest.fixture
+def table(monkeypatch):
+    monkeypatch.setattr(gui.tk, 'Scrollbar', FakeScrollbar)
+    monkeypatch.setattr(gui.ttk, 'Treeview', FakeTreeview)
+    return VirtualTable(None, ('ID', 'Name'), 100)
+
+def select(table, key):
+    table.tree.selected = (table.key_items[key],)
+    table.on_select(None)
+
+@pytest.fixture
+def loader():
+    executor = BackgroundExecutor(FakeRoot(), max_workers=4)
+    yield executor
+    executor.shutdown()
+
+def settle(loader, futures):
+    """Wait for the jobs, then run the executor's poll until it has handed
+    out every result"""
+    wait(futures, 5)
+    deadline = time.monotonic() + 5
+    loader.root.run()
+    while loader.busy and time.monotonic() < deadline:
+        time.sleep(0.01)
+        loader.root.run()
+
+def test_newer_job_makes_older_result_stale(loader):
+    release = threading.Event()
+    results = []
+    old = loader.submit('patients', lambda: release.wait(5) and 'old', results.append)
+    new = loader.submit('patients', lambda: 'new', results.append)
+    release.set()
+    settle(loader, [old, new])
+    assert results == ['new']
+    assert loader.busy == 0
+
+def test_batch_jobs_all_deliver_until_replaced(loader):
+    results, errors = [], []
+
+    def fail():
+        raise RuntimeError('hospital down')
+
+    batch = [loader.submit('search', lambda name=name: name, results.append, replace=False)
+             for name in ('City', 'Central')]
+    batch.append(loader.submit('search', fail, results.append, errors.append, replace=False))
+    settle(loader, batch)
+    assert sorted(results) == ['Central', 'City']
+    assert [str(error) for error in errors] == ['hospital down']
+
+    # A new search drops whatever the previous batch still had running
+    release = threading.Event()
+    results.clear()
+    slow = loader.submit('search', lambda: release.wait(5) and 'slow', results.append, replace=False)
+    fresh = loader.submit('search', lambda: 'fresh', results.append)
+    release.set()
+    settle(loader, [slow, fresh])
+    assert results == ['fresh']
+
+def test_when_idle_waits_for_pending_jobs(loader):
+    release = threading.Event()
+    idle = []
+    job = loader.submit('patients', lambda: release.wait(5), lambda result: None)
+    loader.when_idle(lambda: idle.append(True))
+    assert idle == []
+    release.set()
+    settle(loader, [job])
+    assert idle == [True]
+
+def test_refresh_only_touches_changed_rows(table):
+    table.set_rows([(key, key, f'Patient {key}') for key in range(1, 6)])
+    assert table.tree.shown() == [(key, f'Patient {key}') for key in range(1, 6)]
+    select(table, 3)
+    selected = table.tree.selected
+    table.tree.calls.clear()
+
+    # Update in place
+    table.apply_changes(upserts=[(3, 3, 'Renamed')])
+    assert table.tree.calls == {'item': 1}
+    assert table.tree.shown()[2] == (3, 'Renamed')
+
+    # Insert and delete
+    table.tree.calls.clear()
+    table.apply_changes(upserts=[(6, 6, 'Patient 6')], deletes=[1])
+    assert table.tree.calls == {'insert': 1, 'delete': 1}
+    assert [values[0] for values in table.tree.shown()] == [2, 3, 4, 5, 6]
+
+    # Move: sorting reorders the existing items
+    table.tree.calls.clear()
+    table.sort_by('Name')
+    assert [values[1] for values in table.tree.shown()] == \
+        ['Patient 2', 'Patient 4', 'Patient 5', 'Patient 6', 'Renamed']
+    assert set(table.tree.calls) == {'move'}
+    assert table.tree.selected == selected and table.selected_values() == (3, 'Renamed')
+
+def test_only_a_window_of_rows_is_rendered(table):
+    table.set_rows([(key, key, f'Patient {key}') for key in range(500)])
+    assert len(table.tree.order) == 10 + VirtualTable.BUFFER
+    select(table, 5)
+    table.render(250)
+    assert [values[0] for values in table.tree.shown()] == list(range(150, 360))
+    # The selected row is out of the window but still known
+    assert table.selected_values() == (5, 'Patient 5')
+    table.render(0)
+    assert table.tree.selected == (table.key_items[5],)
+
+def test_type_ahead_finds_substrings_and_follows_edits():
+    index = gui.TypeAheadIndex({1: '1 - Sara Ahmadi', 2: '2 - Ali Rahimi', 3: '3 - Sarah Karimi'})
+    assert index.search('sara', 10) == ['1 - Sara Ahmadi', '3 - Sarah Karimi']
+    assert index.search('IMI', 10) == ['2 - Ali Rahimi', '3 - Sarah Karimi']
+    assert index.search('sa', 1) == ['1 - Sara Ahmadi']
+    assert index.search('nobody', 10) == []
+    assert '2 - Ali Rahimi' in index and '2 - Ali' not in index
+    assert index.label_for('3') == '3 - Sarah Karimi'
+
+    index.add(2, '2 - Ali Tehrani')
+    assert index.search('rahimi', 10) == []
+    assert index.search('tehran', 10) == ['2 - Ali Tehrani']
+    index.remove(1)
+    assert index.search('sara', 10) == ['3 - Sarah Karimi']
+    assert index.label_for(1) is None
+    assert not any(1 in keys for keys in index.postings.values())
+
+def patient(gid, name, hospital='City Hospital'):
+    return gui.make_record('patients', {'patient_id': gid, 'name': name, 'gid': gid}, hospital)
+
+def test_store_notifies_only_changes():
+    store = gui.DataStore()
+    changes = []
+    store.subscribe('patients', lambda upserts, deletes: changes.append(
+        ([record.name for record in upserts], [record.name for record in deletes])))
+
+    store.replace('patients', 'City Hospital', [patient(1, 'Sara'), patient(2, 'Ali')])
+    store.replace('patients', 'Central Hospital', [patient(10, 'Reza', 'Central Hospital')])
+    assert store.is_loaded('patients', 'City Hospital')
+    changes.clear()
+
+    # A reload only reports what changed, and leaves other hospitals alone
+    store.replace('patients', 'City Hospital', [patient(1, 'Sara'), patient(3, 'Maryam')])
+    assert changes == [(['Maryam'], ['Ali'])]
+    assert sorted(record.name for record in store.records('patients')) == ['Maryam', 'Reza', 'Sara']
+
+    changes.clear()
+    store.upsert('patients', patient(1, 'Sara'))
+    assert changes == []
+    store.upsert('patients', patient(1, 'Sara Ahmadi'))
+    store.merge('patients', [patient(1, 'Sara Ahmadi'), patient(4, 'Nima')])
+    store.delete('patients', 1)
+    store.delete('patients', 1)
+    store.delete_many('patients', [3, 4, 99])
+    assert changes == [(['Sara Ahmadi'], []), (['Nima'], []), ([], ['Sara Ahmadi']), ([], ['Maryam', 'Nima'])]
+    assert [record.name for record in store.records('patients', 'Central Hospital')] == ['Reza']
@@ -0,0 +1,35 @@
+from linkage import PatientLinker
+
+class ListSource:
+    def __init__(self, hospital_id, hospital, rows):
+        self.hospital_id = hospital_id
+        self.hospital = hospital
+        self.rows = rows
+
+    def snapshot(self):
+        return 0, self.rows
+
+    def changes(self, since):
+        return None
+
+PATIENT = {'patient_id': 1, 'name': 'Sara Ahmadi', 'age': 30, 'gender': 'Female', 'phone': '0912 111 2233'}
+
+def test_registrations_are_keyed_by_hospital_id(db):
+    linker = PatientLinker(db)
+    # Two hospitals sharing a name are still told apart
+    linker.rebuild([ListSource(7, 'City Hospital', [PATIENT]), ListSource(9, 'City Hospital', [PATIENT])])
+    assert linker.global_id(7, 1) == linker.global_id(9, 1)
+    assert linker.linked(7, 1) == [(7, 1), (9, 1)]
+
+    linker.apply(9, 'City Hospital', [{'row_id': 1, 'row': None}], 5)
+    assert linker.linked(7, 1) == [(7, 1)]
+    cursors = db.execute_query('SELECT hospital_id, seq FROM linkage_cursors ORDER BY hospital_id')
+    assert [(row['hospital_id'], row['seq']) for row in cursors] == [(7, 0), (9, 5)]
+
+def test_index_keyed_by_name_is_rebuilt(db):
+    db.execute_query('CREATE TABLE master_patient_index (hospital TEXT, patient_id INTEGER, global_id INTEGER, '
+                     'PRIMARY KEY (hospital, patient_id))')
+    db.execute_query('CREATE TABLE linkage_cursors (hospital TEXT PRIMARY KEY, seq INTEGER NOT NULL)')
+    linker = PatientLinker(db)
+    linker.sync([ListSource(7, 'City Hospital', [PATIENT])])
+    assert linker.linked(7, 1) == [(7, 1)]
@@ -0,0 +1,24 @@
+import sqlite3
+
+from database import HospitalDatabase
+from maintenance import MaintenanceScheduler
+
+def test_vacuum_is_skipped_until_enabled(tmp_path):
+    path = str(tmp_path / 'old.db')
+    # A database from before incremental vacuum
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE patients (patient_id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL)')
+    conn.close()
+    db = HospitalDatabase(path, 'Old Hospital')
+    scheduler = MaintenanceScheduler(db)
+
+    report = scheduler.vacuum()
+    assert report['skipped'] and report['pages'] == 0
+    assert not db.incremental_vacuum_enabled()
+    reports = scheduler.run_due(force=True)
+    assert not db.incremental_vacuum_enabled()
+    assert [r['task'] for r in reports if r.get('skipped')] == ['incremental_vacuum']
+
+    assert not scheduler.enable_vacuum().get('error')
+    assert db.incremental_vacuum_enabled()
+    assert 'skipped' not in scheduler.vacuum()
@@ -0,0 +1,58 @@
+import pytest
+
+from database import make_gid
+from replication import ReplicaDatabase
+
+def add_history(db):
+    """A patient with an old and a recent appointment"""
+    patient = db.insert('patients', {'name': 'Sara Ahmadi', 'age': 30})['row']
+    doctor = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    rows = [db.insert('appointments', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                       'appointment_date': date, 'appointment_time': '10:00',
+                                       'status': 'Scheduled'})['row']
+            for date in ('2020-01-01', '2030-01-01')]
+    return patient, rows
+
+def ship(db, replica, since=0):
+    seq, changes = db.change_feed(since)
+    assert replica.apply(db.hospital_id, db.hospital_name, since, seq, changes) == seq
+    return seq, changes
+
+def replicated(replica, table):
+    conn = replica.connect()
+    rows = [dict(row) for row in conn.execute(f'SELECT * FROM {table} ORDER BY gid')]
+    conn.close()
+    return rows
+
+@pytest.mark.parametrize('database', ['db', 'sharded'])
+def test_archive_moves_are_not_replicated_as_deletes(database, request, tmp_path):
+    db = request.getfixturevalue(database)
+    replica = ReplicaDatabase(str(tmp_path / 'replica.db'))
+    patient, (old, recent) = add_history(db)
+    seq, _ = ship(db, replica)
+
+    assert db.archive('2025-01-01')['appointments'] == 1
+    seq, changes = ship(db, replica, seq)
+    moved = [change for change in changes if change['table'] == 'appointments']
+    assert [(change['row_id'], change['op']) for change in moved] == [(old['appointment_id'], 'archive')]
+    assert moved[0]['row']['appointment_date'] == '2020-01-01'
+    assert [row['gid'] for row in replicated(replica, 'appointments')] == [old['gid'], recent['gid']]
+
+    # A replica replaying the whole log still gets the archived row
+    fresh = ReplicaDatabase(str(tmp_path / 'fresh.db'))
+    ship(db, fresh)
+    assert [row['gid'] for row in replicated(fresh, 'appointments')] == [old['gid'], recent['gid']]
+
+    db.delete('appointments', 'appointment_id', recent['appointment_id'])
+    ship(db, replica, seq)
+    assert [row['gid'] for row in replicated(replica, 'appointments')] == [old['gid']]
+
+def test_archive_entry_without_row_is_ignored(tmp_path):
+    replica = ReplicaDatabase(str(tmp_path / 'replica.db'))
+    row = {'appointment_id': 1, 'patient_id': 1, 'doctor_id': 1, 'gid': make_gid(5, 1),
+           'patient_gid': make_gid(5, 1), 'doctor_gid': make_gid(5, 1)}
+    replica.apply(5, 'City Hospital', 0, 1, [{'table': 'appointments', 'row_id': 1, 'op': 'insert', 'row': row}])
+    replica.apply(5, 'City Hospital', 1, 2, [{'table': 'appointments', 'row_id': 1, 'op': 'archive', 'row': None}])
+    assert len(replicated(replica, 'appointments')) == 1
+    replica.apply(5, 'City Hospital', 2, 3, [{'table': 'appointments', 'row_id': 1, 'op': 'delete', 'row': None}])
+    assert replicated(replica, 'appointments') == []
@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import pytest
+
+import asgi_server
+import server
+
+BAD_BODIES = [[1, 2], {'ids': [True]}, {'ids': 'all'}, None]
+
+@pytest.fixture
+def app(db, monkeypatch):
+    monkeypatch.setattr(server, 'db', db)
+    return server.app.test_client()
+
+def asgi_request(method, path, body=None, content_type='application/json'):
+    """Status and JSON answer of one request to the ASGI app"""
+    messages = [{'type': 'http.request', 'body': body or b'', 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    headers = [(b'content-type', content_type.encode())] if content_type else []
+    scope = {'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+             'headers': headers, 'scheme': 'http', 'server': ('test', 80), 'root_path': ''}
+    asyncio.run(asgi_server.app(scope, receive, send))
+    body = b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+    return sent[0]['status'], json.loads(body)
+
+@pytest.mark.parametrize('body', BAD_BODIES)
+def test_bulk_delete_rejects_bad_bodies(app, body):
+    response = app.delete('/patients', json=body)
+    assert response.status_code == 400
+
+@pytest.mark.parametrize('body', BAD_BODIES)
+def test_asgi_bulk_delete_rejects_bad_bodies(db, monkeypatch, body):
+    monkeypatch.setattr(server, 'db', db)
+    assert asgi_request('DELETE', '/patients', json.dumps(body).encode())[0] == 400
+
+def test_writes_need_a_json_object(app):
+    patient = app.post('/patients', json={'name': 'Sara Ahmadi'}).json
+    assert app.post('/patients', data='name=Sara', content_type='application/x-www-form-urlencoded').status_code == 415
+    assert app.post('/patients', json=[{'name': 'Sara Ahmadi'}]).status_code == 400
+    assert app.put(f"/patients/{patient['patient_id']}", json=['name']).status_code == 400
+    assert app.delete('/patients', json={'ids': [patient['patient_id']]}).json['count'] == 1
+
+    assert asgi_request('POST', '/patients', b'name=Sara', 'application/x-www-form-urlencoded')[0] == 415
+    assert asgi_request('POST', '/patients', b'{"name": "Sara"}', None)[0] == 415
+    assert asgi_request('POST', '/patients', b'[{"name": "Sara"}]')[0] == 400
+    status, answer = asgi_request('POST', '/patients', b'{"name": "Sara"}')
+    assert status == 200
+    assert asgi_request('PUT', f"/patients/{answer['patient_id']}", b'["name"]')[0] == 400
+    assert asgi_request('PUT', f"/patients/{answer['patient_id']}", b'{"age": 31}', 'text/plain')[0] == 415
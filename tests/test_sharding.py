@@ -0,0 +1,87 @@
+from database import HospitalDatabase
+from sharding import ShardedHospitalDatabase
+
+def test_async_writes_go_to_the_shards(sharded):
+    patients = [sharded.insert_async('patients', {'name': f'Patient {i}', 'age': 30}).result()['row']
+                for i in range(4)]
+    doctor = sharded.insert_async('doctors', {'name': 'Dr. Rahimi'}).result()['row']
+    assert sharded.shards[0].execute_query('SELECT COUNT(*) AS n FROM patients')[0]['n'] == 2
+    assert sharded.shards[1].execute_query('SELECT COUNT(*) AS n FROM patients')[0]['n'] == 2
+    assert sharded.execute_query('SELECT COUNT(*) AS n FROM patients')[0]['n'] == 0
+
+    appointment = sharded.insert_async('appointments', {'patient_id': patients[1]['patient_id'],
+                                                        'doctor_id': doctor['doctor_id']}).result()['row']
+    assert sharded.update_async('patients', 'patient_id', patients[0]['patient_id'],
+                                {'age': 31}).result()['row']['age'] == 31
+    assert sharded.get('patients', 'patient_id', patients[0]['patient_id'])['age'] == 31
+
+    result = sharded.delete_async('doctors', 'doctor_id', doctor['doctor_id']).result()
+    assert result['cascaded']['appointments'] == 1
+    assert sharded.get('appointments', 'appointment_id', appointment['appointment_id']) is None
+
+    ids = [patient['patient_id'] for patient in patients]
+    assert sharded.delete_many_async('patients', 'patient_id', ids).result()['count'] == 4
+    assert sharded.get_all('patients') == []
+
+def add_appointments(db):
+    doctor = db.insert('doctors', {'name': 'Dr. Rahimi', 'specialization': 'Cardiology'})['row']
+    for i in range(6):
+        patient = db.insert('patients', {'name': f'Patient {i}', 'age': 30 + i})['row']
+        for date, status in (('2020-01-0%d' % (i + 1), 'Completed'), ('2030-01-01', 'Cancelled')):
+            db.insert('appointments', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                       'appointment_date': date, 'appointment_time': '10:00', 'status': status})
+        db.insert('medical_records', {'patient_id': patient['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                      'diagnosis': 'Flu', 'record_date': '2020-01-01'})
+
+def test_backup_has_the_live_statistics(sharded, tmp_path):
+    add_appointments(sharded)
+    sharded.archive('2025-01-01')
+    target = str(tmp_path / 'backup.db')
+    sharded.backup(target)
+
+    copy = HospitalDatabase(target, sharded.hospital_name)
+    live = sharded.stats()
+    assert live['appointments_by_status'] == {'Completed': 6, 'Cancelled': 6}
+    assert copy.stats() == live
+    # The copy keeps counting
+    copy.insert('appointments', {'patient_id': 1, 'doctor_id': 1, 'appointment_date': '2030-01-02',
+                                 'status': 'Cancelled'})
+    assert copy.stats()['appointments_by_status']['Cancelled'] == 7
+
+def test_split_moves_archived_rows_to_the_shards(tmp_path):
+    path = str(tmp_path / 'hospital.db')
+    add_appointments(HospitalDatabase(path, 'Test Hospital'))
+    db = HospitalDatabase(path, 'Test Hospital')
+    db.archive('2025-01-01')
+    before = db.stats()
+    timeline = db.timeline(1, include_archive=True)
+
+    sharded = ShardedHospitalDatabase(path, 'Test Hospital', 2)
+    assert len(sharded.get_all('appointments')) == 6
+    assert len(sharded.get_all('appointments', include_archive=True)) == 12
+    assert len(sharded.get_all('medical_records', include_archive=True)) == 6
+    assert sharded.timeline(1, include_archive=True) == timeline
+    assert sharded.stats() == before
+    # Every archived row lives in its patient's shard
+    for index, shard in enumerate(sharded.shards):
+        rows = shard.execute_query('SELECT patient_id FROM archive.appointments', include_archive=True)
+        assert rows and all(row['patient_id'] % 2 == index for row in rows)
+
+def test_row_moving_to_another_shard_stays_in_the_log(sharded):
+    first, second = [sharded.insert('patients', {'name': f'Patient {i}', 'age': 30})['row'] for i in range(2)]
+    assert (sharded.shard_index(first['patient_id']), sharded.shard_index(second['patient_id'])) == (0, 1)
+    doctor = sharded.insert('doctors', {'name': 'Dr. Rahimi'})['row']
+    appointment = sharded.insert('appointments', {'patient_id': second['patient_id'], 'doctor_id': doctor['doctor_id'],
+                                                  'appointment_date': '2030-01-01', 'status': 'Scheduled'})['row']
+    # To a lower shard, whose log is merged first
+    sharded.update('appointments', 'appointment_id', appointment['appointment_id'], {'patient_id': first['patient_id']})
+
+    latest = {}
+    for change in sharded.changes_since(0):
+        latest[(change['table_name'], change['row_id'])] = change['op']
+    assert latest[('appointments', appointment['appointment_id'])] != 'delete'
+    moved = sharded.get('appointments', 'appointment_id', appointment['appointment_id'])
+    assert moved['patient_id'] == first['patient_id']
+    stats = sharded.stats()
+    assert stats['appointments_by_status'] == {'Scheduled': 1}
+    assert [row['patients'] for row in stats['patients_per_doctor']] == [1]